@@ -0,0 +1,332 @@
+import hashlib
+import itertools
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+import ai_backend
+import ai_cache
+import gemini_files
+import ratelimit
+import storage
+
+# --- AI LOGIC (ROBUST RETRY + CORRECTED MODEL) ---
+# Prompting, retries, parsing and caching for the AI Tutor and the Study Center. No Streamlit in here, so
+# the same code runs in the app, in the jobs.py workers and under bench_ai.py. The model comes from
+# ai_backend.load(): real Gemini, or the offline fake when IITCONNECT_AI_BACKEND=fake.
+
+genai = ai_backend.load()
+API_KEY = None
+
+def configure(api_key):
+    global API_KEY
+    if api_key and api_key != "PASTE_YOUR_API_KEY_HERE": API_KEY = api_key
+    genai.configure(api_key=api_key)
+
+def pdf_text(pdf_path, max_chars=None):
+    try: return storage.get_pdf_text(pdf_path, max_chars)
+    except Exception: return ""
+
+AI_MODEL = "gemini-2.5-flash"
+# Bump PROMPT_VERSION whenever AI_PROMPTS change so cached artifacts from older prompts are not served.
+PROMPT_VERSION = 1
+AI_PROMPTS = {
+    'mcq': 'Create 5 MCQs based on the content. Return ONLY a JSON array: [{"question":"...","options":["A","B","C","D"],"answer":"Exact Text","hint":"..."}]',
+    'subjective': 'Create 5 short descriptive questions. Return ONLY a JSON array: [{"question":"...","model_answer":"...","hint":"..."}]',
+    'flashcard': 'Create 8 flashcards. Return ONLY a JSON array: [{"term":"...","definition":"..."}]',
+    'summary': "Summarize in bullets. Return text.",
+    'mindmap': 'Create a hierarchical mind map. Return ONLY valid Graphviz DOT syntax starting with "digraph G {". Use simple labels.'
+}
+# STUDY PACK: every artifact from ONE call. Section shapes mirror AI_PROMPTS so results are interchangeable.
+STUDY_TASKS = ['summary', 'mindmap', 'flashcard', 'mcq', 'subjective']
+PACK_SECTIONS = {
+    'summary': '"summary": "bullet-point summary as one markdown string"',
+    'mindmap': '"mindmap": "hierarchical mind map as Graphviz DOT starting with digraph G {, simple labels"',
+    'flashcard': '"flashcard": [8 items of {"term":"...","definition":"..."}]',
+    'mcq': '"mcq": [5 items of {"question":"...","options":["A","B","C","D"],"answer":"Exact Text","hint":"..."}]',
+    'subjective': '"subjective": [5 items of {"question":"...","model_answer":"...","hint":"..."}]'
+}
+SECTION_KEYS = {'flashcard': ('term', 'definition'), 'mcq': ('question', 'options', 'answer'), 'subjective': ('question', 'model_answer')}
+
+AI_OUTPUT_RESERVE = 2048 # tokens budgeted for the reply until usage_metadata reports the real count
+AI_QUEUE_FULL = "⚠️ System Busy: AI queue is full"
+
+def estimate_tokens(prompt, file_path=None):
+    est = len(prompt) // 4 + AI_OUTPUT_RESERVE
+    if file_path:
+        # Gemini bills ~258 tokens per PDF page / image
+        try: est += 258 * (storage.pdf_stats(file_path)['pages'] if file_path.lower().endswith('.pdf') else 1)
+        except Exception: est += 258
+    return est
+
+def get_ai_response(prompt, file_path=None, priority=ratelimit.INTERACTIVE, max_wait=None, on_text=None):
+    """The model's reply text, or an error string. With on_text, the reply is streamed and on_text(text so far)
+    is called as chunks arrive; a retried attempt starts the text over."""
+    if not API_KEY: return "Error: API Key missing. Please config."
+    
+    model_name = AI_MODEL
+    max_retries = 3
+    base_delay = 10
+    est_tokens = estimate_tokens(prompt, file_path)
+
+    for attempt in range(max_retries):
+        try:
+            # Shared RPM/TPM buckets + concurrency cap; raises RateLimited instead of queueing past max_wait
+            with ratelimit.slot(est_tokens, priority, max_wait) as lease:
+                response = call_model(model_name, prompt, file_path, stream=on_text is not None)
+                text = read_stream(response, on_text) if on_text else response.text
+                usage = getattr(response, 'usage_metadata', None) # on a stream, only set once it is consumed
+                lease.used = getattr(usage, 'total_token_count', None)
+            return text
+
+        except ratelimit.RateLimited as e:
+            return f"{AI_QUEUE_FULL} (#{e.position} in line). Try again in {e.retry_after:.0f}s."
+        except Exception as e:
+            error_msg = str(e)
+            print(f"Attempt {attempt+1} failed: {error_msg}")
+            # Handle Quota/Rate Limits (429) or Server Overload (503)
+            if "429" in error_msg or "quota" in error_msg.lower() or "resource" in error_msg.lower():
+                if attempt < max_retries - 1:
+                    ratelimit.penalize(base_delay * (2**attempt)) # everyone backs off, with jitter; next slot() waits it out
+                    continue
+                else:
+                    return "⚠️ System Busy: API Quota exceeded. Please wait 1 minute."
+            
+            return f"AI Failed. Error: {error_msg}"
+
+def read_stream(response, on_text):
+    parts = []
+    for chunk in response:
+        try: piece = chunk.text
+        except ValueError: continue # a chunk without text parts (e.g. only the finish reason)
+        if piece:
+            parts.append(piece); on_text("".join(parts))
+    return "".join(parts)
+
+def call_model(model_name, prompt, file_path=None, stream=False):
+    model = genai.GenerativeModel(model_name)
+    if file_path:
+        try:
+            mime_type = 'application/pdf'
+            if file_path.lower().endswith(('.png', '.jpg', '.jpeg')):
+                mime_type = 'image/jpeg'
+
+            # One upload per document content, shared across tasks and users until the handle expires
+            uploaded = gemini_files.get_or_upload(file_path, mime_type)
+            response = model.generate_content([uploaded, prompt], stream=stream)
+        except Exception as inner_e:
+            # Fallback text extraction if vision upload/processing fails
+            if file_path.lower().endswith('.pdf'):
+                text = pdf_text(file_path, max_chars=15000)
+                if not text: raise ValueError("Empty PDF text")
+                response = model.generate_content(f"{prompt}\n\nContext:\n{text}", stream=stream)
+            else: 
+                raise inner_e
+    else:
+        response = model.generate_content(prompt, stream=stream)
+    return response
+
+def extract_json_from_text(text):
+    if not text: return None
+    try:
+        match = re.search(r'(\[.*\]|\{.*\})', text, re.DOTALL)
+        if match: return json.loads(match.group(1))
+    except: pass
+    return None
+
+_json_decoder = json.JSONDecoder()
+
+def partial_json_items(text):
+    """The complete objects so far of a JSON array that is still streaming in: '[{...}, {...}, {"te' -> 2 items."""
+    start = (text or "").find('[')
+    if start < 0: return []
+    items, i = [], start + 1
+    while True:
+        while i < len(text) and text[i] in " \t\r\n,": i += 1
+        if i >= len(text) or text[i] == ']': return items
+        try: item, i = _json_decoder.raw_decode(text, i)
+        except ValueError: return items
+        if isinstance(item, dict): items.append(item)
+
+def extract_dot_from_text(text):
+    if not text: return None
+    try:
+        match = re.search(r'(digraph\s+.*\}|graph\s+.*\})', text, re.DOTALL)
+        if match: return match.group(1)
+        if "digraph" in text: return text
+    except: pass
+    return None
+
+class AIBusy(RuntimeError):
+    """Job handlers raise this when the shared AI queue is full; jobs.py defers the job without spending an attempt."""
+    def __init__(self, msg):
+        super().__init__(msg); self.retry_after = ratelimit.retry_after()
+
+def check_ai_result(result, empty="Empty AI reply"):
+    if isinstance(result, str) and result.startswith(AI_QUEUE_FULL): raise AIBusy(result)
+    if not result or is_ai_error(result): raise RuntimeError(result or empty)
+
+def is_ai_error(result):
+    return isinstance(result, str) and (result.startswith("AI Failed") or result.startswith("⚠️ System Busy") or result.startswith("Error"))
+
+def ai_artifact_key(file_path, task_type, force_vision=False):
+    # Cached per-page stats decide vision vs text without re-parsing.
+    use_vision = force_vision or not file_path.lower().endswith('.pdf') or storage.pdf_stats(file_path)['chars'] < 50
+    mode = "vision" if use_vision else "text"
+    return ai_cache.cache_key(storage.file_hash(file_path), task_type, AI_MODEL, PROMPT_VERSION, mode), use_vision
+
+def generate_ai_content(file_path, task_type, force_vision=False, refresh=False, on_text=None):
+    # Persistent cache keyed by (content hash, task, model, prompt version, mode); refresh=True bypasses the read.
+    # on_text streams the raw reply of a single-pass call; map-reduced long documents only have a result at the end.
+    key, use_vision = ai_artifact_key(file_path, task_type, force_vision)
+    if not refresh:
+        cached = ai_cache.get(key)
+        if cached is not None: return cached
+        ai_cache.miss()
+    
+    if not use_vision and is_long_pdf(file_path):
+        result = map_reduce_content(file_path, task_type, refresh) # whole document, not just the first 12k chars
+        if is_ai_error(result): return result
+    else:
+        if use_vision:
+            raw_text = get_ai_response(AI_PROMPTS[task_type], file_path=file_path, on_text=on_text)
+        else:
+            raw_text = get_ai_response(f"{AI_PROMPTS[task_type]}\n\nContent:\n{pdf_text(file_path, max_chars=AI_SINGLE_PASS_CHARS)}", on_text=on_text)
+        
+        if raw_text and is_ai_error(raw_text): return raw_text 
+
+        if task_type == 'summary': result = raw_text
+        elif task_type == 'mindmap': result = extract_dot_from_text(raw_text)
+        else: result = extract_json_from_text(raw_text)
+    
+    if result: ai_cache.put(key, result, storage.file_hash(file_path), task_type, AI_MODEL, PROMPT_VERSION)
+    return result
+
+# --- LONG DOCUMENTS: MAP-REDUCE OVER PAGE CHUNKS ---
+AI_SINGLE_PASS_CHARS = 12000 # text budget of one prompt
+CHUNK_CHARS = 8000
+MAP_WORKERS = int(os.environ.get("IITCONNECT_AI_MAP_WORKERS", "4")) # the shared rate limiter still paces the calls
+MAP_PROMPTS = {
+    'summary': "This is one section of a longer document. Summarize it in concise bullets; keep definitions, formulas and key results. Return text.",
+    'flashcard': 'This is one section of a longer document. Create 4 flashcards. Return ONLY a JSON array: [{"term":"...","definition":"..."}]',
+    'mcq': 'This is one section of a longer document. Create 3 MCQs. Return ONLY a JSON array: [{"question":"...","options":["A","B","C","D"],"answer":"Exact Text","hint":"..."}]',
+    'subjective': 'This is one section of a longer document. Create 2 short descriptive questions. Return ONLY a JSON array: [{"question":"...","model_answer":"...","hint":"..."}]'
+}
+REDUCE_PROMPTS = {
+    'summary': "These are bullet summaries of consecutive sections of one document. Merge them into one bullet summary grouped by topic, removing repetition. Return text.",
+    'mindmap': AI_PROMPTS['mindmap'] + " Build it from these section summaries of one document."
+}
+LIST_LIMITS = {'flashcard': 24, 'mcq': 15, 'subjective': 10}
+
+def is_long_pdf(file_path):
+    return file_path.lower().endswith('.pdf') and storage.pdf_stats(file_path)['chars'] > AI_SINGLE_PASS_CHARS
+
+def pdf_chunks(file_path, target=CHUNK_CHARS):
+    """[(first_page, last_page, text)] of whole pages. A page closes a chunk when its own text hash says so (between
+    target/2 and 2*target chars), so boundaries depend on local content: editing one chapter only changes its chunks."""
+    chunks, pages, size = [], [], 0
+    for page_no, text in storage.iter_pages(file_path):
+        pages.append((page_no, text)); size += len(text)
+        if size >= 2 * target or (size >= target // 2 and int(hashlib.sha256(text.encode()).hexdigest()[:8], 16) % 4 == 0):
+            chunks.append(pages); pages, size = [], 0
+    if pages: chunks.append(pages)
+    return [(p[0][0], p[-1][0], "".join(t for _, t in p)) for p in chunks]
+
+def cached_ai_call(label, prompt, text, parse=None, refresh=False):
+    """One text-mode call memoized in the artifact cache by the hash of its input text."""
+    text_hash = hashlib.sha256(text.encode()).hexdigest()
+    key = ai_cache.cache_key(text_hash, label, AI_MODEL, PROMPT_VERSION)
+    if not refresh:
+        cached = ai_cache.get(key)
+        if cached is not None: return cached
+        ai_cache.miss()
+    raw_text = get_ai_response(f"{prompt}\n\nContent:\n{text}")
+    if is_ai_error(raw_text): return raw_text
+    result = parse(raw_text) if parse else raw_text
+    if result: ai_cache.put(key, result, text_hash, label, AI_MODEL, PROMPT_VERSION)
+    return result
+
+def map_chunks(task_type, chunks, refresh=False):
+    parse = None if task_type == 'summary' else extract_json_from_text
+    with ThreadPoolExecutor(max_workers=MAP_WORKERS) as pool:
+        return list(pool.map(lambda c: cached_ai_call(f"map-{task_type}", MAP_PROMPTS[task_type], c[2], parse, refresh), chunks))
+
+def condense(parts, refresh=False):
+    """Reduce section summaries in rounds until they fit in one prompt. Returns the joined text (or an AI error)."""
+    while True:
+        text = "\n\n".join(parts)
+        if len(text) <= AI_SINGLE_PASS_CHARS: return text
+        before = sum(map(len, parts))
+        batches = [[]]
+        for p in parts:
+            if batches[-1] and sum(map(len, batches[-1])) + len(p) > AI_SINGLE_PASS_CHARS: batches.append([])
+            batches[-1].append(p)
+        with ThreadPoolExecutor(max_workers=MAP_WORKERS) as pool:
+            parts = list(pool.map(lambda b: cached_ai_call("reduce-summary", REDUCE_PROMPTS['summary'], "\n\n".join(b), refresh=refresh), batches))
+        err = next((p for p in parts if is_ai_error(p)), None)
+        if err: return err
+        parts = [p for p in parts if p]
+        if sum(map(len, parts)) >= before: # each round must shrink the text, or it would never fit
+            return f"AI Failed. Error: section summaries did not shrink below {AI_SINGLE_PASS_CHARS} characters"
+
+def merge_items(task_type, per_chunk):
+    """Round-robin across chunks so every part of the document is represented; drop repeated terms/questions."""
+    field = 'term' if task_type == 'flashcard' else 'question'
+    seen, merged = set(), []
+    for row in itertools.zip_longest(*per_chunk):
+        for item in row:
+            if not isinstance(item, dict): continue
+            k = re.sub(r'\W+', ' ', str(item.get(field, ''))).strip().lower()
+            if k and k not in seen: seen.add(k); merged.append(item)
+    return merged[:LIST_LIMITS[task_type]] or None
+
+def map_reduce_content(file_path, task_type, refresh=False):
+    """Study Center artifact for a PDF too long for one prompt: per-chunk calls in parallel, then merge."""
+    chunks = pdf_chunks(file_path)
+    # The mind map is drawn from the summary's section summaries: regenerating it only redoes its own final call.
+    shared_refresh = refresh and task_type != 'mindmap'
+    outputs = map_chunks('summary' if task_type == 'mindmap' else task_type, chunks, shared_refresh)
+    err = next((o for o in outputs if is_ai_error(o)), None)
+    if err: return err # finished chunks are cached; a retry only redoes the rest
+    if task_type in LIST_LIMITS: return merge_items(task_type, [o for o in outputs if isinstance(o, list)])
+    text = condense([f"[Pages {a + 1}-{b + 1}]\n{o}" for (a, b, _), o in zip(chunks, outputs) if o], shared_refresh)
+    if not text or is_ai_error(text): return text
+    if task_type == 'mindmap': return cached_ai_call("reduce-mindmap", REDUCE_PROMPTS['mindmap'], text, extract_dot_from_text, refresh)
+    return cached_ai_call("reduce-summary", REDUCE_PROMPTS['summary'], text, refresh=refresh)
+
+def validate_ai_section(task_type, value):
+    """Normalised section value, or None if it is missing or malformed."""
+    if task_type == 'summary': return value.strip() if isinstance(value, str) and value.strip() else None
+    if task_type == 'mindmap': return extract_dot_from_text(value) if isinstance(value, str) else None
+    if not isinstance(value, list) or not value: return None
+    if not all(isinstance(i, dict) and all(k in i for k in SECTION_KEYS[task_type]) for i in value): return None
+    return value
+
+def generate_study_pack(file_path, force_vision=False, refresh=False):
+    """All Study Center artifacts from one model call; only sections that fail validation are retried one by one."""
+    results, keys = {}, {}
+    for t in STUDY_TASKS:
+        keys[t], use_vision = ai_artifact_key(file_path, t, force_vision)
+        cached = None if refresh else ai_cache.get(keys[t])
+        if cached is not None: results[t] = cached
+    missing = [t for t in STUDY_TASKS if t not in results]
+    if not use_vision and is_long_pdf(file_path):
+        # Too long for one prompt: each task map-reduces (the mind map reuses the cached section summaries)
+        return {t: results[t] if t in results else generate_ai_content(file_path, t, force_vision, refresh) for t in STUDY_TASKS}
+    if not refresh:
+        for _ in missing: ai_cache.miss()
+    if len(missing) > 1:
+        prompt = ("Create a complete study pack from the content. Return ONLY one JSON object with exactly these keys:\n{"
+                  + ",\n".join(PACK_SECTIONS[t] for t in missing) + "}")
+        if use_vision: raw_text = get_ai_response(prompt, file_path=file_path)
+        else: raw_text = get_ai_response(f"{prompt}\n\nContent:\n{pdf_text(file_path, max_chars=AI_SINGLE_PASS_CHARS)}")
+        if is_ai_error(raw_text): return {t: results.get(t, raw_text) for t in STUDY_TASKS} # quota/outage: per-task retries would fail too
+        pack = extract_json_from_text(raw_text)
+        for t in missing:
+            value = validate_ai_section(t, pack.get(t)) if isinstance(pack, dict) else None
+            if value is not None:
+                results[t] = value
+                ai_cache.put(keys[t], value, storage.file_hash(file_path), t, AI_MODEL, PROMPT_VERSION)
+    for t in STUDY_TASKS:
+        if t not in results: results[t] = generate_ai_content(file_path, t, force_vision, refresh=True)
+    return results
@@ -0,0 +1,164 @@
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from types import SimpleNamespace
+
+# --- MODEL BACKEND ---
+# Everything that talks to Gemini goes through load(), which returns either the real google.generativeai
+# module or FakeGenAI, an offline stand-in with the same surface (configure, GenerativeModel.generate_content
+# with or without stream=True, upload_file, get_file, list_models). Pick it with IITCONNECT_AI_BACKEND=fake to run the app, tests or
+# bench_ai.py without spending quota. The fake's behaviour is tuned through IITCONNECT_FAKE_* variables.
+
+BACKEND = os.environ.get("IITCONNECT_AI_BACKEND", "gemini")
+
+_loaded = {}
+_load_lock = threading.Lock()
+
+
+def load(name=None):
+    """The genai-compatible backend for `name` (default IITCONNECT_AI_BACKEND); one shared instance per name."""
+    name = name or BACKEND
+    with _load_lock:
+        if name not in _loaded:
+            if name == "fake": _loaded[name] = FakeGenAI.from_env()
+            elif name == "gemini":
+                import google.generativeai as genai
+                _loaded[name] = genai
+            else: raise ValueError(f"Unknown AI backend '{name}' (expected 'gemini' or 'fake')")
+        return _loaded[name]
+
+
+# Canned replies in the shapes the Study Center prompts ask for
+FAKE_MCQ = [{"question": f"Sample question {i}?", "options": ["Alpha", "Beta", "Gamma", "Delta"], "answer": "Beta", "hint": "Think it through."} for i in range(1, 6)]
+FAKE_FLASHCARDS = [{"term": f"Term {i}", "definition": f"Definition of term {i}."} for i in range(1, 9)]
+FAKE_SUBJECTIVE = [{"question": f"Explain concept {i}.", "model_answer": f"Concept {i} means ...", "hint": "Start from the definition."} for i in range(1, 6)]
+FAKE_SUMMARY = "\n".join(f"- Key point {i}: a short fact from the document." for i in range(1, 9))
+FAKE_DOT = 'digraph G {\n  "Topic" -> "Idea A";\n  "Topic" -> "Idea B";\n  "Idea A" -> "Detail 1";\n  "Idea B" -> "Detail 2";\n}'
+FAKE_VERDICT = "IS_RELEVANT: YES\nIS_LEGITIMATE: YES\nSUMMARY: Lecture notes covering the course topics."
+
+
+def canned_reply(prompt):
+    p = prompt.lower()
+    if "study pack" in p:
+        return json.dumps({'summary': FAKE_SUMMARY, 'mindmap': FAKE_DOT, 'flashcard': FAKE_FLASHCARDS, 'mcq': FAKE_MCQ, 'subjective': FAKE_SUBJECTIVE})
+    if "is_relevant" in p: return FAKE_VERDICT
+    if "mind map" in p: return FAKE_DOT
+    if "mcq" in p: return json.dumps(FAKE_MCQ)
+    if "flashcard" in p: return json.dumps(FAKE_FLASHCARDS)
+    if "descriptive questions" in p: return json.dumps(FAKE_SUBJECTIVE)
+    return FAKE_SUMMARY
+
+
+class FakeFile:
+    def __init__(self, name, ready_at, mime_type=None):
+        self.name, self.ready_at, self.mime_type = name, ready_at, mime_type
+        self.expiration_time = None
+
+    @property
+    def state(self):
+        return SimpleNamespace(name="ACTIVE" if time.monotonic() >= self.ready_at else "PROCESSING")
+
+
+class FakeStream:
+    """stream=True response: iterate for text chunks; .text is only available once the stream has been consumed."""
+    CHUNK_CHARS = 60
+    FIRST_CHUNK = 0.3 # share of the latency spent before the first chunk
+
+    def __init__(self, backend, text, tokens):
+        self.backend, self._text, self._done = backend, text, False
+        self.usage_metadata = SimpleNamespace(total_token_count=tokens)
+
+    def __iter__(self):
+        pieces = [self._text[i:i + self.CHUNK_CHARS] for i in range(0, len(self._text), self.CHUNK_CHARS)] or [""]
+        self.backend.sleep(self.FIRST_CHUNK)
+        for piece in pieces:
+            yield SimpleNamespace(text=piece)
+            self.backend.sleep((1 - self.FIRST_CHUNK) / len(pieces))
+        self._done = True
+
+    @property
+    def text(self):
+        if not self._done: raise RuntimeError("Please let the response complete iteration before accessing the final accumulated attributes")
+        return self._text
+
+
+class FakeModel:
+    def __init__(self, backend, model_name):
+        self.backend, self.model_name = backend, model_name
+
+    def generate_content(self, contents, stream=False):
+        b = self.backend
+        parts = contents if isinstance(contents, list) else [contents]
+        files = [p for p in parts if isinstance(p, FakeFile)]
+        prompt = "\n".join(p for p in parts if isinstance(p, str))
+        b.count('generate')
+        if not stream: b.sleep() # a stream spends its latency while being iterated
+        if b.rng_uniform() < b.rate_429:
+            b.count('429')
+            raise RuntimeError("429 Resource has been exhausted (e.g. check quota).")
+        for f in files:
+            if f.state.name != "ACTIVE": raise RuntimeError(f"400 The File {f.name} is not in an ACTIVE state and usage is not allowed.")
+        text = canned_reply(prompt)
+        tokens = len(prompt) // 4 + len(text) // 4 + 258 * len(files)
+        if stream: return FakeStream(b, text, tokens)
+        return SimpleNamespace(text=text, usage_metadata=SimpleNamespace(total_token_count=tokens))
+
+
+class FakeGenAI:
+    """Offline google.generativeai look-alike with configurable latency, 429 rate and file processing delay."""
+
+    def __init__(self, latency=0.8, jitter=0.3, rate_429=0.0, processing=0.0, seed=None):
+        self.latency, self.jitter, self.rate_429, self.processing = latency, jitter, rate_429, processing
+        self.files = {}
+        self.counters = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        env = os.environ.get
+        seed = env("IITCONNECT_FAKE_SEED")
+        return cls(latency=float(env("IITCONNECT_FAKE_LATENCY", "0.8")), jitter=float(env("IITCONNECT_FAKE_JITTER", "0.3")),
+                   rate_429=float(env("IITCONNECT_FAKE_429_RATE", "0")), processing=float(env("IITCONNECT_FAKE_PROCESSING", "0")),
+                   seed=int(seed) if seed else None)
+
+    def count(self, event):
+        with self._lock: self.counters[event] += 1
+
+    def rng_uniform(self):
+        with self._lock: return self._rng.random()
+
+    def sleep(self, scale=1.0):
+        with self._lock: delay = max(0.0, self._rng.gauss(self.latency, self.jitter * self.latency)) * scale
+        time.sleep(delay)
+
+    # --- genai surface ---
+    def configure(self, **kwargs): pass
+
+    def GenerativeModel(self, model_name):
+        return FakeModel(self, model_name)
+
+    def upload_file(self, path, mime_type=None, **kwargs):
+        if not os.path.exists(path): raise FileNotFoundError(path)
+        self.count('upload')
+        self.sleep(0.5)
+        f = FakeFile(f"files/{uuid.uuid4().hex[:12]}", time.monotonic() + self.processing, mime_type)
+        with self._lock: self.files[f.name] = f
+        return f
+
+    def get_file(self, name):
+        self.count('get_file')
+        with self._lock: f = self.files.get(name)
+        if f is None: raise RuntimeError(f"404 File {name} not found")
+        return f
+
+    def delete_file(self, name):
+        with self._lock: self.files.pop(name, None)
+
+    def list_models(self):
+        return [SimpleNamespace(name="models/fake-flash", supported_generation_methods=["generateContent"])]
+
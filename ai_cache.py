@@ -0,0 +1,93 @@
+import json
+import os
+import threading
+import time
+import db
+
+# --- AI ARTIFACT CACHE ---
+# Generated Study Center artifacts (summary, mindmap, flashcards, MCQs, subjective) persisted per
+# (document content hash, task type, model, prompt version, mode). 300 students opening the same PDF
+# pay for one Gemini call. Bounded by total payload size with least-recently-used eviction.
+# Lookups are plain reads: hit/miss counters and last_used touches are buffered in memory and written in
+# one transaction every FLUSH_SECONDS (or FLUSH_EVENTS); a restart can lose that much of the statistics.
+# A miss is counted only where generation starts, not for every empty Study Center tab.
+
+MAX_BYTES = int(os.environ.get("IITCONNECT_AI_CACHE_MB", "64")) * 1024 * 1024
+FLUSH_SECONDS = 30
+FLUSH_EVENTS = 50
+
+_pending = {} # event -> count not yet written
+_touched = {} # key -> (last_used, hits) not yet written
+_lock = threading.Lock()
+_flushed_at = time.monotonic()
+
+
+def cache_key(content_hash, task_type, model, prompt_version, mode="text"):
+    return f"{content_hash}:{task_type}:{model}:v{prompt_version}:{mode}"
+
+
+def _count(conn, event, n=1):
+    conn.execute("INSERT INTO ai_cache_stats (event, count) VALUES (?, ?) ON CONFLICT(event) DO UPDATE SET count = count + excluded.count", (event, n))
+
+
+def _record(event, key=None):
+    with _lock:
+        _pending[event] = _pending.get(event, 0) + 1
+        if key: _touched[key] = (db.now(), _touched.get(key, (0, 0))[1] + 1)
+        due = sum(_pending.values()) >= FLUSH_EVENTS or time.monotonic() - _flushed_at >= FLUSH_SECONDS
+    if due: flush()
+
+
+def _write_pending(conn):
+    global _flushed_at
+    with _lock:
+        pending, touched = dict(_pending), dict(_touched)
+        _pending.clear(); _touched.clear(); _flushed_at = time.monotonic()
+    for event, n in pending.items(): _count(conn, event, n)
+    conn.executemany("UPDATE ai_artifacts SET last_used = MAX(last_used, ?), hits = hits + ? WHERE key = ?",
+                     [(ts, n, k) for k, (ts, n) in touched.items()])
+
+
+def flush():
+    """Write buffered counters and last_used touches."""
+    with db.transaction() as conn: _write_pending(conn)
+
+
+def get(key):
+    """Cached payload for `key`, or None. Read-only; a hit is counted in the buffer."""
+    row = db.query_one("SELECT payload FROM ai_artifacts WHERE key = ?", (key,))
+    if not row: return None
+    _record("hit", key)
+    return json.loads(row[0])
+
+
+def miss():
+    """Count a lookup that is about to be answered by a model call."""
+    _record("miss")
+
+
+def put(key, payload, content_hash=None, task_type=None, model=None, prompt_version=None):
+    data = json.dumps(payload)
+    with db.transaction() as conn:
+        conn.execute("""INSERT OR REPLACE INTO ai_artifacts (key, content_hash, task_type, model, prompt_version, payload, size, created_at, last_used)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                     (key, content_hash, task_type, model, prompt_version, data, len(data), db.now(), db.now()))
+        _write_pending(conn) # recent touches first, so eviction sees them
+        evict(conn)
+
+
+def evict(conn, max_bytes=None):
+    """Drop least-recently-used artifacts until the total payload size fits in max_bytes."""
+    cur = conn.execute("""DELETE FROM ai_artifacts WHERE key IN (
+                              SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS running FROM ai_artifacts)
+                              WHERE running > ?)""", (max_bytes or MAX_BYTES,))
+    if cur.rowcount > 0: _count(conn, "eviction", cur.rowcount)
+
+
+def stats():
+    flush()
+    counts = {r['event']: r['count'] for r in db.query("SELECT event, count FROM ai_cache_stats")}
+    row = db.query_one("SELECT COUNT(*) AS entries, COALESCE(SUM(size), 0) AS bytes FROM ai_artifacts")
+    hits, misses = counts.get("hit", 0), counts.get("miss", 0)
+    return {'entries': row['entries'], 'bytes': row['bytes'], 'hits': hits, 'misses': misses,
+            'evictions': counts.get("eviction", 0), 'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
@@ -1,17 +1,20 @@
 import streamlit as st
 import os
 import sqlite3
+import db
+import storage
+import ai_cache
+import jobs
+import ratelimit
+import gemini_files
+import ai
+import similar
+import profiler
+import avatars
 import hashlib
-import json
-import time
-import re
 import pandas as pd
-import base64
-from collections import Counter
 from datetime import datetime
-from pypdf import PdfReader
 from streamlit_pdf_viewer import pdf_viewer
-import google.generativeai as genai
 import graphviz
 
 # --- 1. SETUP & CONFIGURATION ---
@@ -24,12 +27,10 @@ except FileNotFoundError:
     st.warning("⚠️ Secrets file not found. Please create .streamlit/secrets.toml")
     st.stop()
 
-genai.configure(api_key=GOOGLE_API_KEY)
-model = genai.GenerativeModel('gemini-2.5-flash-lite')
+ai.configure(GOOGLE_API_KEY)
 
 # CONSTANTS
-DB_NAME = "iitconnect_v52.db"
-UPLOAD_FOLDER = "uploaded_notes"
+UPLOAD_FOLDER = storage.UPLOAD_FOLDER
 if not os.path.exists(UPLOAD_FOLDER): os.makedirs(UPLOAD_FOLDER)
 
 # --- 2. ADVANCED INTERACTIVE CSS ---
@@ -165,440 +166,345 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- 3. DATABASE MANAGEMENT ---
+# All helpers borrow pooled connections from db.py (WAL + busy_timeout + lock retries).
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("PRAGMA foreign_keys = ON;")
-    c.execute('''CREATE TABLE IF NOT EXISTS notes (id INTEGER PRIMARY KEY, uploader TEXT, subject TEXT, title TEXT, filename TEXT, upvotes INTEGER, is_verified INTEGER, tags TEXT, timestamp DATETIME, content TEXT, post_type TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS comments (id INTEGER PRIMARY KEY, target_id INTEGER, target_type TEXT, parent_id INTEGER, user TEXT, comment TEXT, timestamp DATETIME)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS answers (id INTEGER PRIMARY KEY, doubt_id INTEGER, responder TEXT, answer_text TEXT, upvotes INTEGER, timestamp DATETIME)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT, posts_count INTEGER DEFAULT 0, answers_count INTEGER DEFAULT 0, upvotes_received INTEGER DEFAULT 0, reputation INTEGER DEFAULT 0, full_name TEXT, college TEXT, year TEXT, branch TEXT, age TEXT, gender TEXT, bio TEXT, profile_pic TEXT, is_active INTEGER DEFAULT 1)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS votes (user TEXT, item_id INTEGER, item_type TEXT, vote_type INTEGER, PRIMARY KEY (user, item_id, item_type))''')
-    c.execute('''CREATE TABLE IF NOT EXISTS bookmarks (user TEXT, note_id INTEGER, timestamp DATETIME, PRIMARY KEY (user, note_id))''')
-    c.execute('''CREATE TABLE IF NOT EXISTS notifications (id INTEGER PRIMARY KEY, user TEXT, message TEXT, is_read INTEGER DEFAULT 0, timestamp DATETIME)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS course_requests (id INTEGER PRIMARY KEY, user TEXT, course_name TEXT, reason TEXT, timestamp DATETIME)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS reports (id INTEGER PRIMARY KEY, reporter TEXT, post_id INTEGER, reason TEXT, details TEXT, status TEXT DEFAULT 'Pending', timestamp DATETIME)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS follows (follower TEXT, followee TEXT, timestamp DATETIME, PRIMARY KEY (follower, followee))''')
-    conn.commit(); conn.close()
+    # Versioned migrations (schema, epoch timestamps, indexes) live in db.py, keyed on PRAGMA user_version.
+    db.migrate()
+
+def format_ts(ts):
+    return datetime.fromtimestamp(ts).strftime("%d %b %Y, %H:%M") if isinstance(ts, (int, float)) else str(ts)
 
 # --- 4. AUTH & HELPERS ---
 def make_hash(password): return hashlib.sha256(str.encode(password)).hexdigest()
 def register_user(username, password, college):
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    try: c.execute("INSERT INTO users (username, password, college, is_active) VALUES (?, ?, ?, 1)", (username, make_hash(password), college)); conn.commit(); return True
-    except: return False
-    finally: conn.close()
+    try: db.execute("INSERT INTO users (username, password, college, is_active) VALUES (?, ?, ?, 1)", (username, make_hash(password), college)); return True
+    except sqlite3.IntegrityError: return False
 def login_user(username, password):
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE username = ? AND password = ?", (username, make_hash(password)))
-    data = c.fetchone()
-    if data and data[14] == 0: c.execute("UPDATE users SET is_active = 1 WHERE username = ?", (username,)); conn.commit(); st.toast("Welcome back! Account Reactivated 🚀")
-    conn.close(); return data
+    data = db.query_one("SELECT username, is_active FROM users WHERE username = ? AND password = ?", (username, make_hash(password)))
+    if data and data['is_active'] == 0: db.execute("UPDATE users SET is_active = 1 WHERE username = ?", (username,)); st.toast("Welcome back! Account Reactivated 🚀")
+    return data
 
 # --- STATS, BADGES & PROFILE ---
 def get_user_badge(reputation):
-    if reputation > 500: return "🟣 Professor"
-    elif reputation > 200: return "🟡 Scholar"
-    elif reputation > 50: return "🔵 Contributor"
-    return "⚪ Fresher"
+    return db.badge_for(reputation)
 
 def get_user_stats_detailed(username):
-    conn = sqlite3.connect(DB_NAME); conn.row_factory = sqlite3.Row; c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE username = ?", (username,)); user_data = c.fetchone()
-    if not user_data: return None, 0, 0, 0, 0
-    c.execute("SELECT COUNT(*) FROM notes WHERE uploader = ? AND post_type = 'DOUBT'", (username,)); doubts = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM notes WHERE uploader = ? AND post_type = 'RESOURCE'", (username,)); notes = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM follows WHERE followee = ?", (username,)); followers = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM follows WHERE follower = ?", (username,)); following = c.fetchone()[0]
-    conn.close(); return user_data, doubts, notes, followers, following
-
-def update_reputation(username):
-    if username == "Anonymous": return
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    c.execute("SELECT posts_count, answers_count, upvotes_received FROM users WHERE username=?", (username,))
-    res = c.fetchone()
-    if res:
-        new_rep = (res[2] * 2) + (res[0] * 5) + (res[1] * 3)
-        c.execute("UPDATE users SET reputation = ? WHERE username = ?", (new_rep, username))
-        conn.commit()
-    conn.close()
-
-def update_user_profile(username, full_name, year, branch, age, gender, bio, pic_data):
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    c.execute("UPDATE users SET full_name=?, year=?, branch=?, age=?, gender=?, bio=?, profile_pic=? WHERE username=?", 
-              (full_name, year, branch, age, gender, bio, pic_data, username))
-    conn.commit(); conn.close()
+    return db.user_stats(username)
+
+def update_user_profile(username, full_name, year, branch, age, gender, bio, avatar):
+    db.execute("UPDATE users SET full_name=?, year=?, branch=?, age=?, gender=?, bio=?, avatar=? WHERE username=?", 
+               (full_name, year, branch, age, gender, bio, avatar, username))
 
 def change_username(old_user, new_user):
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
     try:
-        tables = ["users", "notes", "answers", "comments", "votes", "bookmarks", "notifications", "course_requests", "reports", "follows"]
-        c.execute("UPDATE users SET username = ? WHERE username = ?", (new_user, old_user))
-        c.execute("UPDATE notes SET uploader = ? WHERE uploader = ?", (new_user, old_user))
-        c.execute("UPDATE answers SET responder = ? WHERE responder = ?", (new_user, old_user))
-        c.execute("UPDATE comments SET user = ? WHERE user = ?", (new_user, old_user))
-        c.execute("UPDATE votes SET user = ? WHERE user = ?", (new_user, old_user))
-        c.execute("UPDATE bookmarks SET user = ? WHERE user = ?", (new_user, old_user))
-        c.execute("UPDATE notifications SET user = ? WHERE user = ?", (new_user, old_user))
-        c.execute("UPDATE follows SET follower = ? WHERE follower = ?", (new_user, old_user))
-        c.execute("UPDATE follows SET followee = ? WHERE followee = ?", (new_user, old_user))
-        conn.commit(); return True
-    except: return False
-    finally: conn.close()
+        with db.transaction() as conn:
+            c = conn.cursor()
+            c.execute("UPDATE users SET username = ? WHERE username = ?", (new_user, old_user))
+            c.execute("UPDATE notes SET uploader = ? WHERE uploader = ?", (new_user, old_user))
+            c.execute("UPDATE answers SET responder = ? WHERE responder = ?", (new_user, old_user))
+            c.execute("UPDATE comments SET user = ? WHERE user = ?", (new_user, old_user))
+            c.execute("UPDATE votes SET user = ? WHERE user = ?", (new_user, old_user))
+            c.execute("UPDATE bookmarks SET user = ? WHERE user = ?", (new_user, old_user))
+            c.execute("UPDATE notifications SET user = ? WHERE user = ?", (new_user, old_user))
+            c.execute("UPDATE follows SET follower = ? WHERE follower = ?", (new_user, old_user))
+            c.execute("UPDATE follows SET followee = ? WHERE followee = ?", (new_user, old_user))
+            c.execute("UPDATE broadcasts SET author = ? WHERE author = ?", (new_user, old_user))
+            c.execute("UPDATE notification_cursor SET user = ? WHERE user = ?", (new_user, old_user))
+        return True
+    except sqlite3.Error: return False
 
 def delete_account(username):
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    c.execute("DELETE FROM users WHERE username = ?", (username,))
-    c.execute("DELETE FROM notes WHERE uploader = ?", (username,))
-    c.execute("DELETE FROM answers WHERE responder = ?", (username,))
-    c.execute("DELETE FROM comments WHERE user = ?", (username,))
-    c.execute("DELETE FROM votes WHERE user = ?", (username,))
-    c.execute("DELETE FROM follows WHERE follower = ? OR followee = ?", (username, username))
-    conn.commit(); conn.close()
+    with db.transaction() as conn:
+        c = conn.cursor()
+        # Votes go first, while the items they point at still exist: the counters of other users' items and authors are corrected.
+        db.drop_voter_votes(conn, username)
+        doubts = [r[0] for r in c.execute("SELECT id FROM notes WHERE uploader = ? AND post_type = 'DOUBT'", (username,)).fetchall()]
+        answered = [r[0] for r in c.execute("SELECT DISTINCT doubt_id FROM answers WHERE responder = ?", (username,)).fetchall()]
+        db.drop_item_votes(conn, "NOTE", [r[0] for r in c.execute("SELECT id FROM notes WHERE uploader = ?", (username,)).fetchall()])
+        db.drop_item_votes(conn, "ANSWER", [r[0] for r in c.execute("SELECT id FROM answers WHERE responder = ?", (username,)).fetchall()])
+        c.execute("DELETE FROM users WHERE username = ?", (username,))
+        c.execute("DELETE FROM notes WHERE uploader = ?", (username,))
+        c.execute("DELETE FROM answers WHERE responder = ?", (username,))
+        c.execute("DELETE FROM comments WHERE user = ?", (username,))
+        c.execute("DELETE FROM follows WHERE follower = ? OR followee = ?", (username, username))
+    similar.remove(doubts)
+    for doubt_id in set(answered) - set(doubts): similar.refresh(doubt_id) # their top answer may have been this user's
 
 def deactivate_account(username):
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    c.execute("UPDATE users SET is_active = 0 WHERE username = ?", (username,)); conn.commit(); conn.close()
+    db.execute("UPDATE users SET is_active = 0 WHERE username = ?", (username,))
 
 # --- SOCIAL: FOLLOW SYSTEM ---
 def follow_user(follower, followee):
     if follower == followee: return
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    try:
-        c.execute("INSERT INTO follows (follower, followee, timestamp) VALUES (?, ?, ?)", (follower, followee, datetime.now()))
-        conn.commit()
-    except: pass 
-    finally: conn.close()
+    try: db.execute("INSERT INTO follows (follower, followee, timestamp) VALUES (?, ?, ?)", (follower, followee, db.now()))
+    except sqlite3.IntegrityError: pass
     add_notification(followee, f"{follower} started following you!")
 
 def unfollow_user(follower, followee):
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    c.execute("DELETE FROM follows WHERE follower=? AND followee=?", (follower, followee))
-    conn.commit(); conn.close()
+    db.execute("DELETE FROM follows WHERE follower=? AND followee=?", (follower, followee))
 
 def is_following(follower, followee):
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    c.execute("SELECT 1 FROM follows WHERE follower=? AND followee=?", (follower, followee))
-    res = c.fetchone()
-    conn.close()
-    return res is not None
+    return db.query_one("SELECT 1 FROM follows WHERE follower=? AND followee=?", (follower, followee)) is not None
 
 def get_followers_list(username):
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    c.execute("SELECT follower FROM follows WHERE followee=?", (username,))
-    res = [row[0] for row in c.fetchall()]
-    conn.close(); return res
+    return [row[0] for row in db.query("SELECT follower FROM follows WHERE followee=?", (username,))]
 
 # --- NOTIFICATIONS, BOOKMARKS & REPORTS ---
-def add_notification(target_user, message):
-    if target_user == st.session_state.user or target_user == "Anonymous": return
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    c.execute("INSERT INTO notifications (user, message, timestamp) VALUES (?, ?, ?)", (target_user, message, datetime.now()))
-    conn.commit(); conn.close()
+def add_notification(target_user, message, actor=None):
+    # actor defaults to the session user; background jobs (no session) pass it explicitly
+    if target_user == (actor or st.session_state.user) or target_user == "Anonymous": return
+    db.execute("INSERT INTO notifications (user, message, timestamp) VALUES (?, ?, ?)", (target_user, message, db.now()))
 
 def get_unread_notifications(user):
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM notifications WHERE user=? AND is_read=0", (user,))
-    count = c.fetchone()[0]
-    c.execute("SELECT * FROM notifications WHERE user=? ORDER BY timestamp DESC LIMIT 10", (user,))
-    notes = c.fetchall(); conn.close(); return count, notes
+    return db.unread_notifications(user)
 
 def mark_notifications_read(user):
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    c.execute("UPDATE notifications SET is_read=1 WHERE user=?", (user,)); conn.commit(); conn.close()
+    db.mark_notifications_read(user)
 
 def toggle_bookmark(note_id):
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    c.execute("SELECT * FROM bookmarks WHERE user=? AND note_id=?", (st.session_state.user, note_id))
-    if c.fetchone():
-        c.execute("DELETE FROM bookmarks WHERE user=? AND note_id=?", (st.session_state.user, note_id))
-        msg = "Removed"
-        icon = "🗑️"
-    else:
-        c.execute("INSERT INTO bookmarks VALUES (?, ?, ?)", (st.session_state.user, note_id, datetime.now()))
-        msg = "Saved"
-        icon = "💾"
-    conn.commit(); conn.close(); st.toast(f"{icon} Bookmark {msg}!"); st.rerun()
+    with db.transaction() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM bookmarks WHERE user=? AND note_id=?", (st.session_state.user, note_id))
+        if c.fetchone():
+            c.execute("DELETE FROM bookmarks WHERE user=? AND note_id=?", (st.session_state.user, note_id))
+            msg = "Removed"
+            icon = "🗑️"
+        else:
+            c.execute("INSERT INTO bookmarks VALUES (?, ?, ?)", (st.session_state.user, note_id, db.now()))
+            msg = "Saved"
+            icon = "💾"
+    st.toast(f"{icon} Bookmark {msg}!"); st.rerun()
 
 def submit_course_request(user, course_name, reason):
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    c.execute("INSERT INTO course_requests (user, course_name, reason, timestamp) VALUES (?, ?, ?, ?)", (user, course_name, reason, datetime.now()))
-    conn.commit(); conn.close()
+    db.execute("INSERT INTO course_requests (user, course_name, reason, timestamp) VALUES (?, ?, ?, ?)", (user, course_name, reason, db.now()))
 
 def submit_report(post_id, reporter, reason, details):
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    c.execute("INSERT INTO reports (reporter, post_id, reason, details, timestamp) VALUES (?, ?, ?, ?, ?)", (reporter, post_id, reason, details, datetime.now()))
-    conn.commit(); conn.close()
+    db.execute("INSERT INTO reports (reporter, post_id, reason, details, timestamp) VALUES (?, ?, ?, ?, ?)", (reporter, post_id, reason, details, db.now()))
 
 # --- 5. CRUD ---
 def delete_item(table, item_id):
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    user = None # ✅ Initialize to prevent UnboundLocalError
-
-    if table == "notes":
-        c.execute("SELECT uploader FROM notes WHERE id=?", (item_id,))
-        res = c.fetchone()
-        if res:
-            user = res[0]
-            c.execute("DELETE FROM notes WHERE id=?", (item_id,))
-            if user != "Anonymous": c.execute("UPDATE users SET posts_count = posts_count - 1 WHERE username=?", (user,))
-    
-    elif table == "answers":
-        c.execute("SELECT responder FROM answers WHERE id=?", (item_id,))
-        res = c.fetchone()
-        if res:
-            user = res[0]
-            c.execute("DELETE FROM answers WHERE id=?", (item_id,))
-            if user != "Anonymous": c.execute("UPDATE users SET answers_count = answers_count - 1 WHERE username=?", (user,))
-    
-    else: 
-        # For comments or other items
-        c.execute(f"DELETE FROM {table} WHERE id=?", (item_id,))
-        user = st.session_state.user # ✅ Set user to current user for comments
-    
-    conn.commit(); conn.close()
-    
-    # Safe check now that user is guaranteed to be defined
-    if user and user != "Anonymous": 
-        update_reputation(user if table in ['notes', 'answers'] else st.session_state.user)
+    # Reputation deltas are applied inside the same transaction as the delete.
+    with db.transaction() as conn:
+        c = conn.cursor()
+        if table == "notes":
+            c.execute("SELECT uploader FROM notes WHERE id=?", (item_id,))
+            res = c.fetchone()
+            if res:
+                user = res[0]
+                db.drop_item_votes(conn, "NOTE", [item_id])
+                c.execute("DELETE FROM notes WHERE id=?", (item_id,))
+                db.adjust_reputation(conn, user, posts=-1)
+        
+        elif table == "answers":
+            c.execute("SELECT responder, doubt_id FROM answers WHERE id=?", (item_id,))
+            res = c.fetchone()
+            if res:
+                user = res[0]
+                db.drop_item_votes(conn, "ANSWER", [item_id])
+                c.execute("DELETE FROM answers WHERE id=?", (item_id,))
+                db.adjust_reputation(conn, user, answers=-1)
+        
+        else: 
+            # For comments or other items (no reputation impact)
+            c.execute(f"DELETE FROM {table} WHERE id=?", (item_id,))
+    if table == "notes": similar.refresh(item_id)
+    elif table == "answers" and res: similar.refresh(res[1]) # its top answer may have changed
         
     st.toast(f"🗑️ {table[:-1].title()} Deleted"); st.rerun()
 
 def edit_item(table, item_id, new_text, column="content"):
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    c.execute(f"UPDATE {table} SET {column}=? WHERE id=?", (new_text, item_id)); conn.commit(); conn.close(); st.toast("✅ Updated successfully!"); st.rerun()
-
-def update_post(note_id, new_title, new_content):
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    c.execute("UPDATE notes SET title=?, content=? WHERE id=?", (new_title, new_content, note_id)); conn.commit(); conn.close(); st.toast("✅ Post Updated!"); st.rerun()
+    db.execute(f"UPDATE {table} SET {column}=? WHERE id=?", (new_text, item_id)); st.toast("✅ Updated successfully!"); st.rerun()
+
+def update_post(note_id, new_title, new_content, new_tags=None):
+    with db.transaction() as conn:
+        old = conn.execute("SELECT tags, timestamp FROM notes WHERE id=?", (note_id,)).fetchone()
+        if not old: return
+        if new_tags is None: new_tags = old['tags']
+        conn.execute("UPDATE notes SET title=?, content=?, tags=? WHERE id=?", (new_title, new_content, new_tags, note_id))
+        db.set_note_tags(conn, note_id, new_tags, old['timestamp'])
+    similar.refresh(note_id)
+    st.toast("✅ Post Updated!"); st.rerun()
 
 def handle_vote(item_id, item_type, voter, direction):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    table = "notes" if item_type == "NOTE" else "answers"
-
-    # 1. CHECK EXISTING VOTE
-    c.execute("SELECT vote_type FROM votes WHERE user=? AND item_id=? AND item_type=?", (voter, item_id, item_type))
-    existing = c.fetchone()
-    
-    change_for_author = 0 # To update the author's reputation later
-
-    # 2. UPDATE VOTES TABLE (Logic: New vs Toggle vs Switch)
-    if not existing:
-        # Case A: New Vote
-        c.execute("INSERT INTO votes VALUES (?, ?, ?, ?)", (voter, item_id, item_type, direction))
-        change_for_author = direction
-    elif existing[0] == direction:
-        # Case B: Toggle Off (e.g., Click Up again -> Remove Upvote)
-        c.execute("DELETE FROM votes WHERE user=? AND item_id=? AND item_type=?", (voter, item_id, item_type))
-        change_for_author = -direction
-    else:
-        # Case C: Switch (e.g., Change Up to Down)
-        c.execute("UPDATE votes SET vote_type=? WHERE user=? AND item_id=? AND item_type=?", (direction, voter, item_id, item_type))
-        change_for_author = 2 * direction
-
-    # 3. CRITICAL FIX: RECALCULATE TOTAL
-    # Instead of doing "upvotes + 1", we count the actual rows. This fixes your "-2" glitch.
-    c.execute("SELECT COALESCE(SUM(vote_type), 0) FROM votes WHERE item_id=? AND item_type=?", (item_id, item_type))
-    real_total = c.fetchone()[0]
-    
-    # Update the note with the real count
-    c.execute(f"UPDATE {table} SET upvotes = ? WHERE id = ?", (real_total, item_id))
-
-    # 4. UPDATE AUTHOR STATS
-    c.execute(f"SELECT {'uploader' if item_type=='NOTE' else 'responder'} FROM {table} WHERE id = ?", (item_id,))
-    author_res = c.fetchone()
-    
-    if author_res:
-        author = author_res[0]
-        if author != "Anonymous":
-            c.execute("UPDATE users SET upvotes_received = upvotes_received + ? WHERE username = ?", (change_for_author, author))
-            conn.commit() # Save changes before updating reputation
-            update_reputation(author)
-    
-    conn.commit()
-    conn.close()
-
-def add_note(uploader, subject, title, filename, tags, verified, content="", post_type="RESOURCE"):
-    # 1. Open connection for the NOTE
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
-    success = False
+    # One transaction: upsert the vote, then apply the delta to the item's counter and the author's stats.
+    db.apply_vote(item_id, item_type, voter, direction)
+
+def add_note(uploader, subject, title, filename, tags, verified, content="", post_type="RESOURCE", original_name=None):
+    note_id = None
+    # Parse the PDF before taking the write lock; the text feeds the full-text index.
+    pdf_text = None
+    if filename and filename.lower().endswith(".pdf") and os.path.exists(os.path.join(UPLOAD_FOLDER, filename)):
+        pdf_text = get_pdf_text(os.path.join(UPLOAD_FOLDER, filename))
     try:
-        # Insert the note
-        c.execute("INSERT INTO notes VALUES (NULL, ?, ?, ?, ?, 0, ?, ?, ?, ?, ?)", 
-                  (uploader, subject, title, filename, 1 if verified else 0, tags, datetime.now(), content, post_type))
-        
-        # Update user stats
-        if uploader != "Anonymous":
-            c.execute("UPDATE users SET posts_count = posts_count + 1 WHERE username = ?", (uploader,))
-        
-        # 2. COMMIT AND CLOSE IMMEDIATELY
-        conn.commit()
-        success = True
-    except Exception as e:
-        st.error(f"Database error: {e}")
-    finally:
-        conn.close()
-
-    # 3. SAFETY PAUSE (Critical for Windows)
-    # Give the OS time to release the file lock
-    if success:
-        time.sleep(0.1) 
-
-    # 4. Handle Notifications (New Connections)
-    if success and uploader != "Anonymous":
-        try:
-            followers = get_followers_list(uploader)
-            for f in followers:
-                add_notification(f, f"{uploader} posted a new {post_type.lower()}: {title}")
+        with db.transaction() as conn:
+            c = conn.cursor()
+            # Insert the note
+            ts = db.now()
+            c.execute("""INSERT INTO notes (uploader, subject, title, filename, upvotes, is_verified, tags, timestamp, content, post_type, original_name)
+                         VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?, ?, ?)""", 
+                      (uploader, subject, title, filename, 1 if verified else 0, tags, ts, content, post_type, original_name))
+            note_id = c.lastrowid
+            if pdf_text: db.set_note_text(note_id, pdf_text, conn)
+            db.set_note_tags(conn, note_id, tags, ts)
             
-            update_reputation(uploader)
-        except Exception as e:
-            print(f"Notification error (non-critical): {e}")
+            # Update user stats/reputation & notify followers (one set-based insert, same transaction)
+            if uploader != "Anonymous":
+                db.adjust_reputation(conn, uploader, posts=1)
+                db.fan_out_post(conn, uploader, note_id, f"{uploader} posted a new {post_type.lower()}: {title}", ts)
+    except Exception as e:
+        st.error(f"Database error: {e}"); note_id = None
+    if note_id and post_type == "DOUBT": similar.refresh(note_id)
+    return note_id
+
 def add_answer(doubt_id, user, text, original_uploader):
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    c.execute("INSERT INTO answers VALUES (NULL, ?, ?, ?, 0, ?)", (doubt_id, user, text, datetime.now()))
-    if user != "Anonymous" and user != "🤖 AI Tutor": c.execute("UPDATE users SET answers_count = answers_count + 1 WHERE username = ?", (user,))
-    conn.commit(); conn.close(); 
-    if user != "Anonymous" and user != "🤖 AI Tutor": update_reputation(user)
-    add_notification(original_uploader, f"{user} answered your doubt!")
+    with db.transaction() as conn:
+        conn.execute("INSERT INTO answers VALUES (NULL, ?, ?, ?, 0, ?)", (doubt_id, user, text, db.now()))
+        if user != "🤖 AI Tutor": db.adjust_reputation(conn, user, answers=1)
+    similar.refresh(doubt_id)
+    add_notification(original_uploader, f"{user} answered your doubt!", actor=user)
 
 def add_comment(target_id, target_type, user, text, parent_id=None, item_owner=None):
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    c.execute("INSERT INTO comments VALUES (NULL, ?, ?, ?, ?, ?, ?)", (target_id, target_type, parent_id, user, text, datetime.now())); conn.commit(); conn.close()
+    db.execute("INSERT INTO comments VALUES (NULL, ?, ?, ?, ?, ?, ?)", (target_id, target_type, parent_id, user, text, db.now()))
     if item_owner: add_notification(item_owner, f"{user} commented on your {target_type.lower()}.")
 
 def get_data(query, params=()):
-    conn = sqlite3.connect(DB_NAME); conn.row_factory = sqlite3.Row; c = conn.cursor()
-    c.execute(query, params); return c.fetchall()
+    return db.query(query, params)
 
 def search_notes(search_term, subject_filter=None, type_filter=None):
-    conn = sqlite3.connect(DB_NAME); conn.row_factory = sqlite3.Row; c = conn.cursor()
-    base = "SELECT * FROM notes WHERE (title LIKE ? OR tags LIKE ?)"
-    params = [f"%{search_term}%", f"%{search_term}%"]
-    if subject_filter: base += " AND subject = ?"; params.append(subject_filter)
-    if type_filter: base += " AND post_type = ?"; params.append(type_filter)
-    base += " ORDER BY timestamp DESC"
-    c.execute(base, params); return c.fetchall()
-
-def get_pdf_text(pdf_path):
-    text = ""; 
-    try: 
-        reader = PdfReader(pdf_path); 
-        for page in reader.pages: text += page.extract_text() or ""
-    except: pass
-    return text
-
-# --- 6. AI LOGIC (ROBUST RETRY + CORRECTED MODEL) ---
-def get_ai_response(prompt, file_path=None):
-    if GOOGLE_API_KEY == "PASTE_YOUR_API_KEY_HERE": return "Error: API Key missing. Please config."
-    
-    # FIXED: Changed from non-existent 2.5-flash to 1.5-flash
-    model_name = "gemini-2.5-flash"
-    max_retries = 3
-    base_delay = 10
-    
-    time.sleep(1) # Prevent burst clicks
-
-    for attempt in range(max_retries):
-        try:
-            model = genai.GenerativeModel(model_name)
-            if file_path:
-                try:
-                    mime_type = 'application/pdf'
-                    if file_path.lower().endswith(('.png', '.jpg', '.jpeg')):
-                        mime_type = 'image/jpeg'
-                        
-                    uploaded = genai.upload_file(file_path, mime_type=mime_type)
-                    wait_count = 0
-                    while uploaded.state.name == "PROCESSING": 
-                        time.sleep(1)
-                        uploaded = genai.get_file(uploaded.name)
-                        wait_count += 1
-                        if wait_count > 30: break 
-                    
-                    response = model.generate_content([uploaded, prompt])
-                except Exception as inner_e:
-                    # Fallback text extraction if vision upload/processing fails
-                    if file_path.lower().endswith('.pdf'):
-                        text = get_pdf_text(file_path)
-                        if not text: raise ValueError("Empty PDF text")
-                        response = model.generate_content(f"{prompt}\n\nContext:\n{text[:15000]}")
-                    else: 
-                        raise inner_e
-            else:
-                response = model.generate_content(prompt)
-            
-            return response.text
-
-        except Exception as e:
-            error_msg = str(e)
-            print(f"Attempt {attempt+1} failed: {error_msg}")
-            # Handle Quota/Rate Limits (429) or Server Overload (503)
-            if "429" in error_msg or "quota" in error_msg.lower() or "resource" in error_msg.lower():
-                if attempt < max_retries - 1:
-                    wait_time = base_delay * (2**attempt)
-                    st.toast(f"⏳ High Traffic: Retrying in {wait_time}s...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    return "⚠️ System Busy: API Quota exceeded. Please wait 1 minute."
-            
-            return f"AI Failed. Error: {error_msg}"
-
-def extract_json_from_text(text):
-    if not text: return None
-    try:
-        match = re.search(r'(\[.*\]|\{.*\})', text, re.DOTALL)
-        if match: return json.loads(match.group(1))
-    except: pass
-    return None
-
-def extract_dot_from_text(text):
-    if not text: return None
-    try:
-        match = re.search(r'(digraph\s+.*\}|graph\s+.*\})', text, re.DOTALL)
-        if match: return match.group(1)
-        if "digraph" in text: return text
-    except: pass
+    # FTS5 over title, tags, doubt content and PDF text; BM25-ranked with a highlighted snippet column.
+    return db.search_notes(search_term, subject_filter, type_filter)
+
+def reindex_pdf_text():
+    """Backfill note_text (and so the search index) for uploaded PDFs that have not been extracted yet."""
+    missing = db.query("SELECT id, filename FROM notes WHERE filename LIKE '%.pdf' AND id NOT IN (SELECT note_id FROM note_text)")
+    for n in missing:
+        fpath = os.path.join(UPLOAD_FOLDER, n['filename'])
+        if os.path.exists(fpath): db.set_note_text(n['id'], get_pdf_text(fpath))
+    return len(missing)
+
+def get_pdf_text(pdf_path, max_chars=None):
+    # Page text is extracted once per file content (storage.py) and streamed back from the DB.
+    try: return storage.get_pdf_text(pdf_path, max_chars)
+    except Exception: return ""
+
+def ai_job_state(slot):
+    """This session's live Study Center job for `slot` (a task type or 'pack'), or None. Finished jobs are forgotten here."""
+    pending = st.session_state.setdefault('ai_jobs', {})
+    if slot not in pending: return None
+    job = db.query_one("SELECT id, status, error FROM ai_jobs WHERE id=?", (pending[slot],))
+    if job and job['status'] in ('queued', 'running'): return job
+    del pending[slot]
+    st.session_state.ai_outputs.pop(slot, None) # done: re-read the artifact cache
+    if job and job['status'] == 'dead': st.session_state.ai_outputs[slot] = f"AI Failed. Error: {job['error']}"
     return None
 
-def generate_ai_content(file_path, task_type, force_vision=False):
-    prompts = {
-        'mcq': 'Create 5 MCQs based on the content. Return ONLY a JSON array: [{"question":"...","options":["A","B","C","D"],"answer":"Exact Text","hint":"..."}]',
-        'subjective': 'Create 5 short descriptive questions. Return ONLY a JSON array: [{"question":"...","model_answer":"...","hint":"..."}]',
-        'flashcard': 'Create 8 flashcards. Return ONLY a JSON array: [{"term":"...","definition":"..."}]',
-        'summary': "Summarize in bullets. Return text.",
-        'mindmap': 'Create a hierarchical mind map. Return ONLY valid Graphviz DOT syntax starting with "digraph G {". Use simple labels.'
-    }
-    
-    extracted_text = get_pdf_text(file_path)
-    use_vision = force_vision or len(extracted_text.strip()) < 50
-    
-    if use_vision:
-        raw_text = get_ai_response(prompts[task_type], file_path=file_path)
-    else:
-        raw_text = get_ai_response(f"{prompts[task_type]}\n\nContent:\n{extracted_text[:12000]}")
-    
-    if raw_text and (raw_text.startswith("AI Failed") or raw_text.startswith("⚠️ System Busy")): return raw_text 
-
-    if task_type == 'summary': return raw_text
-    if task_type == 'mindmap': return extract_dot_from_text(raw_text)
-    
-    return extract_json_from_text(raw_text)
+def show_ai_job(slot):
+    job = ai_job_state(slot) or (slot != 'pack' and ai_job_state('pack'))
+    if not job: return False
+    live_ai_job(job['id'], slot)
+    return True
+
+AI_POLL_SECONDS = 1
+
+@st.fragment(run_every=AI_POLL_SECONDS)
+def live_ai_job(job_id, slot):
+    """Re-polled on its own, without rerunning the page: queue position, then the reply as it streams in.
+    Once the job has finished the whole page reruns and shows the stored result."""
+    with profiler.fragment(st.session_state.nav, "live_ai_job"): render_live_ai_job(job_id, slot)
+
+def render_live_ai_job(job_id, slot):
+    job = db.query_one("SELECT status, progress FROM ai_jobs WHERE id=?", (job_id,))
+    if not job or job['status'] not in ('queued', 'running'): st.rerun()
+    pos = jobs.queue_position(job_id)
+    if pos: st.info(f"⏳ Queued (#{pos} in line)...")
+    elif not job['progress']: st.info("🤖 Generating in the background...")
+    elif slot in ('summary', 'doubt'): st.markdown(job['progress'] + " ▌")
+    elif slot in ITEM_RENDERERS:
+        items = ai.partial_json_items(job['progress'])
+        if items: ITEM_RENDERERS[slot](items, key="live")
+        st.caption(f"✍️ Writing... {len(items)} so far")
+    else: st.info("🤖 Generating in the background...")
+
+def queue_ai_output(file_path, task_type, force_vision=False, refresh=False):
+    # Runs on the AI worker pool; the tab polls the job, then reads the result from the artifact cache.
+    key = ai.ai_artifact_key(file_path, task_type, force_vision)[0]
+    payload = {'file_path': file_path, 'task': task_type, 'force_vision': force_vision, 'refresh': refresh}
+    st.session_state.ai_jobs[task_type] = jobs.enqueue("study_pack" if task_type == 'pack' else "study", payload, dedupe_key=f"study:{key}", priority=jobs.PRIORITY_INTERACTIVE)
+    st.rerun()
+
+def get_ai_output(file_path, task_type, force_vision=False):
+    """Study Center tab data: this session's result, else a persisted artifact (no model call), else None."""
+    if ai_job_state(task_type): return st.session_state.ai_outputs.get(task_type) # keep showing the old result while regenerating
+    data = st.session_state.ai_outputs.get(task_type)
+    if data is None:
+        cached = ai_cache.get(ai.ai_artifact_key(file_path, task_type, force_vision)[0])
+        if cached is not None: data = st.session_state.ai_outputs[task_type] = cached
+    return data
+
+# --- 6c. BACKGROUND AI JOBS (run on jobs.py worker threads: no st.* UI in here) ---
+@jobs.handler("doubt_answer")
+def run_doubt_answer(p):
+    if not db.query_one("SELECT 1 FROM notes WHERE id=?", (p['doubt_id'],)): return "skipped: doubt deleted"
+    # Auto-answers yield to interactive Study Center calls in the shared limiter
+    reply = ai.get_ai_response(p['prompt'], file_path=p.get('file_path'), priority=ratelimit.BACKGROUND, on_text=jobs.report)
+    ai.check_ai_result(reply)
+    if not jobs.owned(): return "skipped: lease lost" # another worker has taken the job over and will answer
+    add_answer(p['doubt_id'], "🤖 AI Tutor", reply, p['uploader'])
+
+@jobs.handler("study")
+def run_study_task(p):
+    result = ai.generate_ai_content(p['file_path'], p['task'], p['force_vision'], refresh=p['refresh'], on_text=jobs.report)
+    ai.check_ai_result(result, "Could not parse AI output")
+
+@jobs.handler("study_pack")
+def run_study_pack(p):
+    results = ai.generate_study_pack(p['file_path'], p['force_vision'], refresh=p['refresh'])
+    failed = [t for t, v in results.items() if not v or ai.is_ai_error(v)]
+    busy = next((results[t] for t in failed if isinstance(results[t], str) and results[t].startswith(ai.AI_QUEUE_FULL)), None)
+    if busy: raise ai.AIBusy(busy) # a full queue defers the whole pack without spending an attempt
+    if failed: # retry re-asks only for the uncached ones
+        raise RuntimeError("Sections failed: " + "; ".join(f"{t} ({results[t] or 'empty reply'})" for t in failed))
 
 def verify_content_with_ai(text, subject):
     if not text or len(text.strip()) < 50: return True, "Scanned (Image/Short)"
     return True, "Allowed"
 
 # --- 7. UI RENDERERS ---
-def render_comments(target_id, target_type, parent_id=None, level=0):
-    query = f"SELECT * FROM comments WHERE target_id=? AND target_type=? AND parent_id {'IS NULL' if parent_id is None else '=?'} ORDER BY timestamp ASC"
-    params = (target_id, target_type) if parent_id is None else (target_id, target_type, parent_id)
-    comments = get_data(query, params)
-    for com in comments:
+def render_flashcards(cards, key="fc"):
+    c1, c2 = st.columns(2)
+    for i, c in enumerate(cards):
+        with (c1 if i%2==0 else c2):
+            with st.container(border=True):
+                # Fix for KeyError: Use .get()
+                term = c.get('term', 'Unknown')
+                definition = c.get('definition', '...')
+                st.markdown(f"### {term}")
+                with st.expander("Reveal Definition"): st.info(definition)
+
+def render_mcqs(questions, key="mcq"):
+    for i, q in enumerate(questions):
+        st.markdown(f"**{i+1}. {q.get('question','?')}**")
+        st.radio(f"Options for Q{i+1}", q.get('options',[]), key=f"{key}_{i}", index=None)
+        with st.expander(f"Show Answer {i+1}"):
+            st.success(f"Correct Answer: {q.get('answer','')}")
+            st.caption(f"Hint: {q.get('hint', '')}")
+        st.divider()
+
+def render_subjective(questions, key="subj"):
+    for i, q in enumerate(questions):
+        st.markdown(f"**Q{i+1}: {q.get('question','?')}**")
+        with st.expander("Show Model Answer"):
+            st.write(q.get('model_answer','...'))
+        st.divider()
+
+# JSON Study Center tasks: each item renders as soon as it has streamed in (see live_ai_job)
+ITEM_RENDERERS = {'flashcard': render_flashcards, 'mcq': render_mcqs, 'subjective': render_subjective}
+
+def render_comments(target_id, target_type, parent_id=None, level=0, thread=None):
+    # `thread` is {parent_id: [comments]} for this target, loaded once (see db.comment_threads) and walked in memory.
+    if thread is None: thread = db.comment_threads([target_id], target_type).get(target_id, {})
+    if level > 3: return
+    for com in thread.get(parent_id, []):
         with st.container():
             if level > 0: col_spacer, col_content = st.columns([0.5 * level, 10])
             else: col_content = st.container()
@@ -619,9 +525,12 @@ def render_comments(target_id, target_type, parent_id=None, level=0):
                         reply = st.text_input("Reply...", key=f"rp_{com['id']}")
                         if st.button("Post", key=f"bp_{com['id']}"): add_comment(target_id, target_type, st.session_state.user, reply, parent_id=com['id']); st.rerun()
                 st.divider()
-                render_comments(target_id, target_type, com['id'], level + 1)
+                render_comments(target_id, target_type, com['id'], level + 1, thread)
 
-def render_feed_item(note):
+def render_feed_item(note, page=None):
+    # `page` is the pre-joined data for the whole feed page (db.hydrate_feed); standalone calls hydrate just this note.
+    if page is None: page = db.hydrate_feed([note], st.session_state.user)
+    my_vote = page['votes'].get(("NOTE", note['id']), 0)
     with st.container(border=True):
         if note['post_type'] == "DOUBT": col_body = st.container()
         else:
@@ -629,22 +538,24 @@ def render_feed_item(note):
             with col_vote:
                 # st.markdown(f"<h3 style='text-align:center; margin:0;'>{note['upvotes']}</h3>", unsafe_allow_html=True)
                 st.metric("Votes", note['upvotes'])
-                if st.button("⬆️", key=f"u_{note['id']}"): handle_vote(note['id'], "NOTE", st.session_state.user, 1); st.rerun()
-                if st.button("⬇️", key=f"d_{note['id']}"): handle_vote(note['id'], "NOTE", st.session_state.user, -1); st.rerun()
+                if st.button("⬆️", key=f"u_{note['id']}", type="primary" if my_vote == 1 else "secondary"): handle_vote(note['id'], "NOTE", st.session_state.user, 1); st.rerun()
+                if st.button("⬇️", key=f"d_{note['id']}", type="primary" if my_vote == -1 else "secondary"): handle_vote(note['id'], "NOTE", st.session_state.user, -1); st.rerun()
         with col_body:
             c_title, c_meta = st.columns([8, 2])
             with c_title: st.subheader(f"{'❓' if note['post_type'] == 'DOUBT' else '📄'} {note['title']}")
             with c_meta:
                 c_bm, c_opt = st.columns(2)
                 with c_bm:
-                    if st.button("🔖", key=f"bm_{note['id']}", help="Save to Bookmarks"): toggle_bookmark(note['id'])
+                    saved = note['id'] in page['bookmarks']
+                    if st.button("🔖", key=f"bm_{note['id']}", help="Remove Bookmark" if saved else "Save to Bookmarks", type="primary" if saved else "secondary"): toggle_bookmark(note['id'])
                 with c_opt:
                     if note['uploader'] == st.session_state.user:
                         with st.popover("⋮"):
                             with st.expander("✏️ Edit Post"):
                                 ed_ti = st.text_input("Title", value=note['title'], key=f"edt_{note['id']}")
                                 ed_co = st.text_area("Content", value=note['content'], key=f"edc_{note['id']}")
-                                if st.button("Update", key=f"upd_{note['id']}"): update_post(note['id'], ed_ti, ed_co)
+                                ed_tg = st.text_input("Tags", value=note['tags'] or "", key=f"edg_{note['id']}")
+                                if st.button("Update", key=f"upd_{note['id']}"): update_post(note['id'], ed_ti, ed_co, ed_tg)
                             with st.expander("🗑️ Delete Post"):
                                 st.warning(f"Delete this {note['post_type'].title()}?")
                                 if st.button("Confirm", key=f"del_{note['id']}"): delete_item("notes", note['id'])
@@ -661,9 +572,8 @@ def render_feed_item(note):
                                     submit_report(note['id'], st.session_state.user, reason, det); st.success("Reported.")
             
             badge_info = ""
-            if note['uploader'] != "Anonymous":
-                udata = get_data("SELECT reputation FROM users WHERE username=?", (note['uploader'],))
-                if udata: badge_info = f" • {get_user_badge(udata[0]['reputation'])}"
+            if note['uploader'] in page['reputation']:
+                badge_info = f" • {get_user_badge(page['reputation'][note['uploader']])}"
 
             if st.button(f"By **{note['uploader']}**{badge_info}", key=f"usr_lnk_{note['id']}", type="secondary"):
                 if note['uploader'] != "Anonymous":
@@ -676,6 +586,7 @@ def render_feed_item(note):
             else:
                 st.caption(f"in *{note['subject']}*")
 
+            if 'snippet' in note.keys() and note['snippet']: st.caption(f"🔎 {note['snippet']}")
             if note['post_type'] == "DOUBT": st.write(note['content'])
             
             if note['filename'] and note['filename'] != "DOUBT":
@@ -688,17 +599,21 @@ def render_feed_item(note):
                             with st.expander("📄 View PDF"): pdf_viewer(fpath, height=400)
                         elif ext in ['png','jpg','jpeg']: st.image(fpath, width=400)
                     with c2:
-                        with open(fpath, "rb") as f: st.download_button("⬇️ Download File", f, file_name=note['filename'])
+                        with open(fpath, "rb") as f: st.download_button("⬇️ Download File", f, file_name=note['original_name'] or os.path.basename(note['filename']))
             st.divider()
             
             if note['post_type'] == "DOUBT":
-                st.write("#### ✅ Answers")
-                ans = get_data("SELECT * FROM answers WHERE doubt_id=? ORDER BY upvotes DESC", (note['id'],))
+                ans = page['answers'].get(note['id'], [])
+                st.write(f"#### ✅ Answers ({len(ans)})")
+                if note['id'] in page['drafts']:
+                    st.write("**🤖 AI Tutor**")
+                    live_ai_job(page['drafts'][note['id']], 'doubt')
                 for a in ans:
+                    a_thread = page['threads']["ANSWER"].get(a['id'], {})
                     ac1, ac2 = st.columns([0.5, 9.5])
                     with ac1:
                         st.write(f"**{a['upvotes']}**")
-                        if st.button("👍", key=f"au_{a['id']}"): handle_vote(a['id'], "ANSWER", st.session_state.user, 1); st.rerun()
+                        if st.button("👍", key=f"au_{a['id']}", type="primary" if page['votes'].get(("ANSWER", a['id'])) == 1 else "secondary"): handle_vote(a['id'], "ANSWER", st.session_state.user, 1); st.rerun()
                     with ac2:
                         st.write(f"**{a['responder']}**")
                         st.info(a['answer_text'])
@@ -710,8 +625,8 @@ def render_feed_item(note):
                                  with st.expander("🗑️ Delete"):
                                      st.warning("Delete this answer?")
                                      if st.button("Confirm", key=f"da_{a['id']}"): delete_item("answers", a['id'])
-                        with st.expander("💬 Comments"):
-                            render_comments(a['id'], "ANSWER")
+                        with st.expander(f"💬 Comments ({db.thread_size(a_thread)})"):
+                            render_comments(a['id'], "ANSWER", thread=a_thread)
                             with st.form(f"cform_ans_{a['id']}"):
                                 c_txt = st.text_input("Comment...", key=f"aci_{a['id']}")
                                 if st.form_submit_button("Post"): add_comment(a['id'], "ANSWER", st.session_state.user, c_txt, item_owner=a['responder']); st.rerun()
@@ -722,20 +637,37 @@ def render_feed_item(note):
                     if st.form_submit_button("Post Answer"): 
                         add_answer(note['id'], st.session_state.user, ans_txt, note['uploader']); st.rerun()
             else:
-                st.write("#### 💬 Discussion")
-                render_comments(note['id'], "NOTE")
+                n_thread = page['threads']["NOTE"].get(note['id'], {})
+                st.write(f"#### 💬 Discussion ({db.thread_size(n_thread)})")
+                render_comments(note['id'], "NOTE", thread=n_thread)
                 with st.form(f"rc_form_{note['id']}"):
                     c_txt = st.text_input("Comment...")
                     if st.form_submit_button("Post"): add_comment(note['id'], "NOTE", st.session_state.user, c_txt, item_owner=note['uploader']); st.rerun()
 
+def render_paged(slot, key, fetch_page):
+    """Keyset-paged listing with 'Load more'. fetch_page(cursor, limit) -> (rows, next_cursor).
+    `key` identifies the query (filters, search text); changing it starts again from page one."""
+    state = st.session_state.pages.get(slot)
+    if not state or state['key'] != key: state = st.session_state.pages[slot] = {'key': key, 'cursors': [None]}
+    shown, nxt = 0, None
+    for cur in state['cursors']:
+        rows, nxt = fetch_page(cur, st.session_state.page_size)
+        page = db.hydrate_feed(rows, st.session_state.user)
+        for r in rows: render_feed_item(r, page)
+        shown += len(rows)
+        if not nxt: break
+    if nxt and st.button("⬇️ Load more", key=f"more_{slot}", use_container_width=True):
+        state['cursors'].append(nxt); st.rerun()
+    return shown
+
 # --- 8. LANDING PAGE & MAIN LOGIC ---
 
 def landing_page():
     # Fetch some dummy stats for the landing page
-    conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM users"); u_count = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM notes"); n_count = c.fetchone()[0]
-    conn.close()
+    with db.connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM users"); u_count = c.fetchone()[0]
+        c.execute("SELECT COUNT(*) FROM notes"); n_count = c.fetchone()[0]
 
     st.markdown("<br>", unsafe_allow_html=True)
     
@@ -792,19 +724,25 @@ def landing_page():
 
 # --- INITIALIZATION ---
 init_db()
+jobs.start_workers()
+similar.get_index() # first build of the similar-doubts index starts in the background
 if 'user' not in st.session_state: st.session_state.user = None
 if 'nav' not in st.session_state: st.session_state.nav = "Feed"
 if 'view_user' not in st.session_state: st.session_state.view_user = None
 if 'course_tab' not in st.session_state: st.session_state.course_tab = "Notes"
 if 'ai_outputs' not in st.session_state: st.session_state.ai_outputs = {} # DICTIONARY FOR OUTPUTS
+if 'pages' not in st.session_state: st.session_state.pages = {} # KEYSET CURSORS PER LISTING
+if 'page_size' not in st.session_state: st.session_state.page_size = db.PAGE_SIZE
 
 # --- MAIN NAVIGATION CONTROLLER ---
+# Each rerun is one profiled page view: its queries and total render time feed the Admin panel's report.
+profiler.begin("Landing" if not st.session_state.user else st.session_state.nav)
 if not st.session_state.user:
     landing_page()
 else:
     # --- SIDEBAR ---
     with st.sidebar:
-        user_data, _, _, followers_count, following_count = get_user_stats_detailed(st.session_state.user)
+        user_data, _, notes_count, followers_count, following_count = get_user_stats_detailed(st.session_state.user)
         
         # 1. PROFILE BUTTON (USERNAME ONLY)
         if st.button(f"👤 {st.session_state.user}", key="profile_user_btn", use_container_width=True):
@@ -823,6 +761,7 @@ else:
             if st.button("🔒 Admin Panel"): st.session_state.nav = "Admin"
 
         st.divider()
+        st.select_slider("Posts per page", options=[10, 20, 50], key="page_size")
         if st.button("Logout"): st.session_state.user = None; st.rerun()
         
         with st.expander("📞 Contact Us"):
@@ -834,6 +773,7 @@ else:
             """)
     
     menu = st.session_state.nav
+    profiler.label(menu)
 
     # --- PAGES ---
     if menu == "Profile":
@@ -859,7 +799,7 @@ else:
         if user_data:
             c1, c2, c3, c4 = st.columns(4)
             c1.metric("Reputation", user_data['reputation'])
-            c2.metric("Notes", get_user_stats_detailed(st.session_state.user)[2])
+            c2.metric("Notes", notes_count)
             c3.metric("Followers", followers_count)
             c4.metric("Following", following_count)
             st.write("---")
@@ -868,8 +808,9 @@ else:
                 with st.form("prof_form"):
                     col_l, col_r = st.columns([1, 2])
                     with col_l:
-                        if user_data['profile_pic']: st.image(base64.b64decode(user_data['profile_pic']), width=150)
-                        new_pic = st.file_uploader("Change Picture", type=['png', 'jpg'])
+                        pic = avatars.thumbnail(user_data['avatar'])
+                        if pic: st.image(pic, width=150)
+                        new_pic = st.file_uploader("Change Picture", type=['png', 'jpg', 'jpeg'])
                     with col_r:
                         fn = st.text_input("Full Name", value=user_data['full_name'] or "")
                         bio = st.text_area("Bio", value=user_data['bio'] or "")
@@ -878,10 +819,11 @@ else:
                     with c_b: br = st.text_input("Branch", value=user_data['branch'] or "")
                     with c_a: age = st.text_input("Age", value=user_data['age'] or "")
                     if st.form_submit_button("💾 Save Profile"):
-                        pic_data = user_data['profile_pic']
-                        if new_pic: pic_data = base64.b64encode(new_pic.read()).decode('utf-8')
-                        update_user_profile(st.session_state.user, fn, yr, br, age, user_data['gender'], bio, pic_data)
-                        st.success("Updated!"); st.rerun()
+                        try:
+                            avatar = avatars.save(new_pic.getvalue()) if new_pic else user_data['avatar']
+                            update_user_profile(st.session_state.user, fn, yr, br, age, user_data['gender'], bio, avatar)
+                            st.success("Updated!"); st.rerun()
+                        except ValueError: st.error("Couldn't read that picture. Try a PNG or JPG.")
                 st.subheader("⚙️ Settings")
                 with st.expander("Change Username"):
                     nu = st.text_input("New Username")
@@ -898,10 +840,9 @@ else:
                         st.error("⚠️ IRREVERSIBLE ACTION!")
                         if st.button("✅ Yes, Delete"): delete_account(st.session_state.user); st.session_state.user=None; st.rerun()
             with t_saved:
-                bookmarks = get_data("SELECT * FROM notes WHERE id IN (SELECT note_id FROM bookmarks WHERE user=?)", (st.session_state.user,))
-                if bookmarks:
-                    for b in bookmarks: render_feed_item(b)
-                else: st.info("No saved items yet. Bookmark posts from the feed!")
+                user = st.session_state.user
+                if not render_paged("saved", user, lambda cur, n: db.bookmarks_page(user, cur, n)):
+                    st.info("No saved items yet. Bookmark posts from the feed!")
 
     elif menu == "Profile_View":
         target_user = st.session_state.view_user
@@ -913,7 +854,8 @@ else:
         if tu_data:
             c_info, c_action = st.columns([3, 1])
             with c_info:
-                if tu_data['profile_pic']: st.image(base64.b64decode(tu_data['profile_pic']), width=150)
+                pic = avatars.thumbnail(tu_data['avatar'])
+                if pic: st.image(pic, width=150)
                 st.write(f"**Bio:** {tu_data['bio'] or 'No bio.'}")
             with c_action:
                 if is_following(st.session_state.user, target_user):
@@ -939,6 +881,68 @@ else:
         reqs = get_data("SELECT * FROM course_requests ORDER BY timestamp DESC")
         if reqs: st.dataframe(reqs)
         else: st.info("No course requests.")
+        st.subheader("🧮 Vote Counters")
+        if st.button("Reconcile counters with votes"):
+            drift = db.reconcile_vote_counters()
+            if drift: st.warning(f"Repaired {len(drift)} drifted counter(s)."); st.dataframe(drift)
+            else: st.success("All counters match the votes table.")
+        if st.button("Recompute all reputations"):
+            st.success(f"Recomputed reputation for {db.recompute_reputations()} user(s).")
+        st.subheader("🗄️ Upload Store")
+        if st.button("Move legacy uploads into the blob store"):
+            st.success(f"Re-pointed {storage.adopt_legacy_uploads()} note(s).")
+        st.subheader("🤖 AI Artifact Cache")
+        cs = ai_cache.stats()
+        k1, k2, k3, k4 = st.columns(4)
+        k1.metric("Entries", cs['entries']); k2.metric("Size", f"{cs['bytes'] / 1024:.0f} KB")
+        k3.metric("Hit rate", f"{cs['hit_rate']:.0%}", f"{cs['hits']} hits / {cs['misses']} misses", delta_color="off"); k4.metric("Evictions", cs['evictions'])
+        gf = gemini_files.stats()
+        st.caption(f"Gemini file handles: {gf['live_handles']} live, {gf['uploads_saved']} re-upload(s) avoided.")
+        st.subheader("🚦 Gemini Rate Limiter")
+        rl = ratelimit.stats()
+        r1, r2, r3, r4 = st.columns(4)
+        r1.metric("In flight", f"{rl['in_flight']}/{ratelimit.MAX_CONCURRENCY}", f"{rl['waiting']} waiting", delta_color="off")
+        r2.metric("Requests left", f"{rl['requests_left']}/{ratelimit.RPM:.0f}", f"{rl['tokens_left']:,} tokens", delta_color="off")
+        r3.metric("Admitted / Rejected", f"{rl.get('admitted', 0)} / {rl.get('rejected', 0)}")
+        r4.metric("429 cooldowns", rl.get('throttled', 0), f"{rl['cooldown']:.0f}s left" if rl['cooldown'] else None, delta_color="off")
+        st.subheader("🧵 AI Job Queue")
+        js = jobs.stats()
+        q1, q2, q3, q4 = st.columns(4)
+        q1.metric("Queued", js.get('queued', 0)); q2.metric("Running", js.get('running', 0))
+        q3.metric("Done", js.get('done', 0)); q4.metric("Dead letters", js.get('dead', 0))
+        jview = st.radio("Show", ["All", "queued", "running", "dead"], horizontal=True, key="job_view")
+        recent_jobs = jobs.recent(None if jview == "All" else jview)
+        if recent_jobs: st.dataframe([dict(j, created_at=format_ts(j['created_at']), updated_at=format_ts(j['updated_at'])) for j in recent_jobs], hide_index=True)
+        dead = jobs.recent('dead')
+        if dead:
+            dj = st.selectbox("Dead letter", [j['id'] for j in dead], format_func=lambda i: next(f"#{j['id']} {j['kind']}: {j['error']}" for j in dead if j['id'] == i))
+            if st.button("Retry job"): jobs.retry(dj); st.rerun()
+        if st.button("Purge finished jobs (> 7 days)"): st.success(f"Removed {jobs.purge()} job(s).")
+        st.subheader("🔎 Search Index")
+        if st.button("Index unextracted PDFs"):
+            with st.spinner("Extracting PDF text..."): st.success(f"Checked {reindex_pdf_text()} PDF(s).")
+        st.subheader("⏱️ Query & Render Profile")
+        ps = profiler.stats()
+        if not ps['enabled']: st.info("Profiling is off (IITCONNECT_PROFILE=0).")
+        else:
+            st.caption(f"Last {ps['views']} page view(s) and {ps['queries']} quer(ies) in this server process "
+                       f"(buffers hold {ps['view_buffer']} / {ps['query_buffer']}, sampling {ps['sample_rate']:.0%}).")
+            views = profiler.page_stats()
+            if views: st.dataframe(views, hide_index=True, use_container_width=True)
+            p1, p2, p3 = st.columns(3)
+            with p1: prof_page = st.selectbox("Page", ["All"] + profiler.pages(), key="prof_page")
+            with p2: prof_order = st.selectbox("Slowest by", ["p95_ms", "max_ms", "mean_ms", "total_ms"], key="prof_order")
+            with p3: prof_n = st.number_input("Top", 5, 100, 10, key="prof_n")
+            page_filter = None if prof_page == "All" else prof_page
+            st.dataframe(profiler.slowest(int(prof_n), page_filter, prof_order), hide_index=True, use_container_width=True)
+            h1, h2 = st.columns(2)
+            with h1:
+                st.caption("Query latency")
+                st.bar_chart(pd.DataFrame(profiler.histogram("queries", page_filter), columns=["bucket", "queries"]).set_index("bucket"))
+            with h2:
+                st.caption("Rerun render time")
+                st.bar_chart(pd.DataFrame(profiler.histogram("views", page_filter), columns=["bucket", "views"]).set_index("bucket"))
+            if st.button("Reset profile"): profiler.reset(); st.rerun()
 
     elif menu == "Feed":
         c1, c2 = st.columns([9, 1])
@@ -952,35 +956,27 @@ else:
                     if st.button("Mark All Read", key="mark_read_feed"): 
                         mark_notifications_read(st.session_state.user)
                         st.rerun()
-                    for n in notifs: st.info(f"{n[2]} ({n[4]})")
+                    for n in notifs: st.info(f"{n[2]} ({format_ts(n[4])})")
                 else: st.caption("No new notifications.")
         
-        tags_raw = get_data("SELECT tags FROM notes")
-        all_tags = []
-        for t in tags_raw: all_tags.extend([x.strip() for x in t['tags'].split('#') if x.strip()])
-        top_tags = [t[0] for t in Counter(all_tags).most_common(5)]
-        st.write("Trending Topics:")
+        c_lbl, c_win = st.columns([3, 2])
+        with c_lbl: st.write("Trending Topics:")
+        with c_win: window = st.radio("Window", ["All time", "24h", "7d"], horizontal=True, label_visibility="collapsed", key="trend_window")
+        if window == "All time": top_tags = db.top_tags(5)
+        else: top_tags = db.trending_tags(24 if window == "24h" else 7 * 24, half_life_hours=6 if window == "24h" else 48)
         cols = st.columns(len(top_tags) + 1)
         if cols[0].button("All Topics"): st.session_state.tag_filter = None
         for i, tag in enumerate(top_tags):
             if cols[i+1].button(f"#{tag}"): st.session_state.tag_filter = tag
         q = st.text_input("🔍 Search...", placeholder="Type to search notes, doubts, or tags...")
-        query = "SELECT * FROM notes"
-        params = []
-        if q:
-            query += " WHERE (title LIKE ? OR tags LIKE ?)"
-            params = [f"%{q}%", f"%{q}%"]
-        elif getattr(st.session_state, 'tag_filter', None):
-            query += " WHERE tags LIKE ?"
-            params = [f"%{st.session_state.tag_filter}%"]
-        query += " ORDER BY timestamp DESC"
-        notes = get_data(query, params)
-        if not notes:
+        tag = getattr(st.session_state, 'tag_filter', None)
+        if q: shown = render_paged("feed", ("search", q), lambda cur, n: db.search_page(q, cur, n))
+        else: shown = render_paged("feed", ("tag", tag), lambda cur, n: db.notes_page(cur, n, tag=tag))
+        if not shown:
             st.markdown("""<div style='text-align:center; padding: 40px; color: #666;'>
                 <h2>📭 Nothing here yet!</h2>
                 <p>Be the first to contribute or try a different search.</p>
             </div>""", unsafe_allow_html=True)
-        for n in notes: render_feed_item(n)
 
     elif menu == "Folders":
         st.title("📂 Course Folders")
@@ -1031,10 +1027,8 @@ else:
             with c2:
                 if st.button("❓ DOUBTS", use_container_width=True, type="primary" if st.session_state.course_tab=="Doubts" else "secondary"): st.session_state.course_tab = "Doubts"
             st.divider()
-            if st.session_state.course_tab == "Notes":
-                for n in get_data("SELECT * FROM notes WHERE subject=? AND post_type='RESOURCE' ORDER BY timestamp DESC", (st.session_state.folder,)): render_feed_item(n)
-            else:
-                for n in get_data("SELECT * FROM notes WHERE subject=? AND post_type='DOUBT' ORDER BY timestamp DESC", (st.session_state.folder,)): render_feed_item(n)
+            folder, ptype = st.session_state.folder, "RESOURCE" if st.session_state.course_tab == "Notes" else "DOUBT"
+            render_paged("folder", (folder, ptype), lambda cur, n: db.notes_page(cur, n, subject=folder, post_type=ptype))
 
     elif menu == "Post":
         st.title("📝 Contribute")
@@ -1044,13 +1038,19 @@ else:
                 ti=st.text_input("Title"); sub=st.selectbox("Subject", ["Physics", "Mathematics", "CS", "Electronics"]); tags=st.text_input("Tags (e.g. #Exam #Hard)"); f=st.file_uploader("PDF", type="pdf")
                 if st.form_submit_button("Upload"):
                     if ti and f:
-                        p = os.path.join(UPLOAD_FOLDER, f.name); open(p, "wb").write(f.getbuffer())
-                        add_note(st.session_state.user, sub, ti, f.name, tags, True); st.success("Posted!")
+                        blob = storage.save_upload(f, f.name) # streamed + deduplicated by content hash
+                        add_note(st.session_state.user, sub, ti, blob, tags, True, original_name=f.name); st.success("Posted!")
                     else: st.error("Title and File are required.")
         with t2:
+            # Question + subject live outside the form so matching answered doubts show up while typing
+            ti=st.text_input("Question (Required)", key="dq")
+            sub=st.selectbox("Sub", ["Physics", "Mathematics", "CS", "Electronics"], key="ds")
+            matches = similar.find(ti, subject=sub) if len(ti) > 8 else []
+            if matches:
+                st.caption("💡 Similar answered doubts")
+                for m in matches:
+                    with st.expander(f"{m['title']} ({m['score']:.0%} match)"): st.markdown(m['answer'])
             with st.form("d"):
-                ti=st.text_input("Question (Required)")
-                sub=st.selectbox("Sub", ["Physics", "Mathematics", "CS", "Electronics"], key="ds")
                 tags=st.text_input("Tags (e.g. #Doubt)")
                 txt=st.text_area("Details (Optional)")
                 f_doubt = st.file_uploader("Attachment (Image/PDF)", type=['png', 'jpg', 'jpeg', 'pdf'])
@@ -1061,33 +1061,42 @@ else:
                         fname = "DOUBT"
                         fpath = None
                         if f_doubt:
-                            fname = f_doubt.name
+                            fname = storage.save_upload(f_doubt, f_doubt.name)
                             fpath = os.path.join(UPLOAD_FOLDER, fname)
-                            with open(fpath, "wb") as f: f.write(f_doubt.getbuffer())
                         
+                        best = next(iter(similar.find(f"{ti} {txt}", subject=sub, limit=1, min_score=similar.SHORTEN_SCORE)), None)
                         uploader_name = "Anonymous" if anon else st.session_state.user
-                        add_note(uploader_name, sub, ti, fname, tags, True, content=txt, post_type="DOUBT")
-                        
-                        # --- AUTO AI ANSWER LOGIC ---
-                        conn = sqlite3.connect(DB_NAME); c = conn.cursor()
-                        c.execute("SELECT id FROM notes WHERE uploader=? ORDER BY id DESC LIMIT 1", (uploader_name,))
-                        new_id_data = c.fetchone()
-                        conn.close()
-                        
-                        if new_id_data:
-                            with st.spinner("🤖 AI is thinking..."):
-                                prompt = f"Answer this academic doubt clearly: {ti}\nDetails: {txt}"
-                                ai_reply = get_ai_response(prompt, file_path=fpath)
-                                if ai_reply and not ai_reply.startswith("Error"):
-                                    add_answer(new_id_data[0], "🤖 AI Tutor", ai_reply, uploader_name)
+                        doubt_id = add_note(uploader_name, sub, ti, fname, tags, True, content=txt, post_type="DOUBT", original_name=f_doubt.name if f_doubt else None)
                         
-                        st.success("Posted & Answered by AI!")
+                        # --- AUTO AI ANSWER (queued; the AI worker posts it through add_answer) ---
+                        if doubt_id and best and best['score'] >= similar.SKIP_SCORE and not f_doubt:
+                            # Near-duplicate of an answered doubt: reuse that answer, no model call
+                            add_answer(doubt_id, "🤖 AI Tutor", f"This was answered before in **{best['title']}**:\n\n{best['answer']}", uploader_name)
+                            st.success("Posted! 🤖 AI Tutor found an existing answer.")
+                        elif doubt_id:
+                            prompt = f"Answer this academic doubt clearly: {ti}\nDetails: {txt}"
+                            if best: prompt += f"\n\nA similar doubt (\"{best['title']}\") was answered as:\n{best['answer'][:2000]}\nBuild on that answer; keep it short and cover only what differs."
+                            job_id = jobs.enqueue("doubt_answer", {'doubt_id': doubt_id, 'prompt': prompt, 'file_path': fpath, 'uploader': uploader_name},
+                                                  dedupe_key=f"doubt:{doubt_id}", priority=jobs.PRIORITY_BATCH)
+                            st.session_state.doubt_draft = {'doubt_id': doubt_id, 'job_id': job_id}
+                            st.success("Posted! 🤖 AI Tutor is drafting an answer.")
                     else:
                         st.error("Title is required. You must also provide either Details or an Attachment.")
+            # The AI Tutor's answer to the doubt just posted, streamed in as it is written
+            draft = st.session_state.get('doubt_draft')
+            if draft:
+                st.write("**🤖 AI Tutor**")
+                job = db.query_one("SELECT status, error FROM ai_jobs WHERE id=?", (draft['job_id'],))
+                if job and job['status'] in ('queued', 'running'): live_ai_job(draft['job_id'], 'doubt')
+                else:
+                    ans = db.query_one("SELECT answer_text FROM answers WHERE doubt_id=? AND responder='🤖 AI Tutor' ORDER BY id DESC LIMIT 1", (draft['doubt_id'],))
+                    if ans: st.info(ans['answer_text'])
+                    else: st.warning(f"AI Tutor could not answer this one. {job['error'] if job else ''}")
+                    if st.button("Dismiss", key="dismiss_draft"): st.session_state.doubt_draft = None; st.rerun()
 
     elif menu == "Leaderboard":
         st.title("🏆 Hall of Fame")
-        data = get_data("SELECT username, posts_count, answers_count, reputation FROM users WHERE reputation > 0 ORDER BY reputation DESC LIMIT 10")
+        data = db.leaderboard(10)
         df = pd.DataFrame(data, columns=["Name", "Contributions", "Answers Given", "Reputation Score"])
         df['Badge'] = df['Reputation Score'].apply(get_user_badge)
         st.dataframe(df, hide_index=True, use_container_width=True)
@@ -1112,115 +1121,92 @@ else:
         else:
             up = st.file_uploader("Upload PDF", type="pdf")
             if up:
-                safe_name = re.sub(r'[^a-zA-Z0-9_\-\.]', '_', up.name)
-                temp = os.path.join(UPLOAD_FOLDER, safe_name)
-                
-                with open(temp, "wb") as f: 
-                    f.write(up.getbuffer())
-                
-                file_path = temp
+                # Store once per uploaded file (not per rerun); the blob path doubles as the cache key downstream.
+                up_key = getattr(up, 'file_id', None) or f"{up.name}:{up.size}"
+                blobs = st.session_state.setdefault('study_uploads', {})
+                if up_key not in blobs:
+                    blobs[up_key] = os.path.join(UPLOAD_FOLDER, storage.save_upload(up, up.name))
+                    storage.extract_pdf(blobs[up_key]) # parse once, now; every tab reads the cached pages
+                file_path = blobs[up_key]
         
         # Reset results if file changes
         if 'current_file' not in st.session_state or st.session_state.current_file != file_path:
             st.session_state.current_file = file_path
-            st.session_state.ai_outputs = {}
-
-        if file_path:
+            st.session_state.ai_outputs = {}; st.session_state.ai_jobs = {}
+
+        if file_path and not os.path.isfile(file_path):
+            # artifact keys hash the file, so there is nothing to look up (or generate) without it
+            st.error("⚠️ The original file for this note is missing, so the Study Center can't use it. Ask the uploader to re-upload it.")
+        elif file_path:
+            if not show_ai_job('pack'):
+                if st.session_state.ai_outputs.get('pack'): st.error(st.session_state.ai_outputs['pack']) # the last pack job died
+                if sum(not get_ai_output(file_path, t, force_vision) for t in ai.STUDY_TASKS) > 1:
+                    if st.button("⚡ Generate Full Study Pack", help="Summary, mind map, flashcards and both quizzes in a single AI call"):
+                        queue_ai_output(file_path, 'pack', force_vision)
             # UNIFIED STUDY CENTER TABS
             t1, t2, t3, t4, t5 = st.tabs(["📝 Summary", "🧠 Mind Map", "🗂 Flashcards", "❓ Quiz (MCQ)", "✍️ Subjective"])
             
             with t1:
-                data = st.session_state.ai_outputs.get('summary')
+                data = get_ai_output(file_path, 'summary', force_vision)
                 if not data:
-                    if st.button("Generate Summary"):
-                        with st.spinner("Summarizing..."):
-                            st.session_state.ai_outputs['summary'] = generate_ai_content(file_path, "summary", force_vision)
-                            st.rerun()
+                    if not show_ai_job('summary') and st.button("Generate Summary"): queue_ai_output(file_path, "summary", force_vision)
                 elif isinstance(data, str) and (data.startswith("AI Failed") or data.startswith("⚠️ System Busy")):
                     st.error(data)
-                    if st.button("Regenerate Summary"): del st.session_state.ai_outputs['summary']; st.rerun()
+                    if not show_ai_job('summary') and st.button("Regenerate Summary"): queue_ai_output(file_path, "summary", force_vision, refresh=True)
                 else:
                     st.markdown(data)
-                    if st.button("Regenerate Summary"): del st.session_state.ai_outputs['summary']; st.rerun()
+                    if not show_ai_job('summary') and st.button("Regenerate Summary"): queue_ai_output(file_path, "summary", force_vision, refresh=True)
 
             with t2:
-                data = st.session_state.ai_outputs.get('mindmap')
+                data = get_ai_output(file_path, 'mindmap', force_vision)
                 if not data:
-                    if st.button("Generate Mind Map"):
-                        with st.spinner("Mapping concepts..."):
-                            st.session_state.ai_outputs['mindmap'] = generate_ai_content(file_path, "mindmap", force_vision)
-                            st.rerun()
+                    if not show_ai_job('mindmap') and st.button("Generate Mind Map"): queue_ai_output(file_path, "mindmap", force_vision)
                 elif isinstance(data, str) and (data.startswith("AI Failed") or data.startswith("⚠️ System Busy")):
                      st.error(data)
-                     if st.button("Regenerate Mind Map"): del st.session_state.ai_outputs['mindmap']; st.rerun()
+                     if not show_ai_job('mindmap') and st.button("Regenerate Mind Map"): queue_ai_output(file_path, "mindmap", force_vision, refresh=True)
                 else:
                     if isinstance(data, str) and ("digraph" in data or "graph" in data):
                         if "rankdir" not in data:
                             data = data.replace("{", '{\n  graph [rankdir=LR, splines=ortho];\n  node [shape=box, style="filled,rounded", fillcolor="#f0f2f6", fontname="Arial", fontsize=12];\n  edge [penwidth=1.2];\n', 1)
                         st.graphviz_chart(data, use_container_width=True)
                     else: st.error(f"Invalid Data: {data}")
-                    if st.button("Regenerate Mind Map"): del st.session_state.ai_outputs['mindmap']; st.rerun()
+                    if not show_ai_job('mindmap') and st.button("Regenerate Mind Map"): queue_ai_output(file_path, "mindmap", force_vision, refresh=True)
 
             with t3:
-                data = st.session_state.ai_outputs.get('flashcard')
+                data = get_ai_output(file_path, 'flashcard', force_vision)
                 if not data:
-                    if st.button("Generate Flashcards"):
-                        with st.spinner("Creating cards..."):
-                            st.session_state.ai_outputs['flashcard'] = generate_ai_content(file_path, "flashcard", force_vision)
-                            st.rerun()
+                    if not show_ai_job('flashcard') and st.button("Generate Flashcards"): queue_ai_output(file_path, "flashcard", force_vision)
                 elif isinstance(data, str) and (data.startswith("AI Failed") or data.startswith("⚠️ System Busy")):
                      st.error(data)
-                     if st.button("Regenerate Flashcards"): del st.session_state.ai_outputs['flashcard']; st.rerun()
+                     if not show_ai_job('flashcard') and st.button("Regenerate Flashcards"): queue_ai_output(file_path, "flashcard", force_vision, refresh=True)
                 elif isinstance(data, list):
-                    c1, c2 = st.columns(2)
-                    for i, c in enumerate(data):
-                        with (c1 if i%2==0 else c2):
-                            with st.container(border=True):
-                                # Fix for KeyError: Use .get()
-                                term = c.get('term', 'Unknown')
-                                definition = c.get('definition', '...')
-                                st.markdown(f"### {term}")
-                                with st.expander("Reveal Definition"): st.info(definition)
-                    if st.button("Regenerate Flashcards"): del st.session_state.ai_outputs['flashcard']; st.rerun()
+                    render_flashcards(data)
+                    if not show_ai_job('flashcard') and st.button("Regenerate Flashcards"): queue_ai_output(file_path, "flashcard", force_vision, refresh=True)
                 else: st.error(data)
 
             with t4:
-                data = st.session_state.ai_outputs.get('mcq')
+                data = get_ai_output(file_path, 'mcq', force_vision)
                 if not data:
-                    if st.button("Generate MCQs"):
-                        with st.spinner("Creating quiz..."):
-                            st.session_state.ai_outputs['mcq'] = generate_ai_content(file_path, "mcq", force_vision)
-                            st.rerun()
+                    if not show_ai_job('mcq') and st.button("Generate MCQs"): queue_ai_output(file_path, "mcq", force_vision)
                 elif isinstance(data, str) and (data.startswith("AI Failed") or data.startswith("⚠️ System Busy")):
                      st.error(data)
-                     if st.button("Regenerate MCQs"): del st.session_state.ai_outputs['mcq']; st.rerun()
+                     if not show_ai_job('mcq') and st.button("Regenerate MCQs"): queue_ai_output(file_path, "mcq", force_vision, refresh=True)
                 elif isinstance(data, list):
-                    for i, q in enumerate(data):
-                        st.markdown(f"**{i+1}. {q.get('question','?')}**")
-                        st.radio(f"Options for Q{i+1}", q.get('options',[]), key=f"mcq_{i}", index=None)
-                        with st.expander(f"Show Answer {i+1}"):
-                            st.success(f"Correct Answer: {q.get('answer','')}")
-                            st.caption(f"Hint: {q.get('hint', '')}")
-                        st.divider()
-                    if st.button("Regenerate MCQs"): del st.session_state.ai_outputs['mcq']; st.rerun()
+                    render_mcqs(data)
+                    if not show_ai_job('mcq') and st.button("Regenerate MCQs"): queue_ai_output(file_path, "mcq", force_vision, refresh=True)
                 else: st.error(data)
 
             with t5:
-                data = st.session_state.ai_outputs.get('subjective')
+                data = get_ai_output(file_path, 'subjective', force_vision)
                 if not data:
-                    if st.button("Generate Subjective"):
-                        with st.spinner("Creating questions..."):
-                            st.session_state.ai_outputs['subjective'] = generate_ai_content(file_path, "subjective", force_vision)
-                            st.rerun()
+                    if not show_ai_job('subjective') and st.button("Generate Subjective"): queue_ai_output(file_path, "subjective", force_vision)
                 elif isinstance(data, str) and (data.startswith("AI Failed") or data.startswith("⚠️ System Busy")):
                      st.error(data)
-                     if st.button("Regenerate Subjective"): del st.session_state.ai_outputs['subjective']; st.rerun()
+                     if not show_ai_job('subjective') and st.button("Regenerate Subjective"): queue_ai_output(file_path, "subjective", force_vision, refresh=True)
                 elif isinstance(data, list):
-                    for i, q in enumerate(data):
-                        st.markdown(f"**Q{i+1}: {q.get('question','?')}**")
-                        with st.expander("Show Model Answer"):
-                            st.write(q.get('model_answer','...'))
-                        st.divider()
-                    if st.button("Regenerate Subjective"): del st.session_state.ai_outputs['subjective']; st.rerun()
+                    render_subjective(data)
+                    if not show_ai_job('subjective') and st.button("Regenerate Subjective"): queue_ai_output(file_path, "subjective", force_vision, refresh=True)
                 else: st.error(data)
-                
\ No newline at end of file
+                
+
+profiler.end()
@@ -0,0 +1,86 @@
+import base64
+import hashlib
+import io
+import os
+import tempfile
+from functools import lru_cache
+from PIL import Image, ImageOps, UnidentifiedImageError
+import storage
+
+# --- PROFILE PICTURES ---
+# A picture is resized once, at upload, to fixed square JPEG thumbnail(s) stored under its SHA-256:
+# uploaded_notes/avatars/<first two hex>/<sha256>_<px>.jpg. users.avatar holds only the hash, so reading a
+# users row stays cheap. Pages read the few KB they show through an in-process cache. Files are content-addressed
+# and never rewritten, so a cached entry can't go stale.
+
+AVATAR_DIR = "avatars"
+SIZES = {'large': 320} # one entry per size some page shows; each upload writes all of them
+JPEG_QUALITY = 85
+CACHE_ENTRIES = 512
+
+
+def path(avatar, size='large'):
+    return os.path.join(storage.UPLOAD_FOLDER, AVATAR_DIR, avatar[:2], f"{avatar}_{SIZES[size]}.jpg")
+
+
+def _flatten(img):
+    # JPEG has no alpha: put transparent PNGs on white rather than the black convert("RGB") would give
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        bg = Image.new("RGB", img.size, "white")
+        bg.paste(img, mask=img.getchannel("A"))
+        return bg
+    return img.convert("RGB")
+
+
+def save(image_bytes):
+    """Store an uploaded picture as thumbnails; returns the avatar id for users.avatar. Raises ValueError if it isn't an image."""
+    avatar = hashlib.sha256(image_bytes).hexdigest()
+    if all(os.path.exists(path(avatar, s)) for s in SIZES): return avatar # same picture uploaded before
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        img.load()
+        img = _flatten(img)
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise ValueError(f"Not a usable image: {e}") from e
+    for size, px in SIZES.items():
+        final = path(avatar, size)
+        os.makedirs(os.path.dirname(final), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(final), prefix=".avatar-")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                ImageOps.fit(img, (px, px), Image.LANCZOS).save(out, "JPEG", quality=JPEG_QUALITY, optimize=True)
+            os.replace(tmp, final)
+        except BaseException:
+            if os.path.exists(tmp): os.remove(tmp)
+            raise
+    return avatar
+
+
+@lru_cache(maxsize=CACHE_ENTRIES)
+def _read(avatar, size):
+    with open(path(avatar, size), "rb") as f: return f.read()
+
+
+def thumbnail(avatar, size='large'):
+    """JPEG bytes of a stored avatar, or None if there is none (or its files are gone)."""
+    if not avatar: return None
+    try: return _read(avatar, size)
+    except OSError: return None
+
+
+def adopt_legacy(conn):
+    """Move base64 pictures out of users.profile_pic into thumbnails, inside the caller's transaction.
+    Pictures that don't decode are dropped. Returns (moved, dropped)."""
+    moved = dropped = 0
+    # one picture in memory at a time: they can be megabytes each
+    names = [r[0] for r in conn.execute("SELECT username FROM users WHERE profile_pic IS NOT NULL AND profile_pic != ''").fetchall()]
+    for username in names:
+        pic = conn.execute("SELECT profile_pic FROM users WHERE username = ?", (username,)).fetchone()[0]
+        try: avatar = save(base64.b64decode(pic, validate=True))
+        except ValueError: avatar = None # binascii.Error included
+        conn.execute("UPDATE users SET avatar = ?, profile_pic = NULL WHERE username = ?", (avatar, username))
+        if avatar: moved += 1
+        else: dropped += 1
+    return moved, dropped
@@ -0,0 +1,164 @@
+"""AI pipeline benchmark against the offline Gemini stand-in (ai_backend.FakeGenAI). No quota is spent.
+
+    python bench_ai.py --callers 8 --requests 40 --latency 0.8 --rate-429 0.05 --json bench_ai.json
+
+Runs each scenario with N concurrent callers: the doubt auto-answer, every Study Center task, the one-call
+study pack and main.py's verify_upload. Reports p50/p95/max latency, throughput, errors, model calls, 429s,
+retries and rate-limiter rejections. With --stream the doubt and Study Center calls stream their replies and the
+time to first content (ttfc) is reported as well. Everything runs against a throwaway database, so the app's DB and AI cache
+are untouched.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+STUDY = ['summary', 'mindmap', 'flashcard', 'mcq', 'subjective']
+SCENARIOS = ['doubt'] + STUDY + ['pack', 'verify']
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated subset of: " + ", ".join(SCENARIOS))
+    p.add_argument("--callers", type=int, default=8, help="concurrent callers per scenario")
+    p.add_argument("--requests", type=int, default=40, help="calls per scenario")
+    p.add_argument("--pdf", help="document for Study Center / verify scenarios (default: first PDF in the upload folder)")
+    p.add_argument("--vision", action="store_true", help="force the file-upload path for Study Center tasks")
+    p.add_argument("--cached", action="store_true", help="allow AI artifact cache hits (default: every call regenerates)")
+    p.add_argument("--stream", action="store_true", help="stream replies and measure time to first content")
+    p.add_argument("--latency", type=float, default=0.8, help="fake model latency in seconds (mean)")
+    p.add_argument("--jitter", type=float, default=0.3, help="latency stddev as a fraction of the mean")
+    p.add_argument("--rate-429", type=float, default=0.0, help="fraction of model calls that fail with 429")
+    p.add_argument("--processing", type=float, default=0.0, help="seconds an uploaded file stays PROCESSING")
+    p.add_argument("--rpm", type=float, help="rate limiter requests/min (default: IITCONNECT_AI_RPM)")
+    p.add_argument("--tpm", type=float, help="rate limiter tokens/min")
+    p.add_argument("--concurrency", type=int, help="rate limiter in-flight cap")
+    p.add_argument("--max-wait", type=float, help="rate limiter fail-fast threshold in seconds")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", help="also write results to this file")
+    return p.parse_args(argv)
+
+
+def configure_env(args):
+    # ai, ratelimit and db read their settings at import time, so this runs before importing them.
+    os.environ["IITCONNECT_AI_BACKEND"] = "fake"
+    os.environ.update(IITCONNECT_FAKE_LATENCY=str(args.latency), IITCONNECT_FAKE_JITTER=str(args.jitter),
+                      IITCONNECT_FAKE_429_RATE=str(args.rate_429), IITCONNECT_FAKE_PROCESSING=str(args.processing),
+                      IITCONNECT_FAKE_SEED=str(args.seed))
+    for value, var in ((args.rpm, "IITCONNECT_AI_RPM"), (args.tpm, "IITCONNECT_AI_TPM"),
+                       (args.concurrency, "IITCONNECT_AI_CONCURRENCY"), (args.max_wait, "IITCONNECT_AI_MAX_WAIT")):
+        if value is not None: os.environ[var] = str(value)
+    workdir = tempfile.mkdtemp(prefix="iitconnect-bench-")
+    os.environ["IITCONNECT_DB"] = os.path.join(workdir, "bench.db")
+    return workdir
+
+
+def find_pdf(folder):
+    for root, _, files in os.walk(folder):
+        for f in sorted(files):
+            if f.lower().endswith(".pdf"): return os.path.join(root, f)
+    return None
+
+
+def percentile(values, q):
+    if not values: return None
+    s = sorted(values)
+    k = (len(s) - 1) * q
+    lo = int(k); hi = min(lo + 1, len(s) - 1)
+    return s[lo] + (s[hi] - s[lo]) * (k - lo)
+
+
+def run_scenario(name, call, callers, requests, stream=False):
+    import ai_backend
+    import ratelimit
+    fake = ai_backend.load("fake")
+    rl0, fk0 = dict(ratelimit.stats()), dict(fake.counters)
+
+    def timed(i):
+        t0 = time.perf_counter()
+        first = []
+        on_text = (lambda text: first or first.append(time.perf_counter() - t0)) if stream else None
+        try: ok = call(i, on_text)
+        except Exception as e: ok = False; print(f"  {name}#{i}: {type(e).__name__}: {e}", file=sys.stderr)
+        return time.perf_counter() - t0, ok, first[0] if first else None
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=callers) as pool: results = list(pool.map(timed, range(requests)))
+    wall = time.perf_counter() - t0
+    rl1, fk1 = ratelimit.stats(), fake.counters
+    lat = [r[0] for r in results]
+    ttfc = [r[2] for r in results if r[2] is not None]
+    ms = lambda v: round(v * 1000, 1) if v is not None else None
+    return {'scenario': name, 'callers': callers, 'requests': requests, 'errors': sum(1 for r in results if not r[1]),
+            'p50_ms': ms(percentile(lat, 0.5)), 'p95_ms': ms(percentile(lat, 0.95)), 'max_ms': ms(max(lat) if lat else None),
+            'ttfc_p50_ms': ms(percentile(ttfc, 0.5)), 'ttfc_p95_ms': ms(percentile(ttfc, 0.95)),
+            'throughput_rps': round(requests / wall, 3) if wall else None, 'wall_s': round(wall, 3),
+            'model_calls': fk1['generate'] - fk0.get('generate', 0), 'uploads': fk1['upload'] - fk0.get('upload', 0),
+            'http_429': fk1['429'] - fk0.get('429', 0), 'retries': rl1.get('throttled', 0) - rl0.get('throttled', 0),
+            'rejected': rl1.get('rejected', 0) - rl0.get('rejected', 0)}
+
+
+def build_calls(args, pdf):
+    import ai
+    import ratelimit
+    refresh = not args.cached
+    ok = lambda r: bool(r) and not ai.is_ai_error(r)
+    calls = {
+        'doubt': lambda i, on_text: ok(ai.get_ai_response(f"Answer this academic doubt clearly: Benchmark question {i}\nDetails: Why does it work?",
+                                                          priority=ratelimit.BACKGROUND, on_text=on_text)),
+        'pack': lambda i, on_text: all(ok(v) for v in ai.generate_study_pack(pdf, args.vision, refresh=refresh).values()),
+    }
+    for task in STUDY:
+        calls[task] = lambda i, on_text, task=task: ok(ai.generate_ai_content(pdf, task, args.vision, refresh=refresh, on_text=on_text))
+
+    def verify(i, on_text):
+        import main # FastAPI + Supabase app; only imported for this scenario
+        upload = SimpleNamespace(filename=f"bench_{i}_{os.path.basename(pdf)}", file=open(pdf, "rb"))
+        try: return 'ai_response' in asyncio.run(main.verify_upload("Benchmark Course", upload))
+        finally: upload.file.close()
+    calls['verify'] = verify
+    return calls
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    repo = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, repo)
+    pdf = os.path.abspath(args.pdf) if args.pdf else find_pdf(os.path.join(repo, "uploaded_notes"))
+    out = os.path.abspath(args.json) if args.json else None
+    workdir = configure_env(args)
+    os.chdir(workdir) # verify_upload writes temp_<name> into the working directory
+
+    import ai
+    import db
+    db.migrate()
+    ai.configure("offline-benchmark")
+    calls = build_calls(args, pdf)
+
+    results = []
+    for name in [s.strip() for s in args.scenarios.split(",") if s.strip()]:
+        if name not in calls: print(f"Unknown scenario '{name}'", file=sys.stderr); continue
+        if name != 'doubt' and not pdf: print(f"Skipping {name}: no PDF (pass --pdf)", file=sys.stderr); continue
+        if name == 'verify':
+            try: import main as _ # noqa: F401
+            except ImportError as e: print(f"Skipping verify: {e}", file=sys.stderr); continue
+        print(f"Running {name} ({args.requests} calls, {args.callers} callers)...", file=sys.stderr)
+        results.append(run_scenario(name, calls[name], args.callers, args.requests, args.stream))
+
+    cols = ['scenario', 'errors', 'p50_ms', 'p95_ms', 'max_ms', 'ttfc_p50_ms', 'throughput_rps', 'model_calls', 'uploads', 'http_429', 'retries', 'rejected']
+    print(" ".join(f"{c:>14}" for c in cols))
+    for r in results: print(" ".join(f"{str(r[c]):>14}" for c in cols))
+    if out:
+        config = {k: v for k, v in vars(args).items() if k != 'json'}
+        with open(out, "w") as f: json.dump({'config': dict(config, pdf=pdf), 'results': results}, f, indent=2)
+        print(f"Wrote {out}", file=sys.stderr)
+    return results
+
+
+if __name__ == "__main__":
+    main()
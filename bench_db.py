@@ -0,0 +1,181 @@
+"""Database micro-benchmarks for the data helpers behind the Feed, Folders, search, comments, votes, Profile and Leaderboard.
+
+    python bench_db.py --sizes tiny,small --json bench_db.json
+    python bench_db.py --sizes tiny,small --data-dir bench-data --compare bench_db.json
+
+For each size (a seed_data.py preset) it builds a synthetic database, or reuses one from --data-dir, then times every
+helper over --repeat calls with varying arguments (popular and long-tail users, notes and search terms) and reports
+p50/p95/max in ms with calls/s. --json writes machine-readable results; --compare prints the p50/p95 change against an
+earlier --json run, so a schema or index change can be judged by the numbers. Each vote call is a pair of votes that
+puts the voter's original vote (up, down or none) back, leaving the data as it was.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import db
+import seed_data
+from bench_ai import percentile
+
+# Each op is named after the app.py helper (or page query) it stands for.
+OPS = ['search_notes', 'feed_page', 'feed_deep_page', 'folder_page', 'tag_page', 'render_comments', 'handle_vote',
+       'get_user_stats_detailed', 'leaderboard', 'notifications', 'trending_tags']
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("--sizes", default="tiny,small", help="comma-separated seed_data presets: " + ", ".join(seed_data.PRESETS))
+    p.add_argument("--ops", default=",".join(OPS), help="comma-separated subset of: " + ", ".join(OPS))
+    p.add_argument("--repeat", type=int, default=200, help="timed calls per op")
+    p.add_argument("--warmup", type=int, default=10, help="untimed calls per op first")
+    p.add_argument("--data-dir", help="keep generated databases here and reuse them on later runs (default: a temp dir)")
+    p.add_argument("--seed", type=int, default=seed_data.DEFAULTS['seed'])
+    p.add_argument("--json", help="also write results to this file")
+    p.add_argument("--compare", help="earlier --json output to diff against")
+    return p.parse_args(argv)
+
+
+def dataset(size, data_dir, seed):
+    path = os.path.join(data_dir, f"{size}-seed{seed}.db")
+    if os.path.exists(path):
+        print(f"Reusing {path}", file=sys.stderr)
+        db.migrate(path)
+    else:
+        print(f"Generating {size} dataset in {path}...", file=sys.stderr)
+        seed_data.generate(path, **seed_data.PRESETS[size], seed=seed, log=lambda msg: print(msg, file=sys.stderr))
+    return path
+
+
+def samples(path, rng, n):
+    """Arguments for n calls: a mix of the most active users / busiest items and uniformly random ones."""
+    q = lambda sql, *params: [r[0] for r in db.query(sql, params, path)]
+    heavy_users = q("SELECT username FROM users ORDER BY posts_count + answers_count DESC LIMIT 20")
+    users = q("SELECT username FROM users")
+    threads = q("SELECT target_id FROM comments WHERE target_type = 'NOTE' GROUP BY target_id ORDER BY COUNT(*) DESC LIMIT 200")
+    note_ids = q("SELECT id FROM notes")
+    stamps = db.query("SELECT timestamp, id FROM notes", path=path)
+    tags = q("SELECT tag FROM tag_counts ORDER BY count DESC LIMIT 50")
+    vocab = seed_data.WORDS
+    mix = lambda hot, cold: [rng.choice(hot if hot and rng.random() < 0.5 else cold) for _ in range(n)]
+    return {
+        'users': mix(heavy_users, users),
+        'terms': [" ".join(rng.sample(vocab, rng.randint(1, 2))) if rng.random() < 0.7 else rng.choice(vocab)[:3] for _ in range(n)],
+        'cursors': [tuple(rng.choice(stamps)) for _ in range(n)],
+        'subjects': [(rng.choice(seed_data.SUBJECTS), rng.choice(["RESOURCE", "DOUBT"])) for _ in range(n)],
+        'tags': [rng.choice(tags) if tags else None for _ in range(n)],
+        'thread_pages': [rng.sample(threads, min(len(threads), 5)) + rng.sample(note_ids, 15) for _ in range(n)],
+        'vote_items': mix(threads, note_ids),
+    }
+
+
+def vote_pairs(path, users, items):
+    """Two directions per (voter, item) that end on the voter's current vote: none/up -> +1, +1; down -> +1, -1."""
+    current = {(r['user'], r['item_id']): r['vote_type'] for r in
+               db.query("SELECT user, item_id, vote_type FROM votes WHERE item_type = 'NOTE'", path=path)}
+    return [(1, -1) if current.get((u, i)) == -1 else (1, 1) for u, i in zip(users, items)]
+
+
+def walk(thread, parent_id=None, level=0):
+    # render_comments' traversal without Streamlit: same depth cap, counts what would be drawn
+    if level > 3: return 0
+    return sum(1 + walk(thread, c['id'], level + 1) for c in thread.get(parent_id, []))
+
+
+def build_ops(path, s):
+    def feed(i, cursor=None):
+        rows, _ = db.notes_page(cursor, path=path)
+        db.hydrate_feed(rows, s['users'][i], path)
+        return len(rows)
+
+    def render_comments(i):
+        threads = db.comment_threads(s['thread_pages'][i], "NOTE", path)
+        return sum(walk(t) for t in threads.values())
+
+    pairs = vote_pairs(path, s['users'], s['vote_items'])
+
+    def vote(i):
+        # two write transactions that restore the voter's original vote: no net change to the data
+        item, voter = s['vote_items'][i], s['users'][i]
+        first, second = pairs[i]
+        d = db.apply_vote(item, "NOTE", voter, first, path)
+        db.apply_vote(item, "NOTE", voter, second, path)
+        return abs(d)
+
+    return {
+        'search_notes': lambda i: len(db.search_notes(s['terms'][i], path=path)),
+        'feed_page': feed,
+        'feed_deep_page': lambda i: feed(i, s['cursors'][i]),
+        'folder_page': lambda i: len(db.notes_page(None, subject=s['subjects'][i][0], post_type=s['subjects'][i][1], path=path)[0]),
+        'tag_page': lambda i: len(db.notes_page(None, tag=s['tags'][i], path=path)[0]),
+        'render_comments': render_comments,
+        'handle_vote': vote,
+        'get_user_stats_detailed': lambda i: sum(db.user_stats(s['users'][i], path)[1:]),
+        'leaderboard': lambda i: len(db.leaderboard(10, path)),
+        'notifications': lambda i: db.unread_notifications(s['users'][i], path=path)[0],
+        'trending_tags': lambda i: len(db.trending_tags(24 * 7, half_life_hours=48, path=path)),
+    }
+
+
+def run_op(name, call, repeat, warmup):
+    for i in range(min(warmup, repeat)): call(i)
+    lat, rows = [], 0
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        rows += call(i) or 0
+        lat.append(time.perf_counter() - t0)
+    ms = lambda v: round(v * 1000, 3)
+    total = sum(lat)
+    return {'op': name, 'calls': repeat, 'p50_ms': ms(percentile(lat, 0.5)), 'p95_ms': ms(percentile(lat, 0.95)),
+            'max_ms': ms(max(lat)), 'mean_ms': ms(total / repeat), 'calls_per_s': round(repeat / total, 1) if total else None,
+            'rows_per_call': round(rows / repeat, 1)}
+
+
+def compare(results, old_path):
+    with open(old_path) as f: old = {(r['size'], r['op']): r for r in json.load(f)['results']}
+    print(f"\nvs {old_path}:")
+    print(" ".join(f"{c:>14}" for c in ['size', 'op', 'p50_ms', 'was', 'change', 'p95_ms', 'was', 'change']))
+    pct = lambda new, was: f"{(new - was) / was * 100:+.0f}%" if was else "n/a"
+    for r in results:
+        o = old.get((r['size'], r['op']))
+        if not o: continue
+        print(" ".join(f"{str(v):>14}" for v in [r['size'], r['op'][:14], r['p50_ms'], o['p50_ms'], pct(r['p50_ms'], o['p50_ms']),
+                                                  r['p95_ms'], o['p95_ms'], pct(r['p95_ms'], o['p95_ms'])]))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="iitconnect-benchdb-")
+    os.makedirs(data_dir, exist_ok=True)
+    ops = [o.strip() for o in args.ops.split(",") if o.strip()]
+    results, datasets = [], {}
+    for size in [s.strip() for s in args.sizes.split(",") if s.strip()]:
+        if size not in seed_data.PRESETS: print(f"Unknown size '{size}'", file=sys.stderr); continue
+        path = dataset(size, data_dir, args.seed)
+        datasets[size] = seed_data.counts(path)
+        calls = build_ops(path, samples(path, random.Random(args.seed), args.repeat))
+        for name in ops:
+            if name not in calls: print(f"Unknown op '{name}'", file=sys.stderr); continue
+            print(f"Running {name} on {size} ({args.repeat} calls)...", file=sys.stderr)
+            results.append(dict(size=size, **run_op(name, calls[name], args.repeat, args.warmup)))
+
+    cols = ['size', 'op', 'p50_ms', 'p95_ms', 'max_ms', 'calls_per_s', 'rows_per_call']
+    print(" ".join(f"{c:>14}" for c in cols))
+    for r in results: print(" ".join(f"{str(r[c])[:14]:>14}" for c in cols))
+    if args.compare: compare(results, args.compare)
+    if args.json:
+        env = {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version, 'schema_version': db.SCHEMA_VERSION,
+               'platform': platform.platform(), 'run_at': db.now()}
+        config = {k: v for k, v in vars(args).items() if k not in ('json', 'compare')}
+        with open(args.json, "w") as f: json.dump({'config': config, 'environment': env, 'datasets': datasets, 'results': results}, f, indent=2)
+        print(f"Wrote {args.json}", file=sys.stderr)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,783 @@
+import os
+import queue
+import random
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+import profiler
+
+# --- SHARED SQLITE ACCESS LAYER ---
+# One pool per process. Every data helper in app.py borrows a connection from here
+# instead of calling sqlite3.connect() itself, so a feed render reuses a handful of
+# handles and concurrent Streamlit sessions share WAL readers instead of fighting over locks.
+
+DB_NAME = os.environ.get("IITCONNECT_DB", "iitconnect_v52.db")
+POOL_SIZE = int(os.environ.get("IITCONNECT_DB_POOL", "8"))
+BUSY_TIMEOUT_MS = 5000
+POOL_WAIT_S = 30
+LOCK_RETRIES = 5
+LOCK_BASE_DELAY = 0.05
+
+
+def is_lock_error(e):
+    msg = str(e).lower()
+    return isinstance(e, sqlite3.OperationalError) and ("locked" in msg or "busy" in msg)
+
+
+def with_retry(fn, retries=LOCK_RETRIES, base_delay=LOCK_BASE_DELAY):
+    """Run fn(), retrying a bounded number of times on 'database is locked'."""
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except sqlite3.OperationalError as e:
+            if not is_lock_error(e) or attempt == retries: raise
+            time.sleep(base_delay * (2 ** attempt) * (0.5 + random.random()))
+
+
+class ConnectionPool:
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # isolation_level=None: autocommit for reads, explicit BEGIN IMMEDIATE for writes (see transaction()).
+        # Profiled connections time every statement for the Admin panel's query report (see profiler.py).
+        factory = profiler.ProfiledConnection if profiler.ENABLED else sqlite3.Connection
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None, check_same_thread=False, factory=factory)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        with_retry(lambda: conn.execute("PRAGMA journal_mode = WAL"))
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+
+    def acquire(self):
+        try: return self._idle.get_nowait()
+        except queue.Empty: pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try: return self._connect()
+                except Exception:
+                    self._created -= 1; raise
+        try: return self._idle.get(timeout=POOL_WAIT_S)
+        except queue.Empty: raise sqlite3.OperationalError("database pool exhausted")
+
+    def release(self, conn):
+        if conn.in_transaction:
+            try: conn.rollback()
+            except sqlite3.Error:
+                conn.close()
+                with self._lock: self._created -= 1
+                return
+        self._idle.put(conn)
+
+    def close_all(self):
+        while True:
+            try: self._idle.get_nowait().close()
+            except queue.Empty: break
+        with self._lock: self._created = 0
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path=None):
+    path = path or DB_NAME
+    with _pools_lock:
+        pool = _pools.get(path)
+        # A forked child must not reuse the parent's sqlite handles.
+        if pool is None or pool.pid != os.getpid():
+            pool = _pools[path] = ConnectionPool(path)
+        return pool
+
+
+@contextmanager
+def connection(path=None):
+    pool = get_pool(path)
+    conn = pool.acquire()
+    try: yield conn
+    finally: pool.release(conn)
+
+
+@contextmanager
+def transaction(path=None):
+    """Borrow a connection and hold the write lock for the block; commits on success, rolls back on error."""
+    with connection(path) as conn:
+        with_retry(lambda: conn.execute("BEGIN IMMEDIATE"))
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback(); raise
+        else:
+            conn.commit()
+
+
+def query(sql, params=(), path=None):
+    with connection(path) as conn:
+        return with_retry(lambda: conn.execute(sql, params).fetchall())
+
+
+def query_one(sql, params=(), path=None):
+    with connection(path) as conn:
+        return with_retry(lambda: conn.execute(sql, params).fetchone())
+
+
+def execute(sql, params=(), path=None):
+    """Single write statement in its own transaction. Returns the cursor's lastrowid."""
+    def run():
+        with transaction(path) as conn: return conn.execute(sql, params).lastrowid
+    return with_retry(run)
+
+
+def now():
+    """Timestamps are stored as integer unix epochs (see migration 2)."""
+    return int(time.time())
+
+
+# --- SCHEMA MIGRATIONS ---
+# Keyed on PRAGMA user_version. Each entry runs once, inside its own write transaction,
+# and bumps user_version in the same transaction so a crash never leaves a half-applied step.
+# Append new migrations to the end; never edit one that has shipped.
+
+TIMESTAMP_TABLES = ["notes", "comments", "answers", "bookmarks", "notifications", "course_requests", "reports", "follows"]
+
+
+def _m001_baseline(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS notes (id INTEGER PRIMARY KEY, uploader TEXT, subject TEXT, title TEXT, filename TEXT, upvotes INTEGER, is_verified INTEGER, tags TEXT, timestamp DATETIME, content TEXT, post_type TEXT)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS comments (id INTEGER PRIMARY KEY, target_id INTEGER, target_type TEXT, parent_id INTEGER, user TEXT, comment TEXT, timestamp DATETIME)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS answers (id INTEGER PRIMARY KEY, doubt_id INTEGER, responder TEXT, answer_text TEXT, upvotes INTEGER, timestamp DATETIME)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT, posts_count INTEGER DEFAULT 0, answers_count INTEGER DEFAULT 0, upvotes_received INTEGER DEFAULT 0, reputation INTEGER DEFAULT 0, full_name TEXT, college TEXT, year TEXT, branch TEXT, age TEXT, gender TEXT, bio TEXT, profile_pic TEXT, is_active INTEGER DEFAULT 1)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS votes (user TEXT, item_id INTEGER, item_type TEXT, vote_type INTEGER, PRIMARY KEY (user, item_id, item_type))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS bookmarks (user TEXT, note_id INTEGER, timestamp DATETIME, PRIMARY KEY (user, note_id))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS notifications (id INTEGER PRIMARY KEY, user TEXT, message TEXT, is_read INTEGER DEFAULT 0, timestamp DATETIME)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS course_requests (id INTEGER PRIMARY KEY, user TEXT, course_name TEXT, reason TEXT, timestamp DATETIME)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS reports (id INTEGER PRIMARY KEY, reporter TEXT, post_id INTEGER, reason TEXT, details TEXT, status TEXT DEFAULT 'Pending', timestamp DATETIME)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS follows (follower TEXT, followee TEXT, timestamp DATETIME, PRIMARY KEY (follower, followee))''')
+
+
+def _m002_epoch_timestamps(conn):
+    # Older rows hold str(datetime.now()) in local time, e.g. '2025-12-25 13:31:06.009462'.
+    for table in TIMESTAMP_TABLES:
+        conn.execute(f"""UPDATE {table} SET timestamp = CAST(strftime('%s', timestamp, 'utc') AS INTEGER)
+                         WHERE typeof(timestamp) = 'text' AND strftime('%s', timestamp, 'utc') IS NOT NULL""")
+
+
+def _m003_hot_path_indexes(conn):
+    # Feed / course folders: WHERE subject=? AND post_type=? ORDER BY timestamp DESC
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_notes_subject_type_ts ON notes(subject, post_type, timestamp DESC, id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_notes_ts ON notes(timestamp DESC, id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_notes_uploader_type ON notes(uploader, post_type)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_answers_doubt ON answers(doubt_id, upvotes DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_answers_responder ON answers(responder)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_comments_target ON comments(target_id, target_type, parent_id, timestamp)")
+    # Unread badge count is answered from the partial index alone; the dropdown list from the second one.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_unread ON notifications(user) WHERE is_read = 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_user_ts ON notifications(user, timestamp DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_follows_followee ON follows(followee, follower)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_votes_item ON votes(item_id, item_type, vote_type)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookmarks_note ON bookmarks(note_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_reputation ON users(reputation DESC)")
+
+
+def _m004_fulltext_search(conn):
+    # Extracted PDF text lives beside notes (not in it) so SELECT * on the feed stays light.
+    conn.execute("CREATE TABLE IF NOT EXISTS note_text (note_id INTEGER PRIMARY KEY, body TEXT)")
+    # rowid == notes.id. prefix='2 3' keeps as-you-type prefix queries on the index instead of a term scan.
+    conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+                        title, tags, content, pdf_text, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS notes_fts_ai AFTER INSERT ON notes BEGIN
+                        INSERT INTO notes_fts(rowid, title, tags, content, pdf_text)
+                        VALUES (new.id, new.title, new.tags, new.content, (SELECT body FROM note_text WHERE note_id = new.id));
+                    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS notes_fts_au AFTER UPDATE OF title, tags, content ON notes BEGIN
+                        UPDATE notes_fts SET title = new.title, tags = new.tags, content = new.content WHERE rowid = new.id;
+                    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS notes_fts_ad AFTER DELETE ON notes BEGIN
+                        DELETE FROM notes_fts WHERE rowid = old.id;
+                        DELETE FROM note_text WHERE note_id = old.id;
+                    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS note_text_ai AFTER INSERT ON note_text BEGIN
+                        UPDATE notes_fts SET pdf_text = new.body WHERE rowid = new.note_id;
+                    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS note_text_au AFTER UPDATE ON note_text BEGIN
+                        UPDATE notes_fts SET pdf_text = new.body WHERE rowid = new.note_id;
+                    END""")
+    conn.execute("DELETE FROM notes_fts")
+    conn.execute("""INSERT INTO notes_fts(rowid, title, tags, content, pdf_text)
+                    SELECT n.id, n.title, n.tags, n.content, t.body FROM notes n LEFT JOIN note_text t ON t.note_id = n.id""")
+
+
+def _m005_search_rank(conn):
+    # Persist the weighted BM25 as the table's rank function so ORDER BY rank uses FTS5's fast path
+    # and (rank, rowid) can serve as a keyset cursor for paging search results.
+    conn.execute("INSERT INTO notes_fts(notes_fts, rank) VALUES ('rank', 'bm25(10.0, 6.0, 2.0, 1.0)')")
+
+
+def _m006_tag_counters(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS tag_counts (tag TEXT PRIMARY KEY, count INTEGER NOT NULL DEFAULT 0)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tag_counts_count ON tag_counts(count DESC, tag)")
+    # Hourly buckets for windowed trending (see trending_tags); pruned past TREND_KEEP_HOURS.
+    conn.execute("CREATE TABLE IF NOT EXISTS tag_trend (tag TEXT, bucket INTEGER, count INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (tag, bucket))")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tag_trend_bucket ON tag_trend(bucket)")
+    # Filled by migration 7, which rebuilds both tables from note_tags.
+
+
+def _m007_note_tags(conn):
+    # Tags parsed once on write. ts mirrors notes.timestamp so a tag filter pages straight off the index.
+    conn.execute("""CREATE TABLE IF NOT EXISTS note_tags (note_id INTEGER NOT NULL, tag TEXT NOT NULL, ts INTEGER,
+                                                         PRIMARY KEY (note_id, tag)) WITHOUT ROWID""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_note_tags_tag_ts ON note_tags(tag, ts DESC, note_id DESC)")
+    # tag_counts / tag_trend now follow note_tags, so every path that (re)tags or deletes a note keeps them right.
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS note_tags_ai AFTER INSERT ON note_tags BEGIN
+                        INSERT INTO tag_counts (tag, count) VALUES (new.tag, 1)
+                            ON CONFLICT(tag) DO UPDATE SET count = count + 1;
+                        INSERT INTO tag_trend (tag, bucket, count) VALUES (new.tag, new.ts / 3600, 1)
+                            ON CONFLICT(tag, bucket) DO UPDATE SET count = count + 1;
+                    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS note_tags_ad AFTER DELETE ON note_tags BEGIN
+                        UPDATE tag_counts SET count = count - 1 WHERE tag = old.tag;
+                        UPDATE tag_trend SET count = count - 1 WHERE tag = old.tag AND bucket = old.ts / 3600;
+                        DELETE FROM tag_counts WHERE tag = old.tag AND count <= 0;
+                        DELETE FROM tag_trend WHERE tag = old.tag AND count <= 0;
+                    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS notes_tags_ad AFTER DELETE ON notes BEGIN
+                        DELETE FROM note_tags WHERE note_id = old.id;
+                    END""")
+    conn.execute("DELETE FROM tag_counts"); conn.execute("DELETE FROM tag_trend"); conn.execute("DELETE FROM note_tags")
+    for r in conn.execute("SELECT id, tags, timestamp FROM notes").fetchall():
+        set_note_tags(conn, r[0], r[1], r[2])
+
+
+def _m008_fanout_on_read(conn):
+    # One row per post from a heavily-followed author; followers see it at read time (see unread_notifications).
+    conn.execute("CREATE TABLE IF NOT EXISTS broadcasts (note_id INTEGER PRIMARY KEY, author TEXT, message TEXT, timestamp INTEGER)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_author_ts ON broadcasts(author, timestamp DESC)")
+    conn.execute("CREATE TABLE IF NOT EXISTS notification_cursor (user TEXT PRIMARY KEY, read_ts INTEGER NOT NULL DEFAULT 0)")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS notes_broadcasts_ad AFTER DELETE ON notes BEGIN
+                        DELETE FROM broadcasts WHERE note_id = old.id;
+                    END""")
+
+
+def _m009_document_pages(conn):
+    # Extracted PDF text, one row per page, keyed by the file's SHA-256 so identical files share it.
+    conn.execute("""CREATE TABLE IF NOT EXISTS documents (hash TEXT PRIMARY KEY, pages INTEGER, chars INTEGER,
+                                                         text_pages INTEGER, extracted_at INTEGER)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS document_pages (hash TEXT, page_no INTEGER, chars INTEGER, text TEXT,
+                                                              PRIMARY KEY (hash, page_no)) WITHOUT ROWID""")
+
+
+def _m010_blob_store(conn):
+    # Content-addressed uploads: notes.filename points at blobs/<aa>/<sha256>.<ext>; the name the user uploaded is kept for display.
+    conn.execute("CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, path TEXT, size INTEGER, created_at INTEGER)")
+    conn.execute("ALTER TABLE notes ADD COLUMN original_name TEXT")
+
+
+def _m011_ai_artifacts(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS ai_artifacts (key TEXT PRIMARY KEY, content_hash TEXT, task_type TEXT, model TEXT,
+                                                            prompt_version INTEGER, payload TEXT, size INTEGER,
+                                                            created_at INTEGER, last_used INTEGER, hits INTEGER DEFAULT 0)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_artifacts_lru ON ai_artifacts(last_used)")
+    conn.execute("CREATE TABLE IF NOT EXISTS ai_cache_stats (event TEXT PRIMARY KEY, count INTEGER NOT NULL DEFAULT 0)")
+
+
+def _m012_ai_jobs(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS ai_jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, payload TEXT,
+                                                       dedupe_key TEXT, priority INTEGER NOT NULL DEFAULT 1,
+                                                       status TEXT NOT NULL DEFAULT 'queued', attempts INTEGER NOT NULL DEFAULT 0,
+                                                       max_attempts INTEGER NOT NULL DEFAULT 3, run_after INTEGER NOT NULL,
+                                                       lease_until INTEGER, worker TEXT, result TEXT, error TEXT,
+                                                       created_at INTEGER, updated_at INTEGER)""")
+    # Claim order for workers; 'running' rows stay in it so expired leases (crashed workers) get picked up again.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_jobs_ready ON ai_jobs(status, priority, run_after, id)")
+    # At most one live job per dedupe key: double-clicks and concurrent viewers share the same job.
+    conn.execute("""CREATE UNIQUE INDEX IF NOT EXISTS idx_ai_jobs_live ON ai_jobs(dedupe_key)
+                    WHERE dedupe_key IS NOT NULL AND status IN ('queued', 'running')""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_jobs_key ON ai_jobs(dedupe_key, id DESC)")
+
+
+def _m013_gemini_files(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS gemini_files (content_hash TEXT PRIMARY KEY, name TEXT NOT NULL, mime_type TEXT,
+                                                            uploaded_at INTEGER, expires_at INTEGER, uses INTEGER DEFAULT 0)""")
+
+
+def _m014_job_progress(conn):
+    # Partial model output of a running job (streamed replies), shown live by the UI; cleared when the job finishes.
+    conn.execute("ALTER TABLE ai_jobs ADD COLUMN progress TEXT")
+
+
+def _m015_avatars(conn):
+    # Profile pictures leave the users row. users.avatar names resized thumbnail files (see avatars.py), and
+    # existing base64 profile_pic values are converted and cleared. The column stays, NULL, so older SQLite
+    # builds without DROP COLUMN can still migrate.
+    conn.execute("ALTER TABLE users ADD COLUMN avatar TEXT")
+    if conn.execute("SELECT 1 FROM users WHERE profile_pic IS NOT NULL AND profile_pic != '' LIMIT 1").fetchone():
+        import avatars # imported here: it needs Pillow and imports storage, which imports this module
+        avatars.adopt_legacy(conn)
+
+
+def _m016_broadcast_read_id(conn):
+    # Broadcasts are marked read up to a note id, not a whole second: one posted in the same second as
+    # mark-read stays unread. read_ts stays as the lower bound for the (author, timestamp) index range.
+    conn.execute("ALTER TABLE notification_cursor ADD COLUMN read_id INTEGER NOT NULL DEFAULT 0")
+    conn.execute("UPDATE notification_cursor SET read_id = COALESCE((SELECT MAX(note_id) FROM broadcasts WHERE timestamp <= read_ts), 0)")
+
+
+def _m017_broadcast_seq(conn):
+    # Note ids can be reused (notes.id has no AUTOINCREMENT: deleting the newest note frees its id), so they can't
+    # mark what has been read. Broadcasts get their own never-reused seq, and read_id is converted to it.
+    conn.execute("DROP TRIGGER IF EXISTS notes_broadcasts_ad") # re-created below; a rename must not see it point at a missing table
+    conn.execute("""CREATE TABLE broadcasts_new (seq INTEGER PRIMARY KEY AUTOINCREMENT, note_id INTEGER NOT NULL UNIQUE,
+                                                 author TEXT, message TEXT, timestamp INTEGER)""")
+    conn.execute("""INSERT INTO broadcasts_new (note_id, author, message, timestamp)
+                    SELECT note_id, author, message, timestamp FROM broadcasts ORDER BY note_id""")
+    conn.execute("""UPDATE notification_cursor SET read_id = COALESCE((SELECT MAX(seq) FROM broadcasts_new WHERE note_id <= read_id), 0)""")
+    conn.execute("DROP TABLE broadcasts")
+    conn.execute("ALTER TABLE broadcasts_new RENAME TO broadcasts")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_author_ts ON broadcasts(author, timestamp DESC)")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS notes_broadcasts_ad AFTER DELETE ON notes BEGIN
+                        DELETE FROM broadcasts WHERE note_id = old.id;
+                    END""")
+
+
+MIGRATIONS = [
+    (1, _m001_baseline),
+    (2, _m002_epoch_timestamps),
+    (3, _m003_hot_path_indexes),
+    (4, _m004_fulltext_search),
+    (5, _m005_search_rank),
+    (6, _m006_tag_counters),
+    (7, _m007_note_tags),
+    (8, _m008_fanout_on_read),
+    (9, _m009_document_pages),
+    (10, _m010_blob_store),
+    (11, _m011_ai_artifacts),
+    (12, _m012_ai_jobs),
+    (13, _m013_gemini_files),
+    (14, _m014_job_progress),
+    (15, _m015_avatars),
+    (16, _m016_broadcast_read_id),
+    (17, _m017_broadcast_seq),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+_migrated = set()
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(path=None):
+    """Bring the database at `path` up to SCHEMA_VERSION. Safe to call on every rerun."""
+    path = path or DB_NAME
+    if path in _migrated: return
+    with connection(path) as conn:
+        for version, step in MIGRATIONS:
+            if schema_version(conn) >= version: continue
+            with_retry(lambda: conn.execute("BEGIN IMMEDIATE"))
+            try:
+                # Re-check under the write lock: another process may have applied it meanwhile.
+                if schema_version(conn) < version:
+                    step(conn)
+                    conn.execute(f"PRAGMA user_version = {version}")
+                conn.commit()
+            except BaseException:
+                conn.rollback(); raise
+        conn.execute("PRAGMA optimize")
+    _migrated.add(path)
+
+
+# --- KEYSET PAGINATION ---
+# Listings page on a (sort key, id) cursor instead of OFFSET, so page N costs the same as page 1.
+# A page function returns (rows, next_cursor); next_cursor is None on the last page.
+PAGE_SIZE = 20
+
+
+def _page(sql, params, cursor, limit, key, pk, desc=True, path=None):
+    """`sql` must end in a WHERE clause; key/pk are the sort expressions (also selected as cursor_key/cursor_id)."""
+    params = list(params)
+    if cursor:
+        sql += f" AND ({key}, {pk}) {'<' if desc else '>'} (?, ?)"; params += list(cursor)
+    order = "DESC" if desc else "ASC"
+    sql += f" ORDER BY {key} {order}, {pk} {order} LIMIT ?"; params.append(limit + 1)
+    rows = query(sql, params, path)
+    if len(rows) <= limit: return rows, None
+    rows = rows[:limit]
+    return rows, (rows[-1]['cursor_key'], rows[-1]['cursor_id'])
+
+
+def notes_page(cursor=None, limit=PAGE_SIZE, subject=None, post_type=None, tag=None, path=None):
+    if tag:
+        # Exact tag match paged straight off note_tags(tag, ts) -- '#Exam' no longer matches '#ExamPrep'.
+        sql = """SELECT notes.*, nt.ts AS cursor_key, nt.note_id AS cursor_id
+                 FROM note_tags nt JOIN notes ON notes.id = nt.note_id WHERE nt.tag = ?"""
+        params, key, pk = [tag], "nt.ts", "nt.note_id"
+    else:
+        sql = "SELECT notes.*, timestamp AS cursor_key, id AS cursor_id FROM notes WHERE 1"
+        params, key, pk = [], "timestamp", "id"
+    if subject: sql += " AND notes.subject = ?"; params.append(subject)
+    if post_type: sql += " AND notes.post_type = ?"; params.append(post_type)
+    return _page(sql, params, cursor, limit, key, pk, path=path)
+
+
+def bookmarks_page(user, cursor=None, limit=PAGE_SIZE, path=None):
+    # Most recently saved first.
+    sql = """SELECT notes.*, b.timestamp AS cursor_key, b.note_id AS cursor_id
+             FROM bookmarks b JOIN notes ON notes.id = b.note_id WHERE b.user = ?"""
+    return _page(sql, [user], cursor, limit, "b.timestamp", "b.note_id", path=path)
+
+
+# --- COMMENT THREADS ---
+# Whole threads are fetched in one indexed query and grouped in memory: {target_id: {parent_id: [comments]}}.
+# Top-level comments sit under parent_id None.
+
+def _group_comments(rows):
+    threads = {}
+    for r in rows: threads.setdefault(r['target_id'], {}).setdefault(r['parent_id'], []).append(r)
+    return threads
+
+
+def comment_threads(target_ids, target_type, path=None):
+    ids = list(target_ids)
+    if not ids: return {}
+    rows = query(f"SELECT * FROM comments WHERE target_type = ? AND target_id IN ({','.join('?' * len(ids))}) ORDER BY timestamp, id",
+                 [target_type, *ids], path)
+    return _group_comments(rows)
+
+
+# --- FEED PAGE HYDRATION ---
+# Everything render_feed_item needs beyond the note row, fetched for a whole page in a fixed
+# number of set-based queries (7, whatever the page size) instead of per item.
+
+def _in(values):
+    return ",".join("?" * len(values))
+
+
+def hydrate_feed(notes, viewer, path=None):
+    note_ids = [n['id'] for n in notes]
+    doubt_ids = [n['id'] for n in notes if n['post_type'] == "DOUBT"]
+    uploaders = sorted({n['uploader'] for n in notes if n['uploader'] != "Anonymous"})
+    page = {'reputation': {}, 'answers': {}, 'threads': {"NOTE": {}, "ANSWER": {}}, 'votes': {}, 'bookmarks': set(), 'drafts': {}}
+    if not note_ids: return page
+    with connection(path) as conn:
+        if uploaders:
+            for r in conn.execute(f"SELECT username, reputation FROM users WHERE username IN ({_in(uploaders)})", uploaders):
+                page['reputation'][r['username']] = r['reputation']
+        answer_ids = []
+        if doubt_ids:
+            for a in conn.execute(f"SELECT * FROM answers WHERE doubt_id IN ({_in(doubt_ids)}) ORDER BY upvotes DESC, id", doubt_ids):
+                page['answers'].setdefault(a['doubt_id'], []).append(a); answer_ids.append(a['id'])
+            # AI Tutor answers still being drafted (queued or streaming), doubt id -> job id
+            keys = [f"doubt:{i}" for i in doubt_ids]
+            for r in conn.execute(f"SELECT id, dedupe_key FROM ai_jobs WHERE dedupe_key IN ({_in(keys)}) AND status IN ('queued', 'running')", keys):
+                page['drafts'][int(r['dedupe_key'].split(':')[1])] = r['id']
+        for target_type, ids in (("NOTE", note_ids), ("ANSWER", answer_ids)):
+            if not ids: continue
+            rows = conn.execute(f"SELECT * FROM comments WHERE target_type = ? AND target_id IN ({_in(ids)}) ORDER BY timestamp, id",
+                                [target_type, *ids]).fetchall()
+            page['threads'][target_type] = _group_comments(rows)
+        item_ids = note_ids + answer_ids
+        for r in conn.execute(f"SELECT item_id, item_type, vote_type FROM votes WHERE user = ? AND item_id IN ({_in(item_ids)})", [viewer, *item_ids]):
+            page['votes'][(r['item_type'], r['item_id'])] = r['vote_type']
+        for r in conn.execute(f"SELECT note_id FROM bookmarks WHERE user = ? AND note_id IN ({_in(note_ids)})", [viewer, *note_ids]):
+            page['bookmarks'].add(r['note_id'])
+    return page
+
+
+def thread_size(thread):
+    return sum(len(v) for v in thread.values())
+
+
+# --- FULL-TEXT SEARCH ---
+SEARCH_LIMIT = 50
+
+
+def fts_query(text):
+    """Turn free text into an FTS5 MATCH expression: every word must match as a prefix (as-you-type)."""
+    words = re.findall(r"\w+", text or "")
+    if not words: return None
+    return " ".join(f'"{w}"*' for w in words)
+
+
+def search_page(text, cursor=None, limit=PAGE_SIZE, subject=None, post_type=None, path=None):
+    """BM25-ranked hits (best first) with a highlighted snippet; paged on (rank, id)."""
+    match = fts_query(text)
+    if not match: return [], None
+    sql = """SELECT notes.*, snippet(notes_fts, -1, '**', '**', '…', 12) AS snippet,
+                    notes_fts.rank AS cursor_key, notes.id AS cursor_id
+             FROM notes_fts JOIN notes ON notes.id = notes_fts.rowid
+             WHERE notes_fts MATCH ?"""
+    params = [match]
+    if subject: sql += " AND notes.subject = ?"; params.append(subject)
+    if post_type: sql += " AND notes.post_type = ?"; params.append(post_type)
+    return _page(sql, params, cursor, limit, "notes_fts.rank", "notes.id", desc=False, path=path)
+
+
+def search_notes(text, subject=None, post_type=None, limit=SEARCH_LIMIT, path=None):
+    return search_page(text, None, limit, subject, post_type, path)[0]
+
+
+def set_note_text(note_id, body, conn=None):
+    """Store extracted document text for a note; the note_text triggers push it into notes_fts."""
+    sql = "INSERT INTO note_text (note_id, body) VALUES (?, ?) ON CONFLICT(note_id) DO UPDATE SET body = excluded.body"
+    if conn is not None: conn.execute(sql, (note_id, body))
+    else: execute(sql, (note_id, body))
+
+
+# --- TAGS ---
+# Tags are normalized into note_tags on write (set_note_tags). Triggers on note_tags keep
+# tag_counts / tag_trend current, so the Feed's trending row is a single indexed read.
+TREND_KEEP_HOURS = 7 * 24
+
+
+def parse_tags(raw):
+    """'#Exam #Hard' -> ['Exam', 'Hard'] (same split the feed renders with), de-duplicated."""
+    return list(dict.fromkeys(t.strip() for t in (raw or "").split('#') if t.strip()))
+
+
+def set_note_tags(conn, note_id, raw, ts):
+    """Sync note_tags for one note with its raw tag string, inside the caller's transaction."""
+    tags = parse_tags(raw)
+    old = {r[0] for r in conn.execute("SELECT tag FROM note_tags WHERE note_id = ?", (note_id,))}
+    for tag in old - set(tags): conn.execute("DELETE FROM note_tags WHERE note_id = ? AND tag = ?", (note_id, tag))
+    for tag in tags:
+        if tag not in old: conn.execute("INSERT INTO note_tags (note_id, tag, ts) VALUES (?, ?, ?)", (note_id, tag, ts))
+    if tags: conn.execute("DELETE FROM tag_trend WHERE bucket < ?", (now() // 3600 - TREND_KEEP_HOURS,))
+
+
+def top_tags(limit=5, path=None):
+    return [r[0] for r in query("SELECT tag FROM tag_counts ORDER BY count DESC, tag LIMIT ?", (limit,), path)]
+
+
+def trending_tags(window_hours=24, half_life_hours=None, limit=5, path=None):
+    """Top tags over the last `window_hours`; with a half-life, older posts count exponentially less."""
+    current = now() // 3600
+    rows = query("SELECT tag, bucket, count FROM tag_trend WHERE bucket > ?", (current - window_hours,), path)
+    scores = {}
+    for r in rows:
+        weight = 0.5 ** ((current - r['bucket']) / half_life_hours) if half_life_hours else 1
+        scores[r['tag']] = scores.get(r['tag'], 0) + r['count'] * weight
+    return [t for t, _ in sorted(scores.items(), key=lambda kv: (-kv[1], kv[0]))[:limit]]
+
+
+# --- NOTIFICATION FAN-OUT ---
+# Up to FANOUT_ON_READ_THRESHOLD followers, a new post writes every follower's notification with one
+# INSERT ... SELECT inside the posting transaction. Above it, the post is recorded once in `broadcasts`
+# and merged into each follower's feed at read time, so posting cost no longer grows with followers.
+FANOUT_ON_READ_THRESHOLD = int(os.environ.get("IITCONNECT_FANOUT_ON_READ", "500"))
+
+
+def fan_out_post(conn, author, note_id, message, ts):
+    followers = conn.execute("SELECT COUNT(*) FROM follows WHERE followee = ?", (author,)).fetchone()[0]
+    if not followers: return
+    if followers > FANOUT_ON_READ_THRESHOLD:
+        conn.execute("INSERT OR REPLACE INTO broadcasts (note_id, author, message, timestamp) VALUES (?, ?, ?, ?)", (note_id, author, message, ts))
+    else:
+        conn.execute("""INSERT INTO notifications (user, message, timestamp)
+                        SELECT follower, ?, ? FROM follows WHERE followee = ? AND follower != ?""", (message, ts, author, author))
+
+
+# A follower's broadcasts since they followed the author. Broadcasts up to seq notification_cursor.read_id have been
+# seen; they were all posted at or before read_ts, so only broadcasts from read_ts on are scanned (author, timestamp index).
+_BROADCASTS_FOR = """SELECT -b.note_id AS id, f.follower AS user, b.message, (b.seq <= :read_id) AS is_read, b.timestamp
+                     FROM follows f JOIN broadcasts b ON b.author = f.followee AND b.timestamp >= f.timestamp
+                     WHERE f.follower = :user"""
+
+
+def unread_notifications(user, limit=10, path=None):
+    """(unread count, latest `limit` rows) across direct notifications and fan-out-on-read broadcasts."""
+    with connection(path) as conn:
+        cursor = conn.execute("SELECT read_ts, read_id FROM notification_cursor WHERE user = ?", (user,)).fetchone()
+        p = {'user': user, 'limit': limit, 'read_ts': cursor['read_ts'] if cursor else 0, 'read_id': cursor['read_id'] if cursor else 0}
+        count = conn.execute("SELECT COUNT(*) FROM notifications WHERE user = ? AND is_read = 0", (user,)).fetchone()[0]
+        count += conn.execute("""SELECT COUNT(*) FROM follows f
+                                 JOIN broadcasts b ON b.author = f.followee AND b.timestamp >= MAX(f.timestamp, :read_ts) AND b.seq > :read_id
+                                 WHERE f.follower = :user""", p).fetchone()[0]
+        rows = conn.execute(f"""SELECT * FROM (SELECT id, user, message, is_read, timestamp FROM notifications WHERE user = :user
+                                               ORDER BY timestamp DESC LIMIT :limit)
+                                UNION ALL SELECT * FROM ({_BROADCASTS_FOR} ORDER BY b.timestamp DESC LIMIT :limit)
+                                ORDER BY timestamp DESC LIMIT :limit""", p).fetchall()
+    return count, rows
+
+
+def mark_notifications_read(user, path=None):
+    with transaction(path) as conn:
+        conn.execute("UPDATE notifications SET is_read = 1 WHERE user = ? AND is_read = 0", (user,))
+        # seq is AUTOINCREMENT: every broadcast committed so far is at or below the current maximum, every later one above it
+        conn.execute("""INSERT INTO notification_cursor (user, read_ts, read_id) VALUES (?, ?, COALESCE((SELECT MAX(seq) FROM broadcasts), 0))
+                        ON CONFLICT(user) DO UPDATE SET read_ts = excluded.read_ts, read_id = excluded.read_id""", (user, now()))
+
+
+# --- REPUTATION ---
+# reputation = upvotes_received*2 + posts_count*5 + answers_count*3, kept as a running total:
+# each event applies its delta in the same transaction as the write that caused it.
+REP_WEIGHTS = {'upvotes': 2, 'posts': 5, 'answers': 3}
+BADGE_TIERS = [(500, "🟣 Professor"), (200, "🟡 Scholar"), (50, "🔵 Contributor")]
+
+
+def badge_for(reputation):
+    for floor, badge in BADGE_TIERS:
+        if (reputation or 0) > floor: return badge
+    return "⚪ Fresher"
+
+
+def adjust_reputation(conn, username, posts=0, answers=0, upvotes=0):
+    """Apply counter deltas and the matching reputation delta; a badge promotion notifies the user.
+    Returns (old_reputation, new_reputation), or None for Anonymous / unknown users."""
+    if not username or username == "Anonymous": return None
+    delta = posts * REP_WEIGHTS['posts'] + answers * REP_WEIGHTS['answers'] + upvotes * REP_WEIGHTS['upvotes']
+    cur = conn.execute("""UPDATE users SET posts_count = posts_count + ?, answers_count = answers_count + ?,
+                                 upvotes_received = upvotes_received + ?, reputation = reputation + ?
+                          WHERE username = ?""", (posts, answers, upvotes, delta, username))
+    if not cur.rowcount: return None
+    new = conn.execute("SELECT reputation FROM users WHERE username = ?", (username,)).fetchone()[0]
+    old = new - delta
+    if delta > 0 and badge_for(new) != badge_for(old):
+        conn.execute("INSERT INTO notifications (user, message, timestamp) VALUES (?, ?, ?)",
+                     (username, f"🏅 You've reached {badge_for(new)}! Reputation: {new}", now()))
+    return old, new
+
+
+def recompute_reputations(path=None):
+    """Repair: rebuild post/answer counts and reputation for every user in one set-based UPDATE."""
+    with transaction(path) as conn:
+        posts = "(SELECT COUNT(*) FROM notes WHERE uploader = users.username)"
+        answers = "(SELECT COUNT(*) FROM answers WHERE responder = users.username)"
+        return conn.execute(f"""UPDATE users SET posts_count = {posts}, answers_count = {answers},
+                                    reputation = upvotes_received * {REP_WEIGHTS['upvotes']} + {posts} * {REP_WEIGHTS['posts']} + {answers} * {REP_WEIGHTS['answers']}""").rowcount
+
+
+# Everything the pages show about a user: not the password hash, nor the legacy profile_pic column.
+USER_COLUMNS = ("username, posts_count, answers_count, upvotes_received, reputation, full_name, college, year, branch, "
+                "age, gender, bio, avatar, is_active")
+
+
+def user_stats(username, path=None):
+    """(user row, doubts, notes, followers, following) for the profile page; (None, 0, 0, 0, 0) if unknown."""
+    with connection(path) as conn:
+        user = conn.execute(f"SELECT {USER_COLUMNS} FROM users WHERE username = ?", (username,)).fetchone()
+        if not user: return None, 0, 0, 0, 0
+        doubts = conn.execute("SELECT COUNT(*) FROM notes WHERE uploader = ? AND post_type = 'DOUBT'", (username,)).fetchone()[0]
+        notes = conn.execute("SELECT COUNT(*) FROM notes WHERE uploader = ? AND post_type = 'RESOURCE'", (username,)).fetchone()[0]
+        followers = conn.execute("SELECT COUNT(*) FROM follows WHERE followee = ?", (username,)).fetchone()[0]
+        following = conn.execute("SELECT COUNT(*) FROM follows WHERE follower = ?", (username,)).fetchone()[0]
+    return user, doubts, notes, followers, following
+
+
+def leaderboard(limit=10, path=None):
+    return query("SELECT username, posts_count, answers_count, reputation FROM users WHERE reputation > 0 ORDER BY reputation DESC LIMIT ?",
+                 (limit,), path)
+
+
+# --- VOTES ---
+# A vote is one write transaction: upsert the voter's row, then apply the resulting delta to the
+# item's upvotes and the author's upvotes_received / reputation (via adjust_reputation).
+# Nothing re-aggregates the votes table on the hot path; reconcile_vote_counters() checks that offline.
+VOTE_TABLES = {"NOTE": ("notes", "uploader"), "ANSWER": ("answers", "responder")}
+
+
+def apply_vote(item_id, item_type, voter, direction, path=None):
+    """Toggle/switch `voter`'s vote on an item; returns the net change to the item's score."""
+    table, author_col = VOTE_TABLES[item_type]
+    with transaction(path) as conn:
+        old = conn.execute("SELECT vote_type FROM votes WHERE user = ? AND item_id = ? AND item_type = ?", (voter, item_id, item_type)).fetchone()
+        if old and old[0] == direction:
+            conn.execute("DELETE FROM votes WHERE user = ? AND item_id = ? AND item_type = ?", (voter, item_id, item_type))
+            delta = -direction
+        else:
+            conn.execute("""INSERT INTO votes (user, item_id, item_type, vote_type) VALUES (?, ?, ?, ?)
+                            ON CONFLICT(user, item_id, item_type) DO UPDATE SET vote_type = excluded.vote_type""",
+                         (voter, item_id, item_type, direction))
+            delta = direction - (old[0] if old else 0)
+        conn.execute(f"UPDATE {table} SET upvotes = COALESCE(upvotes, 0) + ? WHERE id = ?", (delta, item_id))
+        author = conn.execute(f"SELECT {author_col} FROM {table} WHERE id = ?", (item_id,)).fetchone()
+        if author: adjust_reputation(conn, author[0], upvotes=delta)
+    return delta
+
+
+# Votes only count while both the item and the voter exist: deleting either removes the votes and takes
+# their score back from the item and its author, in the caller's transaction. reconcile_vote_counters
+# below checks the counters against that same definition.
+
+def drop_item_votes(conn, item_type, item_ids):
+    """Call before deleting items: take each item's score back from its author, then remove its votes."""
+    table, author_col = VOTE_TABLES[item_type]
+    for i in range(0, len(item_ids), 500): # an account delete can cover thousands of items: stay under SQLite's variable limit
+        ids = item_ids[i:i + 500]
+        rows = conn.execute(f"""SELECT t.{author_col}, SUM(v.vote_type) FROM votes v JOIN {table} t ON t.id = v.item_id
+                                WHERE v.item_type = ? AND v.item_id IN ({_in(ids)}) GROUP BY t.{author_col}""", [item_type, *ids]).fetchall()
+        for author, score in rows:
+            if score: adjust_reputation(conn, author, upvotes=-score)
+        conn.execute(f"DELETE FROM votes WHERE item_type = ? AND item_id IN ({_in(ids)})", [item_type, *ids])
+
+
+def drop_voter_votes(conn, voter):
+    """Call when deleting an account: undo each of its votes on item and author counters, then remove them."""
+    for item_type, (table, author_col) in VOTE_TABLES.items():
+        rows = conn.execute(f"""SELECT t.id, t.{author_col}, v.vote_type FROM votes v JOIN {table} t ON t.id = v.item_id
+                                WHERE v.user = ? AND v.item_type = ?""", (voter, item_type)).fetchall()
+        conn.executemany(f"UPDATE {table} SET upvotes = COALESCE(upvotes, 0) - ? WHERE id = ?", [(r[2], r[0]) for r in rows])
+        per_author = {}
+        for _, author, vote in rows: per_author[author] = per_author.get(author, 0) + vote
+        for author, score in per_author.items():
+            if score: adjust_reputation(conn, author, upvotes=-score)
+    conn.execute("DELETE FROM votes WHERE user = ?", (voter,))
+
+
+def reconcile_vote_counters(fix=True, path=None):
+    """Compare notes/answers.upvotes and users.upvotes_received with the votes table; optionally repair.
+    Returns the drifted rows as dicts (kind, key, stored, actual)."""
+    drift = []
+    with (transaction(path) if fix else connection(path)) as conn:
+        for item_type, (table, author_col) in VOTE_TABLES.items():
+            # votes left behind by deletes before drop_item_votes existed; they count for nothing either way
+            orphans = conn.execute(f"SELECT COUNT(*) FROM votes WHERE item_type = ? AND item_id NOT IN (SELECT id FROM {table})", (item_type,)).fetchone()[0]
+            if orphans:
+                drift.append({'kind': 'votes', 'key': f"{item_type} on deleted items", 'stored': orphans, 'actual': 0})
+                if fix: conn.execute(f"DELETE FROM votes WHERE item_type = ? AND item_id NOT IN (SELECT id FROM {table})", (item_type,))
+            rows = conn.execute(f"""SELECT t.id, COALESCE(t.upvotes, 0) AS stored, COALESCE(v.total, 0) AS actual
+                                    FROM {table} t LEFT JOIN (SELECT item_id, SUM(vote_type) AS total FROM votes
+                                                              WHERE item_type = ? GROUP BY item_id) v ON v.item_id = t.id
+                                    WHERE COALESCE(t.upvotes, 0) != COALESCE(v.total, 0)""", (item_type,)).fetchall()
+            drift += [{'kind': table, 'key': r['id'], 'stored': r['stored'], 'actual': r['actual']} for r in rows]
+            if fix:
+                conn.executemany(f"UPDATE {table} SET upvotes = ? WHERE id = ?", [(r['actual'], r['id']) for r in rows])
+        # After the item fix above, an author's received total is the sum of their items' scores.
+        rows = conn.execute("""SELECT u.username, u.upvotes_received AS stored, COALESCE(s.total, 0) AS actual
+                               FROM users u LEFT JOIN (
+                                   SELECT author, SUM(score) AS total FROM (
+                                       SELECT n.uploader AS author, COALESCE(SUM(v.vote_type), 0) AS score
+                                           FROM notes n JOIN votes v ON v.item_id = n.id AND v.item_type = 'NOTE' GROUP BY n.id
+                                       UNION ALL
+                                       SELECT a.responder, COALESCE(SUM(v.vote_type), 0)
+                                           FROM answers a JOIN votes v ON v.item_id = a.id AND v.item_type = 'ANSWER' GROUP BY a.id)
+                                   GROUP BY author) s ON s.author = u.username
+                               WHERE u.upvotes_received != COALESCE(s.total, 0)""").fetchall()
+        drift += [{'kind': 'users', 'key': r['username'], 'stored': r['stored'], 'actual': r['actual']} for r in rows]
+        if fix:
+            conn.executemany(f"UPDATE users SET upvotes_received = ?, reputation = reputation + {REP_WEIGHTS['upvotes']} * (? - upvotes_received) WHERE username = ?",
+                             [(r['actual'], r['actual'], r['username']) for r in rows])
+    return drift
+
+
+if __name__ == "__main__":
+    # Maintenance entry point, e.g. from cron:
+    #   python db.py reconcile [--dry-run]    vote counters vs the votes table
+    #   python db.py recompute-reputation     rebuild counts + reputation for every user
+    import sys
+    args = sys.argv[1:]
+    migrate()
+    if args[:1] == ["reconcile"]:
+        for d in reconcile_vote_counters(fix="--dry-run" not in args): print(d)
+    elif args[:1] == ["recompute-reputation"]:
+        print(f"recomputed {recompute_reputations()} user(s)")
+    else:
+        print("usage: python db.py reconcile [--dry-run] | recompute-reputation")
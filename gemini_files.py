@@ -0,0 +1,77 @@
+import threading
+import time
+import ai_backend
+import db
+import storage
+
+# --- GEMINI FILE HANDLES ---
+# Vision requests need the document uploaded to the Files API. Handles are registered by content hash, so
+# all five Study Center tasks and every student asking about the same note share one upload until it
+# expires (Gemini keeps files ~48h). A handle that has vanished or expired remotely is re-uploaded transparently.
+
+genai = ai_backend.load()
+
+DEFAULT_TTL = 47 * 3600 # used when the API response carries no expiration_time
+EXPIRY_MARGIN = 600 # don't hand out a handle that may expire mid-request
+PROCESSING_TIMEOUT = 60
+POLL_START, POLL_MAX = 0.5, 8.0
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def _lock_for(content_hash):
+    # one upload per document at a time; concurrent callers wait and then reuse it
+    with _locks_guard: return _locks.setdefault(content_hash, threading.Lock())
+
+
+def wait_until_active(f, timeout=PROCESSING_TIMEOUT):
+    """Poll a PROCESSING file with exponential backoff (0.5s, 1s, 2s ... capped at 8s)."""
+    delay, deadline = POLL_START, time.monotonic() + timeout
+    while f.state.name == "PROCESSING":
+        if time.monotonic() + delay > deadline: raise TimeoutError(f"Gemini is still processing {f.name}")
+        time.sleep(delay)
+        delay = min(delay * 2, POLL_MAX)
+        f = genai.get_file(f.name)
+    if f.state.name == "FAILED": raise RuntimeError(f"Gemini failed to process {f.name}")
+    return f
+
+
+def _expiry(f):
+    exp = getattr(f, 'expiration_time', None)
+    try: return int(exp.timestamp())
+    except Exception: return db.now() + DEFAULT_TTL
+
+
+def _reuse(content_hash):
+    row = db.query_one("SELECT name FROM gemini_files WHERE content_hash = ? AND expires_at > ?", (content_hash, db.now() + EXPIRY_MARGIN))
+    if not row: return None
+    try: f = wait_until_active(genai.get_file(row['name']))
+    except Exception:
+        forget(content_hash) # deleted/expired remotely or failed processing: upload again
+        return None
+    db.execute("UPDATE gemini_files SET uses = uses + 1 WHERE content_hash = ?", (content_hash,))
+    return f
+
+
+def get_or_upload(path, mime_type):
+    """An ACTIVE Gemini file for `path`, reusing the registered handle for its content when still live."""
+    content_hash = storage.file_hash(path)
+    f = _reuse(content_hash)
+    if f: return f
+    with _lock_for(content_hash):
+        f = _reuse(content_hash) # another thread may have uploaded it while we waited
+        if f: return f
+        f = wait_until_active(genai.upload_file(path, mime_type=mime_type))
+        db.execute("""INSERT OR REPLACE INTO gemini_files (content_hash, name, mime_type, uploaded_at, expires_at, uses)
+                      VALUES (?, ?, ?, ?, ?, 1)""", (content_hash, f.name, mime_type, db.now(), _expiry(f)))
+        return f
+
+
+def forget(content_hash):
+    db.execute("DELETE FROM gemini_files WHERE content_hash = ?", (content_hash,))
+
+
+def stats():
+    row = db.query_one("SELECT COUNT(*) AS handles, COALESCE(SUM(uses), 0) AS uses FROM gemini_files WHERE expires_at > ?", (db.now(),))
+    return {'live_handles': row['handles'], 'uploads_saved': row['uses'] - row['handles']}
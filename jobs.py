@@ -0,0 +1,201 @@
+import json
+import math
+import os
+import threading
+import time
+import uuid
+import db
+
+# --- BACKGROUND AI JOBS ---
+# Slow model calls (doubt auto-answers, Study Center generation) are queued in the ai_jobs table and
+# executed by a small per-process worker pool, so a Streamlit script run never blocks on Gemini backoff.
+# Jobs survive restarts: a worker claims a job with a lease, and a job whose lease expires (worker died)
+# is claimed again. A live worker keeps renewing its lease from a heartbeat thread, so a long job (a map-reduce
+# pack over a big deck) is never picked up a second time. Results and failures are only written by the worker
+# that still owns the job. Failures retry with exponential backoff until max_attempts, then stay 'dead'.
+
+WORKERS = int(os.environ.get("IITCONNECT_AI_WORKERS", "2"))
+POLL_SECONDS = 2
+LEASE_SECONDS = 120
+HEARTBEAT_SECONDS = 30
+RETRY_BASE_SECONDS = 15
+PRIORITY_INTERACTIVE, PRIORITY_BATCH = 0, 1
+PROGRESS_SECONDS = 0.5
+
+_handlers = {}
+_local = threading.local() # the job this worker thread is running (and as whom), for report() and owned()
+_wakeup = threading.Event()
+_start_lock = threading.Lock()
+_threads = []
+
+
+def handler(kind):
+    """Register fn(payload) -> result for a job kind. Raise to fail the attempt."""
+    def wrap(fn):
+        _handlers[kind] = fn
+        return fn
+    return wrap
+
+
+def enqueue(kind, payload, dedupe_key=None, priority=PRIORITY_BATCH, max_attempts=3, delay=0):
+    """Queue a job and return its id; if a live job already holds dedupe_key, return that one instead."""
+    ts = db.now()
+    with db.transaction() as conn:
+        if dedupe_key:
+            row = conn.execute("SELECT id FROM ai_jobs WHERE dedupe_key = ? AND status IN ('queued', 'running')", (dedupe_key,)).fetchone()
+            if row: return row[0]
+        cur = conn.execute("""INSERT INTO ai_jobs (kind, payload, dedupe_key, priority, max_attempts, run_after, created_at, updated_at)
+                              VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                           (kind, json.dumps(payload), dedupe_key, priority, max_attempts, ts + delay, ts, ts))
+        job_id = cur.lastrowid
+    _wakeup.set()
+    return job_id
+
+
+def claim(worker):
+    """Atomically take the next runnable job (highest priority, oldest first) or None."""
+    ts = db.now()
+    with db.transaction() as conn:
+        # The worker died holding the job on its last attempt (OOM, crash, restart): dead-letter it rather than re-lease forever.
+        conn.execute("""UPDATE ai_jobs SET status = 'dead', error = 'Lease expired: the worker stopped during the last attempt',
+                               progress = NULL, lease_until = NULL, updated_at = ?
+                        WHERE status = 'running' AND lease_until < ? AND attempts >= max_attempts""", (ts, ts))
+        row = conn.execute("""SELECT id FROM ai_jobs
+                              WHERE (status = 'queued' AND run_after <= :ts) OR (status = 'running' AND lease_until < :ts)
+                              ORDER BY priority, run_after, id LIMIT 1""", {'ts': ts}).fetchone()
+        if not row: return None
+        return conn.execute("""UPDATE ai_jobs SET status = 'running', attempts = attempts + 1, worker = ?, lease_until = ?, updated_at = ?
+                               WHERE id = ? RETURNING *""", (worker, ts + LEASE_SECONDS, ts, row[0])).fetchone()
+
+
+def renew(job_id, worker):
+    """Push the lease of a job this worker is running forward. False once the worker no longer owns it."""
+    with db.transaction() as conn:
+        return conn.execute("UPDATE ai_jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                            (db.now() + LEASE_SECONDS, job_id, worker)).rowcount == 1
+
+
+def _heartbeat(job_id, worker, stop):
+    while not stop.wait(HEARTBEAT_SECONDS):
+        try:
+            if not renew(job_id, worker): return
+        except Exception as e:
+            print(f"AI worker {worker}: lease renewal failed: {e}") # try again next beat; the lease has slack
+
+
+def owned():
+    """True while this thread's job is still leased to it. Handlers check it before side effects (posting an answer)."""
+    job_id = getattr(_local, 'job_id', None)
+    if job_id is None: return True # not running under a worker
+    return db.query_one("SELECT 1 FROM ai_jobs WHERE id = ? AND worker = ? AND status = 'running'", (job_id, _local.worker)) is not None
+
+
+def complete(job_id, worker, result=None):
+    """Store the result; a no-op (False) if the job's lease was lost and it now belongs to someone else."""
+    with db.transaction() as conn:
+        return conn.execute("""UPDATE ai_jobs SET status = 'done', result = ?, error = NULL, progress = NULL, lease_until = NULL, updated_at = ?
+                               WHERE id = ? AND worker = ? AND status = 'running'""", (json.dumps(result), db.now(), job_id, worker)).rowcount == 1
+
+
+def report(text):
+    """Streaming hook for handlers: store the output so far on the running job (at most every PROGRESS_SECONDS)."""
+    job_id = getattr(_local, 'job_id', None)
+    if job_id is None: return
+    ts = time.monotonic()
+    if ts - _local.reported < PROGRESS_SECONDS: return
+    _local.reported = ts
+    db.execute("UPDATE ai_jobs SET progress = ?, lease_until = ? WHERE id = ? AND worker = ? AND status = 'running'",
+               (text, db.now() + LEASE_SECONDS, job_id, _local.worker))
+
+
+def fail(job_id, worker, error, retry_after=None):
+    """Schedule a retry with exponential backoff, or dead-letter the job once its attempts are used up.
+    With retry_after (the shared rate limiter turned the call away) the job is deferred without spending an attempt.
+    Does nothing if this worker no longer owns the job."""
+    ts = db.now()
+    with db.transaction() as conn:
+        row = conn.execute("SELECT attempts, max_attempts FROM ai_jobs WHERE id = ? AND worker = ? AND status = 'running'",
+                           (job_id, worker)).fetchone()
+        if not row: return
+        if retry_after is not None:
+            conn.execute("""UPDATE ai_jobs SET status = 'queued', attempts = attempts - 1, error = ?, progress = NULL, lease_until = NULL,
+                                   run_after = ?, updated_at = ? WHERE id = ?""", (error, ts + math.ceil(retry_after), ts, job_id))
+        elif row['attempts'] >= row['max_attempts']:
+            conn.execute("UPDATE ai_jobs SET status = 'dead', error = ?, progress = NULL, lease_until = NULL, updated_at = ? WHERE id = ?", (error, ts, job_id))
+        else:
+            conn.execute("UPDATE ai_jobs SET status = 'queued', error = ?, progress = NULL, lease_until = NULL, run_after = ?, updated_at = ? WHERE id = ?",
+                         (error, ts + RETRY_BASE_SECONDS * 2 ** (row['attempts'] - 1), ts, job_id))
+
+
+def retry(job_id):
+    """Put a dead-lettered job back in the queue with a fresh set of attempts."""
+    db.execute("UPDATE ai_jobs SET status = 'queued', attempts = 0, run_after = ?, updated_at = ? WHERE id = ? AND status = 'dead'",
+               (db.now(), db.now(), job_id))
+    _wakeup.set()
+
+
+def run_one(worker="inline"):
+    """Claim and execute a single job. Returns False when nothing was runnable."""
+    job = claim(worker)
+    if job is None: return False
+    fn = _handlers.get(job['kind'])
+    _local.job_id, _local.worker, _local.reported = job['id'], worker, 0.0
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job['id'], worker, stop), name=f"ai-lease-{job['id']}", daemon=True).start()
+    try:
+        if fn is None: raise LookupError(f"No handler registered for job kind '{job['kind']}'")
+        complete(job['id'], worker, fn(json.loads(job['payload'] or "null")))
+    except Exception as e:
+        fail(job['id'], worker, f"{type(e).__name__}: {e}", getattr(e, 'retry_after', None))
+    finally:
+        stop.set()
+        _local.job_id = None
+    return True
+
+
+def _work(name):
+    while True:
+        try:
+            while run_one(name): pass
+        except Exception as e:
+            print(f"AI worker {name}: {e}")
+        _wakeup.wait(POLL_SECONDS)
+        _wakeup.clear()
+
+
+def start_workers(n=None):
+    """Start the per-process worker pool once; safe to call on every Streamlit rerun."""
+    with _start_lock:
+        if _threads: return
+        tag = uuid.uuid4().hex[:6]
+        for i in range(n or WORKERS):
+            t = threading.Thread(target=_work, args=(f"{tag}-{i}",), name=f"ai-worker-{i}", daemon=True)
+            t.start(); _threads.append(t)
+
+
+def latest(dedupe_key):
+    return db.query_one("SELECT * FROM ai_jobs WHERE dedupe_key = ? ORDER BY id DESC LIMIT 1", (dedupe_key,))
+
+
+def queue_position(job_id):
+    """1-based position among queued jobs that will run before this one (0 once it is running or finished)."""
+    row = db.query_one("""SELECT COUNT(*) AS ahead FROM ai_jobs j, ai_jobs me
+                          WHERE me.id = ? AND me.status = 'queued' AND j.status = 'queued'
+                            AND (j.priority, j.run_after, j.id) <= (me.priority, me.run_after, me.id)""", (job_id,))
+    return row['ahead'] if row else 0
+
+
+def stats():
+    return {r['status']: r['n'] for r in db.query("SELECT status, COUNT(*) AS n FROM ai_jobs GROUP BY status")}
+
+
+def recent(status=None, limit=50):
+    sql = "SELECT id, kind, status, priority, attempts, max_attempts, error, worker, created_at, updated_at FROM ai_jobs"
+    if status: return db.query(sql + " WHERE status = ? ORDER BY id DESC LIMIT ?", (status, limit))
+    return db.query(sql + " ORDER BY id DESC LIMIT ?", (limit,))
+
+
+def purge(older_than_days=7):
+    """Drop finished jobs past retention; dead letters are kept until retried or inspected."""
+    with db.transaction() as conn:
+        return conn.execute("DELETE FROM ai_jobs WHERE status = 'done' AND updated_at < ?", (db.now() - older_than_days * 86400,)).rowcount
@@ -0,0 +1,216 @@
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# --- QUERY & RENDER PROFILING ---
+# db's pooled connections are ProfiledConnections, so every statement is timed (execute plus fetches) with its
+# row count. Each statement is tagged with the page view running on that thread. app.py opens one view per rerun
+# around the page branch. Samples go into in-memory ring buffers, one set per process, which the Admin panel
+# summarises. Queries from AI workers are tagged BACKGROUND. A st.fragment body runs in fragment(), its own view
+# labelled "<page> › <fragment>", so its periodic reruns don't land in BACKGROUND either.
+# IITCONNECT_PROFILE=0 turns the hooks off. IITCONNECT_PROFILE_SAMPLE keeps only that fraction of page views.
+
+ENABLED = os.environ.get("IITCONNECT_PROFILE", "1") != "0"
+SAMPLE_RATE = float(os.environ.get("IITCONNECT_PROFILE_SAMPLE", "1.0"))
+QUERY_BUFFER = int(os.environ.get("IITCONNECT_PROFILE_QUERIES", "5000"))
+VIEW_BUFFER = 1000
+HISTOGRAM_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000]
+BACKGROUND = "(background)"
+
+_queries = deque(maxlen=QUERY_BUFFER)
+_views = deque(maxlen=VIEW_BUFFER)
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class View:
+    def __init__(self, page, sampled):
+        self.page, self.sampled = page, sampled
+        self.started = self.last = time.perf_counter()
+        self.at = int(time.time())
+        self.queries, self.query_ms = 0, 0.0
+
+
+def begin(page):
+    """Start timing a rerun on this thread. A view cut short by st.rerun() is closed first, at its last query."""
+    stale = getattr(_local, 'view', None)
+    if stale: _finish(stale, stale.last, interrupted=True)
+    _local.view = View(page, random.random() < SAMPLE_RATE)
+    return _local.view
+
+
+def label(page):
+    # the page is only known once the sidebar has run; its queries are counted from begin()
+    view = getattr(_local, 'view', None)
+    if view: view.page = page
+
+
+def end():
+    view = getattr(_local, 'view', None)
+    if view: _finish(view, time.perf_counter())
+
+
+@contextmanager
+def fragment(page, name):
+    """Profile a fragment run as the view "<page> › <name>". Run inline during a page rerun, it also counts
+    towards the enclosing view, which is restored afterwards."""
+    outer = getattr(_local, 'view', None)
+    view = _local.view = View(f"{page} › {name}", random.random() < SAMPLE_RATE)
+    try: yield view
+    finally:
+        _finish(view, time.perf_counter()) # st.rerun() from inside the fragment ends it too
+        if outer is not None and view.sampled and outer.sampled:
+            outer.queries += view.queries; outer.query_ms += view.query_ms; outer.last = view.last
+        _local.view = outer
+
+
+def _finish(view, until, interrupted=False):
+    _local.view = None
+    if not view.sampled: return
+    with _lock:
+        _views.append({'page': view.page, 'ms': (until - view.started) * 1000, 'queries': view.queries,
+                       'query_ms': view.query_ms, 'interrupted': interrupted, 'at': view.at})
+
+
+def record_query(sql, seconds, rows):
+    """Log one statement; returns the sample so later fetches can add to it (None when not sampled)."""
+    view = getattr(_local, 'view', None)
+    if view is not None:
+        if not view.sampled: return None
+        view.queries += 1; view.query_ms += seconds * 1000; view.last = time.perf_counter()
+    elif random.random() >= SAMPLE_RATE: return None
+    sample = {'sql': sql, 'ms': seconds * 1000, 'rows': rows, 'page': view.page if view else BACKGROUND, 'at': int(time.time())}
+    with _lock: _queries.append(sample)
+    return sample
+
+
+def _fetched(sample, seconds, rows):
+    sample['ms'] += seconds * 1000; sample['rows'] += rows
+    view = getattr(_local, 'view', None)
+    if view is not None and view.sampled: view.query_ms += seconds * 1000; view.last = time.perf_counter()
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    _sample = None
+
+    def execute(self, sql, parameters=()):
+        t0 = time.perf_counter()
+        try: return super().execute(sql, parameters)
+        finally: self._sample = record_query(sql, time.perf_counter() - t0, max(self.rowcount, 0))
+
+    def executemany(self, sql, seq_of_parameters):
+        t0 = time.perf_counter()
+        try: return super().executemany(sql, seq_of_parameters)
+        finally: self._sample = record_query(sql, time.perf_counter() - t0, max(self.rowcount, 0))
+
+    def _count(self, t0, rows):
+        if self._sample is not None: _fetched(self._sample, time.perf_counter() - t0, rows)
+
+    def fetchone(self):
+        t0 = time.perf_counter(); row = super().fetchone()
+        self._count(t0, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        t0 = time.perf_counter(); rows = super().fetchmany(self.arraysize if size is None else size)
+        self._count(t0, len(rows))
+        return rows
+
+    def fetchall(self):
+        t0 = time.perf_counter(); rows = super().fetchall()
+        self._count(t0, len(rows))
+        return rows
+
+    def __next__(self):
+        t0 = time.perf_counter(); row = super().__next__()
+        self._count(t0, 1)
+        return row
+
+
+class ProfiledConnection(sqlite3.Connection):
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+# --- REPORTS (Admin panel) ---
+
+def _snapshot():
+    with _lock: return list(_queries), list(_views)
+
+
+def percentile(values, q):
+    if not values: return None
+    s = sorted(values)
+    k = (len(s) - 1) * q
+    lo = int(k); hi = min(lo + 1, len(s) - 1)
+    return s[lo] + (s[hi] - s[lo]) * (k - lo)
+
+
+def normalize(sql):
+    """One shape per statement: whitespace collapsed, IN (?, ?, ...) lists folded."""
+    return re.sub(r"\?(\s*,\s*\?)+", "?, …", re.sub(r"\s+", " ", sql).strip())
+
+
+def slowest(limit=10, page=None, order='p95_ms'):
+    """Statements grouped by shape, slowest first by `order` (p95_ms, max_ms, mean_ms or total_ms)."""
+    groups = {}
+    for q in _snapshot()[0]:
+        if page is None or q['page'] == page: groups.setdefault(normalize(q['sql']), []).append(q)
+    out = []
+    for sql, qs in groups.items():
+        ms = [q['ms'] for q in qs]
+        out.append({'sql': sql, 'calls': len(qs), 'total_ms': round(sum(ms), 1), 'mean_ms': round(sum(ms) / len(ms), 2),
+                    'p95_ms': round(percentile(ms, 0.95), 2), 'max_ms': round(max(ms), 2),
+                    'rows': round(sum(q['rows'] for q in qs) / len(qs), 1), 'pages': ", ".join(sorted({q['page'] for q in qs}))})
+    return sorted(out, key=lambda r: -r[order])[:limit]
+
+
+def page_stats():
+    """Per page: reruns sampled, render time percentiles and queries per view."""
+    groups = {}
+    for v in _snapshot()[1]: groups.setdefault(v['page'], []).append(v)
+    out = []
+    for page, vs in sorted(groups.items()):
+        ms, nq = [v['ms'] for v in vs], [v['queries'] for v in vs]
+        out.append({'page': page, 'views': len(vs), 'p50_ms': round(percentile(ms, 0.5), 1), 'p95_ms': round(percentile(ms, 0.95), 1),
+                    'max_ms': round(max(ms), 1), 'queries_per_view': round(sum(nq) / len(nq), 1), 'max_queries': max(nq),
+                    'db_share': f"{sum(v['query_ms'] for v in vs) / max(sum(ms), 1e-9):.0%}",
+                    'cut_short': sum(1 for v in vs if v['interrupted'])})
+    return out
+
+
+def pages():
+    queries, views = _snapshot()
+    return sorted({v['page'] for v in views} | {q['page'] for q in queries})
+
+
+def histogram(kind="queries", page=None):
+    """[(bucket label, count)] of query latencies or page render times, on HISTOGRAM_MS edges."""
+    queries, views = _snapshot()
+    ms = [r['ms'] for r in (queries if kind == "queries" else views) if page is None or r['page'] == page]
+    # "< 5 ms" is the bucket up to that edge; right-aligned numbers keep the labels in order when a chart sorts them
+    labels = [f"<{edge:>5} ms" for edge in HISTOGRAM_MS] + [f"≥{HISTOGRAM_MS[-1]:>5} ms"]
+    counts = [0] * len(labels)
+    for v in ms: counts[sum(1 for edge in HISTOGRAM_MS if v >= edge)] += 1
+    return list(zip(labels, counts))
+
+
+def stats():
+    queries, views = _snapshot()
+    return {'enabled': ENABLED, 'sample_rate': SAMPLE_RATE, 'queries': len(queries), 'views': len(views),
+            'query_buffer': QUERY_BUFFER, 'view_buffer': VIEW_BUFFER}
+
+
+def reset():
+    with _lock: _queries.clear(); _views.clear()
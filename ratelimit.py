@@ -0,0 +1,131 @@
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# --- GEMINI RATE LIMITER ---
+# One governor per process, shared by every Streamlit session and AI worker thread that uses the API key.
+# Two token buckets (requests/min and tokens/min) plus a cap on in-flight calls. Waiters are served by
+# priority class, then FIFO. A caller that would wait longer than max_wait is rejected immediately with its
+# queue position, instead of sleeping blind. A 429 from the server pauses everyone for a jittered cooldown.
+
+RPM = float(os.environ.get("IITCONNECT_AI_RPM", "10"))
+TPM = float(os.environ.get("IITCONNECT_AI_TPM", "250000"))
+MAX_CONCURRENCY = int(os.environ.get("IITCONNECT_AI_CONCURRENCY", "4"))
+MAX_WAIT = float(os.environ.get("IITCONNECT_AI_MAX_WAIT", "30"))
+INTERACTIVE, BACKGROUND = 0, 1
+
+
+class RateLimited(Exception):
+    def __init__(self, position, retry_after):
+        super().__init__(f"#{position} in line, retry in {retry_after:.0f}s")
+        self.position, self.retry_after = position, retry_after
+
+
+class Governor:
+    def __init__(self, rpm=RPM, tpm=TPM, concurrency=MAX_CONCURRENCY):
+        self.rpm, self.tpm, self.concurrency = rpm, tpm, concurrency
+        self.cond = threading.Condition()
+        self.requests, self.tokens = rpm, tpm # both buckets start full
+        self.updated = time.monotonic()
+        self.cooldown_until = 0.0
+        self.in_flight = 0
+        self.waiters = [] # heap of (priority, seq)
+        self.seq = itertools.count()
+        self.counters = Counter()
+
+    def _refill(self, now):
+        elapsed, self.updated = now - self.updated, now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    def _wait_for(self, tokens, now):
+        """Seconds until the buckets (and any 429 cooldown) would admit one request of `tokens`."""
+        return max(0.0, (1 - self.requests) * 60 / self.rpm, (tokens - self.tokens) * 60 / self.tpm, self.cooldown_until - now)
+
+    def acquire(self, tokens, priority=INTERACTIVE, max_wait=None):
+        """Block until admitted, or raise RateLimited as soon as the estimated wait exceeds max_wait."""
+        tokens = min(tokens, self.tpm) # an oversized prompt must still be admissible eventually
+        me = (priority, next(self.seq))
+        deadline = time.monotonic() + (MAX_WAIT if max_wait is None else max_wait)
+        with self.cond:
+            heapq.heappush(self.waiters, me)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    wait = self._wait_for(tokens, now)
+                    if self.waiters[0] == me and wait <= 0 and self.in_flight < self.concurrency:
+                        self.requests -= 1; self.tokens -= tokens; self.in_flight += 1
+                        self.counters['admitted'] += 1
+                        return
+                    position = sorted(self.waiters).index(me) + 1
+                    eta = wait + (position - 1) * 60 / self.rpm
+                    if now >= deadline or now + eta > deadline:
+                        self.counters['rejected'] += 1
+                        raise RateLimited(position, max(eta, 1.0))
+                    self.cond.wait(min(wait, deadline - now) if wait > 0 else deadline - now) # releases notify
+            finally:
+                if me in self.waiters:
+                    self.waiters.remove(me); heapq.heapify(self.waiters)
+                self.cond.notify_all()
+
+    def release(self, reserved, used=None):
+        """Free the concurrency slot; settle the token bucket against the real usage when it is known."""
+        with self.cond:
+            self.in_flight -= 1
+            if used is not None: self.tokens += min(reserved, self.tpm) - used
+            self.cond.notify_all()
+
+    def penalize(self, seconds):
+        """Server said 429: hold every caller for a jittered cooldown so the retries don't arrive in lockstep."""
+        with self.cond:
+            self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds * random.uniform(1.0, 1.5))
+            self.counters['throttled'] += 1
+            self.cond.notify_all()
+
+    def retry_after(self, tokens=0):
+        with self.cond:
+            now = time.monotonic()
+            self._refill(now)
+            return max(self._wait_for(tokens, now) + len(self.waiters) * 60 / self.rpm, 1.0)
+
+    def stats(self):
+        with self.cond:
+            now = time.monotonic()
+            self._refill(now)
+            return {'in_flight': self.in_flight, 'waiting': len(self.waiters), 'requests_left': int(self.requests),
+                    'tokens_left': int(self.tokens), 'cooldown': max(0.0, self.cooldown_until - now), **self.counters}
+
+
+class Lease:
+    """Handed to the caller inside slot(); set `used` to the response's token count to settle the bucket."""
+    def __init__(self, reserved):
+        self.reserved, self.used = reserved, None
+
+
+GOVERNOR = Governor()
+
+
+@contextmanager
+def slot(tokens, priority=INTERACTIVE, max_wait=None):
+    GOVERNOR.acquire(tokens, priority, max_wait)
+    lease = Lease(tokens)
+    try: yield lease
+    finally: GOVERNOR.release(lease.reserved, lease.used)
+
+
+def penalize(seconds):
+    GOVERNOR.penalize(seconds)
+
+
+def retry_after(tokens=0):
+    return GOVERNOR.retry_after(tokens)
+
+
+def stats():
+    return GOVERNOR.stats()
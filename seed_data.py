@@ -0,0 +1,274 @@
+"""Synthetic data generator: fills a fresh IITConnect database with realistic volumes for load testing.
+
+    python seed_data.py bench.db --preset small
+    python seed_data.py bench.db --users 50000 --notes 500000 --votes 5000000 --comments 1000000
+
+Distributions follow the shape of a real campus feed: a few authors write most posts, a few posts collect most
+votes, comments and bookmarks, and follower counts are power-law (a handful of users followed by thousands).
+Comment threads nest deeply. Rows go straight into the tables with executemany; the schema's own triggers still
+maintain the search index and tag counters. Vote, post and reputation counters are then rebuilt with
+db.reconcile_vote_counters / db.recompute_reputations, so the result looks as if it had been made through the app.
+"""
+import argparse
+import hashlib
+import itertools
+import os
+import random
+import sys
+import time
+
+import db
+
+SUBJECTS = ["Physics", "Mathematics", "CS", "Electronics"]
+COLLEGES = ["IIT Bombay", "IIT Delhi", "IIT Madras", "IIT Kanpur", "IIT Kharagpur", "IIT Roorkee", "IIT Guwahati", "IIT Hyderabad"]
+BRANCHES = ["CSE", "EE", "ME", "CE", "ChE", "EP", "MnC"]
+WORDS = """algorithm array graph tree heap hash sort search dynamic programming recursion complexity pointer memory cache
+           thread process kernel network protocol packet router compiler parser grammar automata turing proof theorem lemma
+           matrix vector eigenvalue determinant integral derivative limit series convergence fourier laplace transform
+           probability random variable distribution expectation variance entropy signal filter circuit voltage current
+           resistor capacitor inductor transistor diode amplifier op-amp frequency phase wave quantum momentum energy force
+           field electric magnetic gravity thermodynamics entropy oscillator optics lens interference diffraction relativity
+           mechanics kinematics torque friction fluid pressure lecture notes tutorial assignment midsem endsem quiz solution
+           previous year paper summary formula sheet lab report derivation example problem concept doubt""".split()
+TAGS = ["Exam", "Midsem", "Endsem", "Quiz", "PYQ", "Notes", "Hard", "Easy", "Important", "Lab", "Assignment", "Formula",
+        "Revision", "Tutorial", "Doubt"] + [f"Topic{i}" for i in range(300)]
+
+PRESETS = {
+    'tiny': dict(users=500, notes=5_000, votes=50_000, comments=10_000, follows=10),
+    'small': dict(users=5_000, notes=50_000, votes=500_000, comments=100_000, follows=20),
+    'medium': dict(users=20_000, notes=200_000, votes=2_000_000, comments=400_000, follows=30),
+    'large': dict(users=50_000, notes=500_000, votes=5_000_000, comments=1_000_000, follows=40),
+}
+DEFAULTS = dict(doubt_share=0.3, answers_per_doubt=1.5, answer_vote_share=0.15, bookmarks=2.0, notifications=5.0,
+                days=365, alpha=1.1, seed=42)
+BATCH = 50_000
+
+
+class Zipf:
+    """Draw items with P(rank r) ~ 1/r^alpha. Ranks are shuffled over the items so popularity is unrelated to id/age."""
+
+    def __init__(self, rng, items, alpha):
+        self.rng = rng
+        self.items = list(items)
+        rng.shuffle(self.items)
+        self.cum = list(itertools.accumulate(1.0 / (r + 1) ** alpha for r in range(len(self.items))))
+
+    def draw(self, k=1):
+        return self.rng.choices(self.items, cum_weights=self.cum, k=k)
+
+    def one(self):
+        return self.draw(1)[0]
+
+
+def words(rng, sampler, lo, hi):
+    return " ".join(sampler.draw(rng.randint(lo, hi)))
+
+
+def _batched(rows, size=BATCH):
+    it = iter(rows)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk: return
+        yield chunk
+
+
+def insert(path, sql, rows):
+    """Bulk insert in BATCH-sized transactions; returns the number of rows offered."""
+    n = 0
+    for chunk in _batched(rows):
+        with db.transaction(path) as conn: conn.executemany(sql, chunk)
+        n += len(chunk)
+    return n
+
+
+def gen_users(rng, n):
+    password = hashlib.sha256(b"password").hexdigest() # every synthetic account logs in with "password"
+    for i in range(n):
+        yield (f"user{i:06d}", password, f"Student {i}", rng.choice(COLLEGES), str(rng.randint(1, 5)), rng.choice(BRANCHES),
+               str(rng.randint(17, 26)), rng.choice(["Male", "Female", "Other"]), "")
+
+
+def gen_notes(rng, n, authors, vocab, tags, doubt_share, start, end):
+    # ids are assigned in time order, as they would be in production
+    stamps = sorted(rng.randint(start, end) for _ in range(n))
+    for i, ts in enumerate(stamps, 1):
+        doubt = rng.random() < doubt_share
+        title = words(rng, vocab, 3, 9).capitalize()
+        note_tags = " ".join(f"#{t}" for t in dict.fromkeys(tags.draw(rng.randint(0, 3))))
+        content = words(rng, vocab, 10, 60) + "?" if doubt else ""
+        yield (i, authors.one(), rng.choice(SUBJECTS), title, "DOUBT" if doubt else f"synthetic/{i}.pdf", 0,
+               1 if rng.random() < 0.2 else 0, note_tags, ts, content, "DOUBT" if doubt else "RESOURCE",
+               None if doubt else f"{title[:40]}.pdf")
+
+
+def gen_comment_trees(rng, n, targets, users, vocab, now):
+    """Threads sized by popularity; each reply goes under the latest comment (a chain), a random one, or the root."""
+    threads = {}
+    for t in targets.draw(n): threads[t] = threads.get(t, 0) + 1
+    cid = 0
+    for (target_type, target_id, ts), size in threads.items():
+        ids = []
+        for _ in range(size):
+            cid += 1
+            r = rng.random()
+            parent = None if not ids or r < 0.25 else ids[-1] if r < 0.65 else rng.choice(ids)
+            ts = min(now, ts + rng.randint(30, 6 * 3600))
+            ids.append(cid)
+            yield (cid, target_id, target_type, parent, users.one(), words(rng, vocab, 3, 25), ts)
+
+
+def plan_votes(rng, n, items, answers, answer_share, n_voters):
+    """{(item_type, item_id): votes} adding up to n (or to every voter on every item, if n is more than that).
+    A voter votes once per item, so an item full at n_voters takes no more and its draws go to the next popular one."""
+    total_items = len(items.items) + (len(answers.items) if answers else 0)
+    n = min(n, total_items * n_voters)
+    plan, placed = {}, 0
+    while placed < n:
+        on_answer = answers and rng.random() < answer_share
+        key = ("ANSWER", answers.one()) if on_answer else ("NOTE", items.one())
+        k = plan.get(key, 0)
+        if k < n_voters: plan[key] = k + 1; placed += 1
+    return plan
+
+
+def gen_votes(rng, plan, voters, n_voters):
+    """Distinct voters per item: popularity-weighted by rejection, or a uniform sample when most users vote on it."""
+    for (item_type, item_id), k in plan.items():
+        if k > n_voters // 2: chosen = rng.sample(voters.items, k)
+        else:
+            chosen = set()
+            while len(chosen) < k: chosen.add(voters.one())
+        for user in chosen: yield (user, item_id, item_type, 1 if rng.random() < 0.85 else -1)
+
+
+def gen_follows(rng, users, followees, avg, now, start):
+    for u in users:
+        # Pareto out-degree: most users follow a few people, some follow hundreds
+        k = min(int(rng.paretovariate(1.5) * avg / 3), len(users) - 1)
+        for v in followees.draw(k):
+            if v != u: yield (u, v, rng.randint(start, now))
+
+
+def generate(path, users, notes, votes, comments, follows, doubt_share=DEFAULTS['doubt_share'],
+             answers_per_doubt=DEFAULTS['answers_per_doubt'], answer_vote_share=DEFAULTS['answer_vote_share'],
+             bookmarks=DEFAULTS['bookmarks'], notifications=DEFAULTS['notifications'], days=DEFAULTS['days'],
+             alpha=DEFAULTS['alpha'], seed=DEFAULTS['seed'], log=None):
+    """Populate a fresh database at `path`; returns {table: row count}. `bookmarks`/`notifications` are per user."""
+    if os.path.exists(path): raise FileExistsError(f"{path} already exists; seed_data only fills a fresh database")
+    log = log or (lambda msg: None)
+    rng = random.Random(seed)
+    end = db.now(); start = end - days * 86400
+    db.migrate(path)
+
+    t0 = time.perf_counter()
+    step = lambda what: log(f"  {what} ({time.perf_counter() - t0:.1f}s)")
+    names = [f"user{i:06d}" for i in range(users)]
+    insert(path, "INSERT INTO users (username, password, full_name, college, year, branch, age, gender, bio) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+           gen_users(rng, users))
+    step(f"{users} users")
+
+    authors = Zipf(rng, names, alpha) # who posts, answers and comments
+    vocab = Zipf(rng, WORDS + [f"term{i}" for i in range(5000)], alpha)
+    tags = Zipf(rng, TAGS, alpha)
+    insert(path, """INSERT INTO notes (id, uploader, subject, title, filename, upvotes, is_verified, tags, timestamp, content, post_type, original_name)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", gen_notes(rng, notes, authors, vocab, tags, doubt_share, start, end))
+    tagged = db.query("SELECT id, tags, timestamp FROM notes WHERE tags != ''", path=path)
+    insert(path, "INSERT INTO note_tags (note_id, tag, ts) VALUES (?, ?, ?)",
+           ((r['id'], t, r['timestamp']) for r in tagged for t in db.parse_tags(r['tags'])))
+    db.execute("DELETE FROM tag_trend WHERE bucket < ?", (end // 3600 - db.TREND_KEEP_HOURS,), path)
+    step(f"{notes} notes")
+
+    doubts = [(r['id'], r['timestamp']) for r in db.query("SELECT id, timestamp FROM notes WHERE post_type = 'DOUBT'", path=path)]
+
+    def gen_answers():
+        for doubt_id, ts in doubts:
+            for _ in range(min(int(rng.expovariate(1 / answers_per_doubt)), 20)):
+                yield (doubt_id, authors.one(), words(rng, vocab, 15, 120), 0, min(end, ts + rng.randint(60, 3 * 86400)))
+    insert(path, "INSERT INTO answers (doubt_id, responder, answer_text, upvotes, timestamp) VALUES (?, ?, ?, ?, ?)", gen_answers())
+    answer_rows = db.query("SELECT id, timestamp FROM answers", path=path)
+    step(f"{len(answer_rows)} answers")
+
+    note_rows = db.query("SELECT id, timestamp FROM notes", path=path)
+    note_ids = [r['id'] for r in note_rows]
+    answer_ids = [r['id'] for r in answer_rows]
+    popular_notes = Zipf(rng, note_ids, alpha)
+    popular_answers = Zipf(rng, answer_ids, alpha) if answer_ids else None
+
+    plan = plan_votes(rng, votes, popular_notes, popular_answers, answer_vote_share, len(names))
+    voters = Zipf(rng, names, 0.6) # voting is spread more evenly than posting
+    placed = insert(path, "INSERT INTO votes (user, item_id, item_type, vote_type) VALUES (?, ?, ?, ?)", gen_votes(rng, plan, voters, len(names)))
+    step(f"{placed} votes" + (f" (of {votes} asked for: every user has voted on every item)" if placed < votes else ""))
+
+    targets = [("NOTE", r['id'], r['timestamp']) for r in note_rows] + [("ANSWER", r['id'], r['timestamp']) for r in answer_rows]
+    insert(path, "INSERT INTO comments (id, target_id, target_type, parent_id, user, comment, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)",
+           gen_comment_trees(rng, comments, Zipf(rng, targets, alpha), authors, vocab, end))
+    step(f"{comments} comments")
+
+    insert(path, "INSERT OR IGNORE INTO follows (follower, followee, timestamp) VALUES (?, ?, ?)",
+           gen_follows(rng, names, Zipf(rng, names, alpha), follows, end, start))
+    with db.transaction(path) as conn:
+        # Authors above the fan-out threshold get broadcasts instead of per-follower notifications (see db.fan_out_post).
+        conn.execute("""INSERT INTO broadcasts (note_id, author, message, timestamp)
+                        SELECT n.id, n.uploader, n.uploader || ' posted a new ' || lower(n.post_type) || ': ' || n.title, n.timestamp
+                        FROM notes n WHERE n.uploader IN (SELECT followee FROM follows GROUP BY followee HAVING COUNT(*) > ?)
+                        ORDER BY n.id""", (db.FANOUT_ON_READ_THRESHOLD,)) # seq in posting order
+    step(f"follow graph (avg {follows}/user)")
+
+    insert(path, "INSERT OR IGNORE INTO bookmarks (user, note_id, timestamp) VALUES (?, ?, ?)",
+           ((rng.choice(names), popular_notes.one(), rng.randint(start, end)) for _ in range(int(users * bookmarks))))
+    insert(path, "INSERT INTO notifications (user, message, is_read, timestamp) VALUES (?, ?, ?, ?)",
+           ((rng.choice(names), f"{authors.one()} answered your doubt!", 1 if rng.random() < 0.7 else 0, rng.randint(start, end))
+            for _ in range(int(users * notifications))))
+    step("bookmarks and notifications")
+
+    db.reconcile_vote_counters(fix=True, path=path)
+    db.recompute_reputations(path)
+    with db.connection(path) as conn: conn.execute("ANALYZE")
+    step("counters rebuilt")
+    return counts(path)
+
+
+def counts(path):
+    tables = ["users", "notes", "answers", "comments", "votes", "follows", "bookmarks", "notifications", "broadcasts", "note_tags"]
+    return {t: db.query_one(f"SELECT COUNT(*) FROM {t}", path=path)[0] for t in tables}
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("path", help="database file to create (must not exist unless --force)")
+    p.add_argument("--preset", choices=sorted(PRESETS), default="tiny", help="base volumes; the flags below override them")
+    for name in ["users", "notes", "votes", "comments"]: p.add_argument(f"--{name}", type=int)
+    p.add_argument("--follows", type=int, help="average accounts followed per user")
+    p.add_argument("--doubt-share", type=float, default=DEFAULTS['doubt_share'], help="fraction of posts that are doubts")
+    p.add_argument("--answers-per-doubt", type=float, default=DEFAULTS['answers_per_doubt'])
+    p.add_argument("--bookmarks", type=float, default=DEFAULTS['bookmarks'], help="per user")
+    p.add_argument("--notifications", type=float, default=DEFAULTS['notifications'], help="per user")
+    p.add_argument("--days", type=int, default=DEFAULTS['days'], help="history span")
+    p.add_argument("--alpha", type=float, default=DEFAULTS['alpha'], help="power-law exponent for popularity")
+    p.add_argument("--seed", type=int, default=DEFAULTS['seed'])
+    p.add_argument("--force", action="store_true", help="replace an existing database")
+    return p.parse_args(argv)
+
+
+def volumes(args):
+    v = dict(PRESETS[args.preset])
+    v.update({k: getattr(args, k) for k in v if getattr(args, k) is not None})
+    return v
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.force:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.path + suffix): os.remove(args.path + suffix)
+    v = volumes(args)
+    print(f"Seeding {args.path}: " + ", ".join(f"{k}={n}" for k, n in v.items()), file=sys.stderr)
+    result = generate(args.path, **v, doubt_share=args.doubt_share, answers_per_doubt=args.answers_per_doubt, bookmarks=args.bookmarks,
+                      notifications=args.notifications, days=args.days, alpha=args.alpha, seed=args.seed,
+                      log=lambda msg: print(msg, file=sys.stderr))
+    for table, n in result.items(): print(f"{table:>14} {n}")
+    return result
+
+
+if __name__ == "__main__":
+    main()
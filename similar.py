@@ -0,0 +1,215 @@
+import re
+import threading
+import time
+import numpy as np
+from scipy import sparse
+import db
+
+# --- SIMILAR DOUBTS ---
+# Offline TF-IDF index over doubts (title + details, plus the top answer at half weight). Used to show
+# "similar answered doubts" while a student types, and to skip or shorten the AI call on a near-duplicate.
+# Raw term counts are kept per doubt, so add/refresh/remove only touch that doubt. Queries score against an
+# immutable weighted matrix. Doubts changed since it was built are scored on their own (an overlay), so they
+# show up at once. A background thread rebuilds the matrix REBUILD_DELAY after a burst of changes and swaps it
+# in. The whole index is reloaded from the DB every REBUILD_SECONDS (also in the background) to pick up votes
+# and other processes' writes. No build or reload ever runs inside a page rerun.
+
+SUGGEST_SCORE = 0.35 # list as similar
+SHORTEN_SCORE = 0.6 # give the model the matched answer and ask for a short reply
+SKIP_SCORE = 0.85 # reuse the matched answer; no model call
+ANSWER_WEIGHT = 0.5
+REBUILD_SECONDS = 900
+REBUILD_DELAY = 2.0
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""a an the is are was were be been to of in on for and or if what why how when where which who whom does do did
+                         i me my we our you your it its this that these those with as at by from can cannot not no there here please
+                         help doubt question anyone someone explain""".split())
+
+_DOUBTS_SQL = """SELECT n.id, n.subject, n.title, n.content,
+                        (SELECT a.answer_text FROM answers a WHERE a.doubt_id = n.id ORDER BY a.upvotes DESC, a.id LIMIT 1) AS answer
+                 FROM notes n WHERE n.post_type = 'DOUBT'"""
+
+
+def tokenize(text):
+    return [t for t in TOKEN_RE.findall((text or "").lower()) if len(t) > 1 and t not in STOPWORDS]
+
+
+def _build(rows, meta, n_terms):
+    """(ids, subjects, csc matrix, idf, position by id) for a snapshot of the per-doubt counts."""
+    ids = list(rows)
+    indptr = np.cumsum([0] + [len(rows[i]) for i in ids])
+    indices = np.fromiter((c for i in ids for c in rows[i]), dtype=np.int64, count=indptr[-1])
+    counts = np.fromiter((v for i in ids for v in rows[i].values()), dtype=np.float64, count=indptr[-1])
+    m = sparse.csr_matrix((1.0 + np.log(counts), indices, indptr), shape=(len(ids), max(n_terms, 1)))
+    df = np.bincount(m.indices, minlength=m.shape[1])
+    idf = np.log((1 + len(ids)) / (1 + df)) + 1.0
+    m.data *= idf[m.indices]
+    norms = np.sqrt(np.asarray(m.multiply(m).sum(axis=1)).ravel())
+    m = sparse.diags(1.0 / np.where(norms > 0, norms, 1.0)) @ m
+    subjects = np.array([meta[i]['subject'] for i in ids], dtype=object)
+    return np.array(ids), subjects, m.tocsc(), idf, {d: n for n, d in enumerate(ids)}
+
+
+def _read_corpus():
+    vocab, rows, meta = {}, {}, {}
+    for r in db.query(_DOUBTS_SQL): _count_terms(r, vocab, rows, meta)
+    return vocab, rows, meta
+
+
+def _count_terms(r, vocab, rows, meta):
+    counts = {}
+    for weight, text in ((1.0, f"{r['title']} {r['content'] or ''}"), (ANSWER_WEIGHT, r['answer'])):
+        for t in tokenize(text):
+            col = vocab.setdefault(t, len(vocab))
+            counts[col] = counts.get(col, 0.0) + weight
+    rows[r['id']] = counts # replaced, never mutated: snapshots share these dicts
+    meta[r['id']] = {'subject': r['subject'], 'title': r['title'], 'answer': r['answer']}
+
+
+class DoubtIndex:
+    """Cosine similarity over TF-IDF vectors (sublinear tf, smoothed idf, L2-normalised rows)."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.vocab = {}
+        self.rows = {} # doubt id -> {term id: weighted count}
+        self.meta = {} # doubt id -> {'subject', 'title', 'answer'}
+        self.built_at = 0.0
+        self.ready = False # first load done
+        self._matrix = None # _build() output; replaced whole, never modified
+        self._dirty = {} # doubt id -> change number, for doubts changed since _matrix was built
+        self._changes = 0
+        self._busy = False # a build or reload thread is running
+        self._reloading = None # ids changed while a reload reads the DB (replayed onto the new corpus)
+
+    def load(self):
+        """Re-read every doubt and rebuild. Slow on a large corpus: run it on a background thread."""
+        with self.lock: self._reloading = set()
+        vocab, rows, meta = _read_corpus()
+        matrix = _build(rows, meta, len(vocab))
+        with self.lock:
+            replay, self._reloading = self._reloading, None
+            self.vocab, self.rows, self.meta, self._matrix, self._dirty = vocab, rows, meta, matrix, {}
+            self.built_at, self.ready = time.monotonic(), True
+        for doubt_id in replay: self.refresh(doubt_id)
+
+    def _changed(self, doubt_id):
+        self._changes += 1
+        self._dirty[doubt_id] = self._changes
+        if self._reloading is not None: self._reloading.add(doubt_id)
+        self._start(self._rebuild)
+
+    def _start(self, target):
+        # one background thread at a time; it re-checks for work before it exits
+        if self._busy: return
+        self._busy = True
+        threading.Thread(target=target, name="similar-index", daemon=True).start()
+
+    def _rebuild(self):
+        while True:
+            time.sleep(REBUILD_DELAY) # let a burst of changes settle into one rebuild
+            with self.lock:
+                if not self._dirty or self._reloading is not None: # nothing left, or the reload will cover it
+                    self._busy = False; return
+                rows, meta, n_terms, upto = dict(self.rows), dict(self.meta), len(self.vocab), self._changes
+            try: matrix = _build(rows, meta, n_terms)
+            except Exception as e:
+                print(f"Similar-doubts rebuild failed: {e}")
+                with self.lock: self._busy = False
+                return
+            with self.lock:
+                self._matrix = matrix
+                self._dirty = {d: n for d, n in self._dirty.items() if n > upto}
+
+    def reload_in_background(self):
+        with self.lock: self._start(self._reload)
+
+    def _reload(self):
+        try: self.load()
+        except Exception as e: print(f"Similar-doubts reload failed: {e}")
+        with self.lock:
+            self._busy, self._reloading = False, None
+            if self._dirty: self._start(self._rebuild) # changes replayed onto the reloaded corpus
+
+    def refresh(self, doubt_id):
+        row = db.query_one(_DOUBTS_SQL + " AND n.id = ?", (doubt_id,))
+        with self.lock:
+            if row:
+                _count_terms(row, self.vocab, self.rows, self.meta)
+                self._changed(doubt_id)
+            else: self.remove(doubt_id)
+
+    def remove(self, doubt_id):
+        with self.lock:
+            self.meta.pop(doubt_id, None)
+            if self.rows.pop(doubt_id, None) is not None: self._changed(doubt_id)
+
+    def search(self, text, subject=None, limit=3, min_score=SUGGEST_SCORE, answered_only=True):
+        """[{'id', 'title', 'subject', 'answer', 'score'}] best first."""
+        with self.lock:
+            counts = {}
+            for t in tokenize(text):
+                if t in self.vocab: counts[self.vocab[t]] = counts.get(self.vocab[t], 0) + 1
+            if not counts or not self.rows or self._matrix is None: return []
+            ids, subjects, m, idf, pos = self._matrix
+            # terms the matrix hasn't seen yet weigh like the rarest ones
+            unseen = np.log(1 + len(ids)) + 1.0
+            weight = {c: (1.0 + np.log(n)) * (idf[c] if c < len(idf) else unseen) for c, n in counts.items()}
+            qnorm = np.sqrt(sum(w * w for w in weight.values()))
+            known = [c for c in weight if c < len(idf)]
+            scored = {}
+            if known:
+                cols = np.array(known, dtype=np.int64)
+                scores = m[:, cols] @ (np.array([weight[c] for c in known]) / qnorm) # only the query's columns are touched
+                if subject: scores = np.where(subjects == subject, scores, 0.0)
+                for i in np.argsort(-scores)[:limit * 4 + len(self._dirty)]:
+                    if scores[i] < min_score: break
+                    scored[int(ids[i])] = float(scores[i])
+            for d in self._dirty: # changed since the build: stale (or no) matrix row, score it directly
+                scored.pop(d, None)
+                row = self.rows.get(d)
+                if row is None or (subject and self.meta[d]['subject'] != subject): continue
+                w = {c: (1.0 + np.log(v)) * (idf[c] if c < len(idf) else unseen) for c, v in row.items()}
+                norm = np.sqrt(sum(x * x for x in w.values()))
+                score = sum(w[c] * weight[c] for c in weight if c in w) / (norm * qnorm) if norm else 0.0
+                if score >= min_score: scored[d] = float(score)
+            out = []
+            for d, score in sorted(scored.items(), key=lambda kv: -kv[1]):
+                if len(out) == limit: break
+                meta = self.meta[d]
+                if answered_only and not meta['answer']: continue
+                out.append(dict(meta, id=d, score=score))
+            return out
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """The shared index, or None while its first load is still running in the background."""
+    global _index
+    with _index_lock:
+        if _index is None: _index = DoubtIndex()
+        if not _index.ready: _index.reload_in_background() # no-op while the first load runs; retries a failed one
+        elif _index.ready and time.monotonic() - _index.built_at > REBUILD_SECONDS:
+            _index.built_at = time.monotonic() # don't start another reload while this one runs
+            _index.reload_in_background()
+    return _index if _index.ready else None
+
+
+def find(text, subject=None, limit=3, min_score=SUGGEST_SCORE):
+    """Similar doubts, best first; [] until the index has loaded."""
+    index = get_index()
+    return index.search(text, subject, limit, min_score) if index else []
+
+
+def refresh(doubt_id):
+    """Re-read one doubt (new, edited, answered or deleted). No-op until the index exists."""
+    if _index is not None: _index.refresh(doubt_id)
+
+
+def remove(doubt_ids):
+    """Drop doubts that are already gone from the DB (e.g. a deleted account's)."""
+    if _index is not None:
+        for doubt_id in doubt_ids: _index.remove(doubt_id)
@@ -0,0 +1,123 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from pypdf import PdfReader
+import db
+
+UPLOAD_FOLDER = "uploaded_notes"
+HASH_CHUNK = 1024 * 1024
+_hash_memo = {}
+_hash_lock = threading.Lock()
+
+# --- CONTENT-ADDRESSED UPLOAD STORE ---
+# Uploads are streamed to disk in chunks while being hashed, then stored once under their SHA-256:
+# uploaded_notes/blobs/<first two hex>/<sha256>.<ext>. Two users uploading "notes.pdf" no longer
+# overwrite each other, identical files are kept once, and everything downstream keys on the hash.
+
+BLOB_DIR = "blobs"
+
+
+def _ext(name):
+    ext = os.path.splitext(name or "")[1].lower()
+    return ext if re.fullmatch(r"\.[a-z0-9]{1,8}", ext) else ""
+
+
+def save_upload(fileobj, original_name):
+    """Store a file-like upload; returns its path relative to UPLOAD_FOLDER (what notes.filename holds)."""
+    if hasattr(fileobj, "seek"): fileobj.seek(0)
+    h, size = hashlib.sha256(), 0
+    fd, tmp = tempfile.mkstemp(dir=UPLOAD_FOLDER, prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in iter(lambda: fileobj.read(HASH_CHUNK), b""):
+                h.update(chunk); out.write(chunk); size += len(chunk)
+        digest = h.hexdigest()
+        rel = os.path.join(BLOB_DIR, digest[:2], digest + _ext(original_name))
+        final = os.path.join(UPLOAD_FOLDER, rel)
+        if os.path.exists(final): os.remove(tmp) # deduplicated
+        else:
+            os.makedirs(os.path.dirname(final), exist_ok=True)
+            os.replace(tmp, final)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+    db.execute("INSERT OR IGNORE INTO blobs (hash, path, size, created_at) VALUES (?, ?, ?, ?)", (digest, rel, size, db.now()))
+    st_ = os.stat(final)
+    with _hash_lock: _hash_memo[(os.path.realpath(final), st_.st_size, st_.st_mtime_ns)] = digest
+    return rel
+
+
+def adopt_legacy_uploads():
+    """Move notes that still point at uploaded_notes/<original name> onto blobs. Returns the number re-pointed."""
+    moved = 0
+    for n in db.query(f"SELECT id, filename FROM notes WHERE filename != 'DOUBT' AND filename NOT LIKE '{BLOB_DIR}/%'"):
+        path = os.path.join(UPLOAD_FOLDER, n['filename'])
+        if not os.path.isfile(path): continue
+        with open(path, "rb") as f: rel = save_upload(f, n['filename'])
+        db.execute("UPDATE notes SET filename = ?, original_name = COALESCE(original_name, ?) WHERE id = ?", (rel, n['filename'], n['id']))
+        moved += 1
+    return moved
+
+
+# --- DOCUMENT TEXT CACHE ---
+# PDFs are parsed once (normally at upload) and their text is kept per page in the DB, keyed by
+# the file's SHA-256. Readers stream pages back lazily and can stop after the first N characters;
+# the vision-vs-text decision reads the cached per-document stats instead of re-parsing.
+
+def file_hash(path):
+    """SHA-256 of a file, memoized on (path, size, mtime) so reruns don't re-read it."""
+    st_ = os.stat(path)
+    key = (os.path.realpath(path), st_.st_size, st_.st_mtime_ns)
+    with _hash_lock:
+        if key in _hash_memo: return _hash_memo[key]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""): h.update(chunk)
+    with _hash_lock: _hash_memo[key] = h.hexdigest()
+    return _hash_memo[key]
+
+
+def extract_pdf(path):
+    """Make sure the page text of `path` is cached; returns its content hash. Parses at most once per file content."""
+    digest = file_hash(path)
+    if db.query_one("SELECT 1 FROM documents WHERE hash = ?", (digest,)): return digest
+    pages = []
+    try:
+        for i, page in enumerate(PdfReader(path).pages):
+            text = page.extract_text() or ""
+            pages.append((digest, i, len(text.strip()), text))
+    except Exception: pass # unreadable/scanned: cache as zero text so we don't retry every request
+    with db.transaction() as conn:
+        conn.executemany("INSERT OR REPLACE INTO document_pages (hash, page_no, chars, text) VALUES (?, ?, ?, ?)", pages)
+        conn.execute("INSERT OR REPLACE INTO documents (hash, pages, chars, text_pages, extracted_at) VALUES (?, ?, ?, ?, ?)",
+                     (digest, len(pages), sum(p[2] for p in pages), sum(1 for p in pages if p[2]), db.now()))
+    return digest
+
+
+def pdf_stats(path):
+    """{'pages', 'chars', 'text_pages'} for a PDF (chars counts non-whitespace-trimmed text per page)."""
+    row = db.query_one("SELECT pages, chars, text_pages FROM documents WHERE hash = ?", (extract_pdf(path),))
+    return dict(row)
+
+
+def iter_pages(path, start=0, batch=8):
+    """Yield (page_no, text) lazily from the cache, reading `batch` pages per query."""
+    digest = extract_pdf(path)
+    page_no = start - 1
+    while True:
+        rows = db.query("SELECT page_no, text FROM document_pages WHERE hash = ? AND page_no > ? ORDER BY page_no LIMIT ?", (digest, page_no, batch))
+        for r in rows: yield r['page_no'], r['text']
+        if len(rows) < batch: return
+        page_no = rows[-1]['page_no']
+
+
+def get_pdf_text(path, max_chars=None):
+    """Concatenated page text, stopping once `max_chars` characters have been collected."""
+    parts, total = [], 0
+    for _, text in iter_pages(path):
+        parts.append(text); total += len(text)
+        if max_chars is not None and total >= max_chars: break
+    text = "".join(parts)
+    return text[:max_chars] if max_chars is not None else text